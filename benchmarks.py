@@ -0,0 +1,612 @@
+import os
+import sys
+import time
+import json
+import argparse
+import platform
+import tempfile
+import glm
+import numpy as np
+from transfunc import TransFunc, TransFuncPopulation, PreintegratedTable
+from dataset import VolumeDataset, TimeSeriesDataset
+from cpuraycaster import CPURaycaster
+from chunkedvolume import ChunkedVolume, convertRawVolume
+import fitness
+
+def loadBuckyball(memoryMapped = False):
+    return VolumeDataset('buckyball_64x64x64x1.vol', 64, 64, 64, 1, True, True, 28, memoryMapped)
+
+def syntheticDataFile(size):
+    # smooth 8 bit test volume (concentric shells around the center), written once to the temp directory
+    dataFile = os.path.join(tempfile.gettempdir(), f'volevol_bench_{size}x{size}x{size}x1.vol')
+    if not os.path.exists(dataFile):
+        coords = (np.arange(size, dtype = np.float32) + 0.5) / size - 0.5
+        with open(dataFile, 'wb') as f:
+            for z in coords:
+                r = np.sqrt(z * z + coords[:, None] ** 2 + coords[None, :] ** 2)
+                shells = 0.5 + 0.5 * np.cos(24 * np.pi * r) * np.clip(1 - 2 * r, 0, 1)
+                (shells * 255).astype(np.uint8).tofile(f)
+    return dataFile
+
+def timeSeriesFiles(size, noTimesteps):
+    # synthetic time series, shells moving outwards over time, one 8 bit file per timestep in the temp directory
+    files = []
+    coords = (np.arange(size, dtype = np.float32) + 0.5) / size - 0.5
+    for t in range(noTimesteps):
+        dataFile = os.path.join(tempfile.gettempdir(), f'volevol_bench_series_{size}_{t}.vol')
+        if not os.path.exists(dataFile):
+            r = np.sqrt(coords[:, None, None] ** 2 + coords[None, :, None] ** 2 + coords[None, None, :] ** 2)
+            shells = 0.5 + 0.5 * np.cos(24 * np.pi * r - 2 * np.pi * t / noTimesteps) * np.clip(1 - 2 * r, 0, 1)
+            (shells * 255).astype(np.uint8).tofile(dataFile)
+        files.append(dataFile)
+    return files
+
+def loadSynthetic(size, memoryMapped = False):
+    return VolumeDataset(syntheticDataFile(size), size, size, size, 1, True, True, 0, memoryMapped)
+
+# raw files of the datasets as (file, sizeX, sizeY, sizeZ, bytesPerVoxel, bigEndian, headerSkip)
+rawFiles = {'buckyball64' : lambda: ('buckyball_64x64x64x1.vol', 64, 64, 64, 1, True, 28),
+            'synthetic256' : lambda: (syntheticDataFile(256), 256, 256, 256, 1, True, 0)}
+
+# datasets of the load / render benchmarks, by name
+datasets = {'buckyball64' : loadBuckyball,
+            'synthetic256' : lambda memoryMapped = False: loadSynthetic(256, memoryMapped)}
+
+# benchmark suite for the hot paths of the renderer
+# usage: python benchmarks.py [--group cpu|gl|ui] [--filter name] [--output results.json] [--compare baseline.json]
+# every measurement is recorded under a name in results (seconds, lower is better); --output writes them as JSON,
+# --compare flags measurements that are slower than in a stored baseline
+# the cpu group runs without Qt / OpenGL, the gl group renders offscreen (also on Mesa llvmpipe, see --software),
+# the ui group times Qt widgets / matplotlib without an OpenGL context
+
+results = {}
+
+# renderer string of the OpenGL context used by the gl group, queried while that context is current
+glRenderer = None
+
+def record(name, seconds):
+    results[name] = seconds
+    return seconds
+
+def timeIt(func, repeats = 20):
+    # best-of-n wall time of func() in seconds
+    best = float('inf')
+    for _ in range(repeats):
+        start = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+def getDataReference(tf : TransFunc, n):
+    # per-sample python loop equivalent to the original TransFunc.getData, kept for comparison
+    samples = []
+    dx = 1/(n-1)
+    for i in range(n):
+        x = i*dx
+        if x < tf.cp[0].x:
+            yrgba = glm.vec4(tf.cp[0].rgba.rgb, 0)
+        elif x > tf.cp[-1].x:
+            yrgba = tf.cp[-1].rgba
+        else:
+            rIdx = tf.findRightIdx(x)
+            p0 = tf.cp[rIdx-1]
+            p1 = tf.cp[rIdx]
+            u = (x - p0.x) / (p1.x - p0.x)
+            v = tf.interpolationFunc(u)
+            yrgba = p0.rgba + v * (p1.rgba - p0.rgba)
+        samples.extend([yrgba.r, yrgba.g, yrgba.b, yrgba.a])
+    return (np.array(samples) * 255).astype(np.uint8)
+
+def benchTransFuncGetData(sizes = (256, 1024, 4096)):
+    tf = TransFunc()
+    tf.addCP(0.5, glm.vec4(0.2, 0.6, 0.9, 0.4))
+    tf.addCP(0.7, glm.vec4(0.9, 0.9, 0.1, 0.2))
+
+    print('TransFunc.getData')
+    print(f'{"n":>6} {"loop [ms]":>12} {"numpy [ms]":>12} {"cached [ms]":>12} {"speedup":>9}')
+    for n in sizes:
+        tLoop = record(f'transfunc/getData/loop/n={n}', timeIt(lambda: getDataReference(tf, n), 5))
+        # invalidate the memoized table so the numpy path is actually timed
+        tNumpy = record(f'transfunc/getData/numpy/n={n}', timeIt(lambda: (tf.lutCache.clear(), tf.getData(n))))
+        tCached = record(f'transfunc/getData/cached/n={n}', timeIt(lambda: tf.getData(n)))
+        print(f'{n:>6} {1000*tLoop:>12.3f} {1000*tNumpy:>12.3f} {1000*tCached:>12.3f} {tLoop/tNumpy:>8.1f}x')
+
+def benchTransFuncUpdate(sizes = (1024, 4096), noCPs = 10):
+    # dragging one control point: full resampling against resampling the range between its neighbours
+    tf = TransFuncPopulation.random(1, noCPs, 0).getTransFunc(0)
+    moved = tf.cp[noCPs // 2]
+    print(f'TransFunc lookup table update ({noCPs} control points, one moved)')
+    for n in sizes:
+        data = tf.getData(n).copy()
+        def drag():
+            prevCPs = tf.controlPointsToArray()
+            moved.rgba.a = 0.75 if moved.rgba.a != 0.75 else 0.25
+            return prevCPs
+        tFull = record(f'transfunc/update/full/n={n}', timeIt(lambda: (drag(), tf.lutCache.clear(), tf.getData(n))))
+        tPartial = record(f'transfunc/update/partial/n={n}', timeIt(lambda: tf.updateData(data, n, *tf.changedRange(drag()))))
+        print(f'  n = {n:>5}: full {1000*tFull:.3f} ms, partial {1000*tPartial:.3f} ms')
+
+def benchSamplesForDrawing(sizes = (200, 1000)):
+    tf = TransFunc()
+    tf.addCP(0.5, glm.vec4(0.2, 0.6, 0.9, 0.4))
+    tf.addCP(0.7, glm.vec4(0.9, 0.9, 0.1, 0.2))
+    print('TransFunc.samplesForDrawing')
+    for n in sizes:
+        t = record(f'transfunc/samplesForDrawing/n={n}', timeIt(lambda: tf.samplesForDrawing(n)))
+        print(f'  {n:>5} samples: {1000*t:.3f} ms')
+
+def benchTransFuncPopulation(size = 256, noCPs = 6, n = 1024):
+    pop = TransFuncPopulation.random(size, noCPs, rng = 0)
+    transFuncs = pop.toTransFuncs()
+
+    def perObject():
+        for tf in transFuncs:
+            tf.lutCache.clear()
+            tf.getData(n)
+
+    tObjects = record('population/getData/perObject', timeIt(perObject, 3))
+    tPop = record('population/getData', timeIt(lambda: pop.getData(n)))
+    tMutate = record('population/mutate', timeIt(lambda: pop.select(np.arange(size)).mutate(rng = 1)))
+    tCrossover = record('population/crossover', timeIt(lambda: pop.crossover(np.arange(size), np.arange(size)[::-1], rng = 1)))
+
+    print(f'TransFuncPopulation ({size} members, {noCPs} control points, n = {n})')
+    print(f'  per-object getData: {1000*tObjects:.2f} ms')
+    print(f'  population getData: {1000*tPop:.2f} ms ({tObjects/tPop:.1f}x)')
+    print(f'  mutate:             {1000*tMutate:.2f} ms')
+    print(f'  crossover:          {1000*tCrossover:.2f} ms')
+
+def benchDatasetLoad(repeats = 3):
+    # VolumeDataset construction, read into memory against memory-mapped (+ one streaming pass over all slabs)
+    print('VolumeDataset load')
+    for name, load in datasets.items():
+        load() # creates the synthetic file outside the timing
+        tRaw = record(f'dataset/load/raw/{name}', timeIt(load, repeats))
+        tMapped = record(f'dataset/load/memmap/{name}', timeIt(lambda: load(True), repeats))
+        def mappedPass():
+            ds = load(True)
+            for _ in ds.slabs(16):
+                pass
+        tPass = record(f'dataset/load/memmap+slabs/{name}', timeIt(mappedPass, repeats))
+        print(f'  {name:>14}: raw {1000*tRaw:.1f} ms, memmap {1000*tMapped:.1f} ms, memmap + slabs {1000*tPass:.1f} ms')
+
+def benchStatistics(repeats = 3):
+    # histogram / statistics pass over the raw data against reading the sidecar of an earlier load
+    print('VolumeDataset statistics')
+    for name, load in datasets.items():
+        ds = load(True)
+        def compute():
+            ds.statistics = None
+            ds.computeStatistics(useCache = False)
+        tCompute = record(f'dataset/statistics/compute/{name}', timeIt(compute, repeats))
+        ds.computeStatistics()
+        def cached():
+            ds.statistics = None
+            ds.computeStatistics()
+        tCached = record(f'dataset/statistics/cached/{name}', timeIt(cached, repeats))
+        print(f'  {name:>14}: computed {1000*tCompute:.1f} ms, from sidecar {1000*tCached:.2f} ms')
+
+def benchChunkedVolume(workerCounts = (1, 4), repeats = 3):
+    # disk footprint and load time of the chunked container against the raw file (file cache warm)
+    print('Chunked volume container')
+    for name, rawFile in rawFiles.items():
+        rawArgs = rawFile()
+        rawSize = os.path.getsize(rawArgs[0])
+        tRaw = record(f'chunked/load/raw/{name}', timeIt(lambda: np.fromfile(rawArgs[0], dtype = np.uint8), repeats))
+        print(f'  {name:>14} raw: {rawSize/2**20:.2f} MiB, {1000*tRaw:.1f} ms')
+        for compression in ('zlib', 'lzma'):
+            chunkedFile = os.path.join(tempfile.gettempdir(), f'volevol_bench_{name}_{compression}.cvol')
+            tConvert = record(f'chunked/convert/{compression}/{name}', 
+                              timeIt(lambda: convertRawVolume(*rawArgs, chunkedFile, compression = compression), 1))
+            chunkedSize = os.path.getsize(chunkedFile)
+            print(f'  {name:>14} {compression}: {chunkedSize/2**20:.2f} MiB ({100*chunkedSize/rawSize:.1f}%), convert {1000*tConvert:.1f} ms')
+            for workers in workerCounts:
+                def load():
+                    volume = ChunkedVolume(chunkedFile, workers)
+                    volume.readAll()
+                    volume.close()
+                t = record(f'chunked/load/{compression}/workers={workers}/{name}', timeIt(load, repeats))
+                print(f'  {"":>14} {compression} load, {workers} threads: {1000*t:.1f} ms')
+
+def benchFitness(noImages = 256, sizes = (32, 64, 256), chunkPixels = (1 << 16, 1 << 18, 1 << 20)):
+    # gradient / histogram metrics of a rendered batch: one image at a time against chunks of chunkPixels pixels
+    for size in sizes:
+        images = np.random.default_rng(0).integers(0, 256, size = (noImages, size, size, 4), dtype = np.uint8)
+        print(f'Fitness metrics ({noImages} images of {size}x{size})')
+        tLoop = record(f'fitness/perImage/{size}x{size}', timeIt(lambda: [fitness.scoreBatch(img) for img in images], 3) / noImages)
+        print(f'  {"per image":>28}: {1000*tLoop:.3f} ms / image')
+        for pixels in chunkPixels:
+            t = record(f'fitness/batch/chunkPixels={pixels}/{size}x{size}', 
+                       timeIt(lambda: fitness.scoreBatch(images, chunkPixels = pixels), 3) / noImages)
+            label = f'chunks of 2^{pixels.bit_length() - 1} px ({min(max(pixels // (size * size), 1), noImages)} images)'
+            print(f'  {label:>28}: {1000*t:.3f} ms / image ({1/t:.0f} images / s, {tLoop/t:.2f}x per image)')
+
+def benchCPURender(sizes = (64, 128), frames = 2):
+    # single-process CPU raycaster, the reference path when no OpenGL is available
+    print('CPURaycaster.render + getPixels')
+    for name, load in datasets.items():
+        raycaster = CPURaycaster(load(), TransFunc(), noiseSeed = 0)
+        for size in sizes:
+            raycaster.resize(size, size)
+            t = record(f'cpu/render/{name}/{size}x{size}', timeIt(lambda: (raycaster.render(), raycaster.getPixels()), frames))
+            print(f'  {name:>14} {size}x{size}: {1000*t:.1f} ms / frame')
+        raycaster.close()
+
+def benchCPURaycasterScaling(workerCounts = (1, 2, 4, 8, 16), w = 256, h = 256, tileSize = 32):
+    raycaster = CPURaycaster(loadBuckyball(), TransFunc(), w, h, noiseSeed = 0)
+    raycaster.tileSize = tileSize
+
+    print(f'CPURaycaster tile-parallel scaling ({w}x{h}, {tileSize}x{tileSize} tiles)')
+    print(f'{"workers":>8} {"time [s]":>10} {"speedup":>9} {"efficiency":>11}')
+    tSingle = None
+    for workers in workerCounts:
+        raycaster.workers = workers
+        raycaster.render() # warm-up, starts the pool
+        t = record(f'cpu/tiles/workers={workers}', timeIt(raycaster.render, 2))
+        tSingle = t if tSingle is None else tSingle
+        speedup = tSingle / t
+        print(f'{workers:>8} {t:>10.3f} {speedup:>8.2f}x {100*speedup/workers:>10.1f}%')
+    raycaster.close()
+
+def benchPreintegratedTable(n = 256):
+    # control points 0.05 apart, moving the middle one of three changes ~10% of the domain
+    tf = TransFunc()
+    for x in (0.05, 0.1, 0.15, 0.45, 0.5, 0.55):
+        tf.addCP(x, glm.vec4(0.2, 0.6, 0.9, 0.4))
+    table = PreintegratedTable(n)
+
+    def full():
+        table.samples = None
+        table.update(tf)
+
+    print(f'PreintegratedTable ({n}x{n})')
+    print(f'  full rebuild: {1000*record("preintegration/table/full", timeIt(full)):.2f} ms')
+    full()
+    for x in (0.1, 0.5):
+        # move one control point back and forth, only the entries whose segment meets its neighbourhood are recomputed
+        cp = tf.cp[tf.findRightIdx(x) - 1]
+        dirtyArea = []
+
+        def incremental():
+            cp.rgba.a = 0.75 if cp.rgba.a != 0.75 else 0.25
+            dirtyArea.append(sum((row1 - row0) * (col1 - col0) for row0, row1, col0, col1 in table.update(tf)) / n**2)
+
+        t = record(f'preintegration/table/incremental/x={x}', timeIt(incremental))
+        print(f'  incremental, point at {x}: {1000*t:.2f} ms, {100*max(dirtyArea):.0f}% of the table recomputed')
+
+def benchTimeSeriesPlayback(size = 128, noTimesteps = 8, fps = 30, frames = 90):
+    # paced playback of a time series: sustained fps and dropped frames with the prefetching loader
+    print(f'Time series playback ({noTimesteps} timesteps of {size}^3, target {fps} fps)')
+    files = timeSeriesFiles(size, noTimesteps)
+    for prefetchCount in (1, 4):
+        series = TimeSeriesDataset(files, size, size, size, 1, True, True, 0, prefetchCount)
+        series.start()
+        series.nextFrame(timeout = 10)
+        nextDue = time.perf_counter()
+        for _ in range(frames):
+            nextDue += 1 / fps
+            time.sleep(max(0.0, nextDue - time.perf_counter()))
+            series.nextFrame()
+        series.stop()
+        stats = series.playbackStats()
+        record(f'timeseries/load/{size}', stats['meanLoadTime'])
+        record(f'timeseries/frameTime/prefetch={prefetchCount}/{size}', 1 / stats['fps'] if stats['fps'] > 0 else float('inf'))
+        print(f'  prefetch {prefetchCount}: {stats["fps"]:.1f} fps, {stats["framesDropped"]} dropped of {frames}, '
+              f'load {1000*stats["meanLoadTime"]:.1f} ms / timestep')
+
+def createOffscreenRenderer(w = 256, h = 256, dataset = None):
+    # imported here, so the CPU benchmarks run without Qt / OpenGL
+    from PySide2.QtWidgets import QApplication
+    from renderer import VolumeRenderer
+    # a QApplication rather than a QGuiApplication, so the widget benchmarks can share it
+    app = QApplication.instance() or QApplication(sys.argv)
+    renderer = VolumeRenderer(dataset or loadBuckyball(), TransFunc(), None, w, h)
+    global glRenderer
+    if glRenderer is None:
+        try:
+            glRenderer = glRendererString()
+        except Exception as e:
+            print(f'Warning: could not query the OpenGL renderer: {e}')
+    return app, renderer
+
+def glRendererString():
+    import OpenGL.GL as gl
+    return gl.glGetString(gl.GL_RENDERER).decode()
+
+def benchSetupShader(frames = 1000):
+    # per-frame CPU cost of VolumeRaycaster.setupShader, without and with uniform / texture binding caches
+    app, renderer = createOffscreenRenderer()
+    print(f'VolumeRaycaster.setupShader ({frames} frames)')
+    for cached in (False, True):
+        renderer.shader.cacheUniforms = cached
+        renderer.cacheTextureBindings = cached
+        renderer.setupShader()
+        t = timeIt(lambda: [renderer.setupShader() for _ in range(frames)], 3) / frames
+        record(f'gl/setupShader/{"cached" if cached else "uncached"}', t)
+        print(f'  {"cached" if cached else "uncached":>8}: {1e6*t:.1f} us / frame')
+
+def timeFrames(renderer, frames):
+    # GPU frame time: render + glFinish, after one warm-up frame
+    import OpenGL.GL as gl
+    def frame():
+        renderer.render()
+        gl.glFinish()
+    frame()
+    return timeIt(lambda: [frame() for _ in range(frames)], 3) / frames
+
+def benchTransFuncTextureUpdate(updates = 100):
+    # VolumeRaycaster.updateTransFunc while one control point is dragged (partial resample + glTexSubImage1D)
+    import OpenGL.GL as gl
+    app, renderer = createOffscreenRenderer()
+    renderer.transFunc.addCP(0.5, glm.vec4(0.2, 0.6, 0.9, 0.4))
+    renderer.updateTransFunc()
+    moved = renderer.transFunc.cp[1]
+    def drag():
+        for i in range(updates):
+            moved.rgba.a = 0.2 + 0.1 * (i % 5)
+            renderer.updateTransFunc()
+        gl.glFinish()
+    t = record('gl/transFuncUpdate', timeIt(drag, 3) / updates)
+    print(f'VolumeRaycaster.updateTransFunc: {1000*t:.3f} ms / update')
+
+def benchTextureUpload(repeats = 3):
+    # dataset upload into the 3D texture, direct and through pixel unpack buffers
+    import OpenGL.GL as gl
+    app, renderer = createOffscreenRenderer()
+    print('Dataset texture upload')
+    for name, load in datasets.items():
+        renderer.dataset = load()
+        for usePBOs in (False, True):
+            renderer.usePixelUnpackBuffers = usePBOs
+            t = record(f'gl/upload/{name}/{"pbo" if usePBOs else "direct"}', 
+                       timeIt(lambda: (renderer.setupDatasetTexture(), gl.glFinish()), repeats))
+            print(f'  {name:>14} {"pbo" if usePBOs else "direct":>6}: {1000*t:.1f} ms')
+
+def benchRenderReadback(sizes = (256, 512, 1024), frames = 20):
+    # frame time of VolumeRenderer.render + getPixels
+    header = 'VolumeRenderer.render + getPixels'
+    for name, load in datasets.items():
+        for size in sizes:
+            app, renderer = createOffscreenRenderer(size, size, load())
+            if header is not None:
+                # glRenderer is only known once createOffscreenRenderer has made a context current
+                print(f'{header} ({glRenderer})')
+                header = None
+            renderer.render()
+            renderer.getPixels()
+            t = timeIt(lambda: [(renderer.render(), renderer.getPixels()) for _ in range(frames)], 3) / frames
+            record(f'gl/render+getPixels/{name}/{size}x{size}', t)
+            print(f'  {name:>14} {size:>4}x{size:<4}: {1000*t:.2f} ms / frame')
+
+def benchProfiler(frames = 200, w = 256, h = 256):
+    # cost of the profiler instrumentation, disabled and enabled, and the per-stage timings it reports
+    app, renderer = createOffscreenRenderer(w, h)
+    print(f'FrameProfiler ({w}x{h})')
+    for enabled in (False, True):
+        renderer.profiler.enabled = enabled
+        t = record(f'gl/profiler/{"enabled" if enabled else "disabled"}', timeFrames(renderer, frames))
+        print(f'  {"enabled" if enabled else "disabled":>8}: {1000*t:.3f} ms / frame')
+    renderer.getPixels()
+    renderer.render()
+    print(renderer.profiler.report())
+    renderer.profiler.enabled = False
+
+def benchTimeSeriesUpload(size = 128, noTimesteps = 8, frames = 40, w = 512, h = 512):
+    # per-frame cost of swapping in a new timestep (upload into the back texture) and rendering it
+    import OpenGL.GL as gl
+    files = timeSeriesFiles(size, noTimesteps)
+    series = TimeSeriesDataset(files, size, size, size, 1, True, True, 0, noTimesteps)
+    app, renderer = createOffscreenRenderer(w, h, series.dataset)
+    series.brickSize = renderer.brickSize
+    series.start()
+    volumes = [series.nextFrame(timeout = 10) for _ in range(noTimesteps)]
+    # copies, the series recycles its slots
+    volumes = [(volume.copy(), brickRanges) for _, volume, brickRanges in volumes]
+    series.stop()
+    print(f'Time series upload + render ({size}^3, {w}x{h})')
+    t = timeFrames(renderer, frames)
+    record(f'gl/timeseries/static/{size}', t)
+    print(f'  {"static":>8}: {1000*t:.2f} ms / frame')
+    counter = iter(range(1 << 30))
+    def frame():
+        volume, brickRanges = volumes[next(counter) % noTimesteps]
+        renderer.uploadVolumeFrame(volume, brickRanges)
+        renderer.render()
+        gl.glFinish()
+    frame()
+    t = record(f'gl/timeseries/playback/{size}', timeIt(lambda: [frame() for _ in range(frames)], 3) / frames)
+    print(f'  {"playback":>8}: {1000*t:.2f} ms / frame ({1/t:.1f} fps)')
+
+def benchHistogramPlotter(sizes = (256, 4096), updates = 30):
+    # the previous HistogramPlotter.updateHist (clear, re-plot and full draw) against the incremental blitted update
+    from PySide2.QtWidgets import QApplication
+    from viewerwidgets import HistogramPlotter
+    app = QApplication.instance() or QApplication(sys.argv)
+    print('HistogramPlotter update')
+    for bins in sizes:
+        histograms = np.random.default_rng(0).random((updates, bins)) * 0.01
+        full = HistogramPlotter()
+        def fullRedraw(histVals):
+            axes = full.axes
+            xVals = np.arange(0.0, 1.0, 1.0 / bins)
+            axes.cla()
+            axes.plot(xVals, histVals)
+            histMean = (np.max(histVals) - np.min(histVals)) / 2
+            axes.plot([0, 1], [histMean, histMean])
+            chi2 = np.sum((histVals - histMean)**2)/histMean
+            axes.annotate(f'chi2 = {round(chi2, 3)}', (0.02, 0.009))
+            axes.set_xlim(full.xRange)
+            axes.set_ylim(full.yRange)
+            full.fig.canvas.draw()
+        tFull = record(f'ui/histogram/fullRedraw/{bins}', timeIt(lambda: [fullRedraw(hv) for hv in histograms], 1) / updates)
+        plotter = HistogramPlotter()
+        plotter.drawHist(histograms[0])
+        tBlit = record(f'ui/histogram/incremental/{bins}', timeIt(lambda: [plotter.drawHist(hv) for hv in histograms], 1) / updates)
+        print(f'  {bins:>5} bins: full redraw {1000*tFull:.2f} ms ({1/tFull:.0f} Hz), incremental {1000*tBlit:.2f} ms ({1/tBlit:.0f} Hz)')
+
+def benchTransFuncWidgetPaint(noCPs = 50, paints = 50):
+    # TransFuncWidget.paintEvent with 50 control points: plain repaints (cached) against repaints while dragging
+    from PySide2.QtWidgets import QApplication
+    from transfuncwidget import TransFuncWidget
+    app = QApplication.instance() or QApplication(sys.argv)
+    tf = TransFuncPopulation.random(1, noCPs, 0).getTransFunc(0)
+    widget = TransFuncWidget(tf)
+    widget.resize(600, 200)
+    widget.grab()
+    print(f'TransFuncWidget paint ({noCPs} control points)')
+    tRepaint = record('ui/transFuncWidget/repaint', timeIt(lambda: [widget.grab() for _ in range(paints)], 3) / paints)
+    def drag():
+        for i in range(paints):
+            tf.cp[noCPs // 2].rgba.a = 0.5 + 0.4 * (i % 2)
+            widget.grab()
+    tDrag = record('ui/transFuncWidget/drag', timeIt(drag, 3) / paints)
+    print(f'  repaint {1000*tRepaint:.2f} ms, drag {1000*tDrag:.2f} ms / frame')
+
+def benchLevelOfDetail(frames = 20, w = 512, h = 512):
+    # frame time and texture memory per pyramid level of the 256^3 dataset, levels activated by hand
+    app, renderer = createOffscreenRenderer(w, h, datasets['synthetic256']())
+    levels = renderer.dataset.buildPyramid(renderer.pyramidMinSize, renderer.pyramidReduction)
+    print(f'Level of detail ({w}x{h}, {len(levels)} levels)')
+    for level, ds in enumerate(levels):
+        renderer.activateLevel(level)
+        t = record(f'gl/lod/level={level}', timeFrames(renderer, frames))
+        print(f'  level {level} ({ds.sizeX}x{ds.sizeY}x{ds.sizeZ}, {renderer.levelTextureBytes(level)/2**20:.2f} MiB): {1000*t:.2f} ms / frame')
+    renderer.activateLevel(0)
+
+def benchEmptySpaceSkipping(frames = 50, w = 512, h = 512):
+    app, renderer = createOffscreenRenderer(w, h)
+    occupied = renderer.classifyBricks(renderer.transFuncData)
+    print(f'Empty-space skipping ({w}x{h}, {renderer.brickSize}^3 bricks, {100*occupied.mean():.1f}% occupied)')
+    for enabled in (False, True):
+        renderer.enableEmptySpaceSkipping = enabled
+        t = record(f'gl/emptySpaceSkipping/{"on" if enabled else "off"}', timeFrames(renderer, frames))
+        print(f'  {"on" if enabled else "off":>4}: {1000*t:.2f} ms / frame')
+
+def benchGradients(frames = 50, w = 512, h = 512):
+    # on-the-fly gradients (six extra fetches per lit sample) against precomputed gradient textures
+    app, renderer = createOffscreenRenderer(w, h)
+    ds = renderer.dataset
+    dataBytes = ds.sizeX * ds.sizeY * ds.sizeZ * np.dtype(ds.dataType).itemsize
+    print(f'Gradients ({w}x{h}, dataset texture {dataBytes/2**20:.1f} MiB)')
+    print(f'{"gradients":>10} {"setup [ms]":>11} {"memory [MiB]":>13} {"frame [ms]":>11} {"fps":>7}')
+    for gradientFormat in (None, 'RGB8', 'RGB10_A2'):
+        renderer.gradientFormat = gradientFormat
+        tSetup = timeIt(renderer.setupGradientTexture, 1)
+        t = timeFrames(renderer, frames)
+        name = gradientFormat or 'on-the-fly'
+        record(f'gl/gradients/{name}', t)
+        print(f'{name:>10} {1000*tSetup:>11.1f} {renderer.gradientTextureBytes()/2**20:>13.2f} {1000*t:>11.2f} {1/t:>7.1f}')
+    renderer.gradientFormat = None
+    renderer.setupGradientTexture()
+
+def benchPreintegration(frames = 50, w = 512, h = 512):
+    # post-classification at the default sampling rate against pre-integration at 3-5x larger steps
+    app, renderer = createOffscreenRenderer(w, h)
+    defaultRate = renderer.samplingRate
+    print(f'Pre-integrated classification ({w}x{h})')
+    for preintegrated, rate in ((False, defaultRate), (False, defaultRate / 4), (True, defaultRate / 4), (True, defaultRate / 3)):
+        renderer.usePreintegration = preintegrated
+        renderer.samplingRate = rate
+        t = record(f'gl/preintegration/{"preintegrated" if preintegrated else "1d"}/rate={rate:.2f}', timeFrames(renderer, frames))
+        print(f'  {"pre-integrated" if preintegrated else "1D table":>14}, {rate:.2f} samples / voxel: {1000*t:.2f} ms / frame')
+    renderer.usePreintegration = False
+    renderer.samplingRate = defaultRate
+
+# (group, benchmark) in the order they run
+benchmarks = [('cpu', benchDatasetLoad),
+              ('cpu', benchStatistics),
+              ('cpu', benchChunkedVolume),
+              ('cpu', benchTransFuncGetData),
+              ('cpu', benchTransFuncUpdate),
+              ('cpu', benchSamplesForDrawing),
+              ('cpu', benchTransFuncPopulation),
+              ('cpu', benchPreintegratedTable),
+              ('cpu', benchTimeSeriesPlayback),
+              ('cpu', benchFitness),
+              ('cpu', benchCPURender),
+              ('cpu', benchCPURaycasterScaling),
+              ('gl', benchTextureUpload),
+              ('gl', benchTransFuncTextureUpdate),
+              ('gl', benchRenderReadback),
+              ('gl', benchSetupShader),
+              ('gl', benchProfiler),
+              ('gl', benchTimeSeriesUpload),
+              ('gl', benchLevelOfDetail),
+              ('gl', benchEmptySpaceSkipping),
+              ('gl', benchGradients),
+              ('gl', benchPreintegration),
+              ('ui', benchHistogramPlotter),
+              ('ui', benchTransFuncWidgetPaint)]
+
+def environmentInfo(glRenderer):
+    return {'time' : time.strftime('%Y-%m-%d %H:%M:%S'),
+            'platform' : platform.platform(),
+            'python' : platform.python_version(),
+            'numpy' : np.__version__,
+            'cpus' : os.cpu_count(),
+            'glRenderer' : glRenderer}
+
+def compareResults(baseline, current, threshold):
+    '''
+    prints current against baseline measurements, a measurement more than threshold (relative) slower 
+    than its baseline is a regression; returns the names of the regressions
+    '''
+    regressions = []
+    print(f'{"benchmark":<56} {"baseline":>11} {"current":>11} {"change":>8}')
+    for name, t in current.items():
+        tBase = baseline.get(name)
+        if tBase is None or tBase <= 0:
+            print(f'{name:<56} {"-":>11} {1000*t:>9.3f}ms {"new":>8}')
+            continue
+        change = t / tBase - 1
+        flag = ''
+        if change > threshold:
+            flag = '  REGRESSION'
+            regressions.append(name)
+        elif change < -threshold:
+            flag = '  improved'
+        print(f'{name:<56} {1000*tBase:>9.3f}ms {1000*t:>9.3f}ms {100*change:>+7.1f}%{flag}')
+    for name in baseline:
+        if name not in current:
+            print(f'{name:<56} missing in the current run')
+    return regressions
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = 'benchmarks of the render, transfer function and I/O hot paths')
+    parser.add_argument('--group', choices = ['all', 'cpu', 'gl', 'ui'], default = 'all')
+    parser.add_argument('--filter', default = None, help = 'run only the benchmarks whose function name contains this')
+    parser.add_argument('--output', default = None, help = 'write the results to this JSON file')
+    parser.add_argument('--compare', default = None, help = 'baseline JSON file written by --output')
+    parser.add_argument('--threshold', type = float, default = 0.1, help = 'relative slowdown reported as regression')
+    parser.add_argument('--software', action = 'store_true', help = 'force Mesa software rendering (llvmpipe)')
+    args = parser.parse_args()
+
+    # headless: without a display Qt renders through the offscreen platform
+    if not os.environ.get('DISPLAY') and not os.environ.get('WAYLAND_DISPLAY') and sys.platform.startswith('linux'):
+        os.environ.setdefault('QT_QPA_PLATFORM', 'offscreen')
+    if args.software:
+        os.environ['LIBGL_ALWAYS_SOFTWARE'] = '1'
+
+    for group, bench in benchmarks:
+        if args.group != 'all' and group != args.group:
+            continue
+        if args.filter is not None and args.filter.lower() not in bench.__name__.lower():
+            continue
+        try:
+            bench()
+        except Exception as e:
+            # e.g. no Qt / OpenGL on this machine, the remaining benchmarks still run
+            print(f'Warning: {bench.__name__} failed: {e}')
+
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump({'environment' : environmentInfo(glRenderer), 'results' : results}, f, indent = 4)
+        print(f'results written to {args.output}')
+
+    if args.compare is not None:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        print(f'comparison against {args.compare} ({baseline["environment"]["time"]})')
+        regressions = compareResults(baseline['results'], results, args.threshold)
+        if regressions:
+            print(f'{len(regressions)} regression(s) above {100*args.threshold:.0f}%')
+            sys.exit(1)
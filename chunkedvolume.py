@@ -0,0 +1,240 @@
+import os
+import sys
+import json
+import zlib
+import lzma
+import math
+import struct
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+
+# chunked volume container (.cvol)
+#
+# layout:  'CVOL' | version (uint32) | header size (uint32) | header (utf-8 json) | brick index | bricks
+# header:  dims [x, y, z], dtype (without byte order), endianness ('big', 'little' or 'none'), spacing [x, y, z],
+#          valueRange [min, max], histogram {'bins', 'range', 'counts'}, brickSize, compression
+# index:   one (offset, size) uint64 little-endian pair per brick, bricks in z, y, x order
+# bricks:  independently compressed, brickSize^3 voxels (cropped at the volume border), in the declared byte order
+
+magic = b'CVOL'
+formatVersion = 1
+
+compressors = {'none' : (lambda data, level: data, lambda data: data),
+               'zlib' : (lambda data, level: zlib.compress(data, level), zlib.decompress),
+               'lzma' : (lambda data, level: lzma.compress(data, preset = level), lzma.decompress)}
+
+def brickSlices(brickIdx, brickSize, shape):
+    # (z, y, x) slices of brick brickIdx = (bz, by, bx) in a volume of the given (z, y, x) shape
+    return tuple(slice(b * brickSize, min((b + 1) * brickSize, n)) for b, n in zip(brickIdx, shape))
+
+def writeChunkedVolume(fileName, volume, spacing = (1.0, 1.0, 1.0), brickSize = 32,
+                       compression = 'zlib', level = 6, histogramBins = 256, workers = None):
+    '''
+    writes the (z, y, x) array volume (e.g. a np.memmap of a raw file) as a chunked volume file
+    bricks are compressed in a thread pool, one layer of bricks at a time, so the volume is streamed
+    '''
+    if compression not in compressors:
+        print(f'Error: unknown compression {compression}, expected one of {list(compressors)}')
+        return False
+    compress = compressors[compression][0]
+    sizeZ, sizeY, sizeX = volume.shape
+    bricks = [math.ceil(n / brickSize) for n in volume.shape]
+
+    # first pass: value range, needed for the histogram bins
+    minValue = None
+    maxValue = None
+    for bz in range(bricks[0]):
+        layer = volume[bz * brickSize : (bz + 1) * brickSize]
+        minValue = layer.min() if minValue is None else min(minValue, layer.min())
+        maxValue = layer.max() if maxValue is None else max(maxValue, layer.max())
+    minValue = minValue.item()
+    maxValue = maxValue.item()
+
+    dtype = volume.dtype
+    byteOrder = dtype.byteorder
+    if byteOrder == '=':
+        byteOrder = '>' if sys.byteorder == 'big' else '<'
+    endianness = 'none' if dtype.itemsize == 1 else ('big' if byteOrder == '>' else 'little')
+    counts = np.zeros(histogramBins, dtype = np.int64)
+    compressed = []
+    with ThreadPoolExecutor(workers) as pool:
+        for bz in range(bricks[0]):
+            layer = np.asarray(volume[bz * brickSize : (bz + 1) * brickSize])
+            counts += np.histogram(layer, bins = histogramBins, range = (minValue, maxValue))[0]
+            layerBricks = [layer[brickSlices((0, by, bx), brickSize, layer.shape)]
+                           for by in range(bricks[1]) for bx in range(bricks[2])]
+            compressed.extend(pool.map(lambda brick: compress(np.ascontiguousarray(brick).tobytes(), level), layerBricks))
+
+    header = {'dims' : [sizeX, sizeY, sizeZ],
+              'dtype' : dtype.str[1:],
+              'endianness' : endianness,
+              'spacing' : [float(s) for s in spacing],
+              'valueRange' : [minValue, maxValue],
+              'histogram' : {'bins' : histogramBins, 'range' : [minValue, maxValue], 'counts' : counts.tolist()},
+              'brickSize' : brickSize,
+              'compression' : compression}
+    headerBytes = json.dumps(header).encode('utf-8')
+
+    dataStart = 12 + len(headerBytes) + 16 * len(compressed)
+    sizes = np.array([len(c) for c in compressed], dtype = np.uint64)
+    offsets = dataStart + np.concatenate([[0], np.cumsum(sizes)[:-1]]).astype(np.uint64)
+    index = np.stack([offsets, sizes], axis = 1).astype('<u8')
+
+    with open(fileName, 'wb') as f:
+        f.write(magic)
+        f.write(struct.pack('<II', formatVersion, len(headerBytes)))
+        f.write(headerBytes)
+        f.write(index.tobytes())
+        for c in compressed:
+            f.write(c)
+    return True
+
+def convertRawVolume(rawFile, sizeX, sizeY, sizeZ, bytesPerVoxel, bigEndian = True, headerSkip = 0,
+                     outFile = None, **writeArgs):
+    '''
+    converts a raw volume file (as read by VolumeDataset) to a chunked volume file,
+    outFile defaults to the raw file name with the extension .cvol; returns the output file name
+    '''
+    endianChar = '>' if bigEndian else '<'
+    dataTypes = {1 : 'B', 2 : f'{endianChar}u2', 4 : f'{endianChar}f'}
+    if bytesPerVoxel not in dataTypes:
+        print(f'Error: unsupported voxel size {bytesPerVoxel}')
+        return None
+    if outFile is None:
+        outFile = os.path.splitext(rawFile)[0] + '.cvol'
+    volume = np.memmap(rawFile, dtype = dataTypes[bytesPerVoxel], mode = 'r',
+                       offset = headerSkip, shape = (sizeZ, sizeY, sizeX))
+    if not writeChunkedVolume(outFile, volume, **writeArgs):
+        return None
+    return outFile
+
+class ChunkedVolume:
+    '''
+    reader of chunked volume files
+    bricks are decompressed in a thread pool (zlib / lzma release the GIL) directly into the slab being read,
+    the bricks of the last layer read are kept, so slabs that are not aligned to bricks decompress each brick once
+    '''
+    def __init__(self, fileName, workers = None):
+        self.fileName = fileName
+        self.workers = workers
+        self.pool = None
+        self.file = open(fileName, 'rb')
+        self.fileLock = threading.Lock()
+        # stays None if the file is not a chunked volume file
+        self.header = None
+
+        if self.file.read(4) != magic:
+            print(f'Error: {fileName} is not a chunked volume file')
+            self.file.close()
+            return
+        version, headerSize = struct.unpack('<II', self.file.read(8))
+        if version > formatVersion:
+            print(f'Warning: {fileName} has format version {version}, newer than {formatVersion}')
+        self.header = json.loads(self.file.read(headerSize).decode('utf-8'))
+
+        sizeX, sizeY, sizeZ = self.header['dims']
+        self.shape = (sizeZ, sizeY, sizeX)
+        byteOrder = {'big' : '>', 'little' : '<', 'none' : '|'}[self.header['endianness']]
+        self.dtype = np.dtype(byteOrder + self.header['dtype'])
+        self.brickSize = self.header['brickSize']
+        self.bricks = tuple(math.ceil(n / self.brickSize) for n in self.shape)
+        self.decompress = compressors[self.header['compression']][1]
+
+        noBricks = self.bricks[0] * self.bricks[1] * self.bricks[2]
+        self.index = np.frombuffer(self.file.read(16 * noBricks), dtype = '<u8').reshape((noBricks, 2))
+
+        # decoded bricks of the most recently read brick layer, {(by, bx) : array}
+        self.cachedLayer = None
+        self.cachedBricks = {}
+
+    def isChunkedFile(fileName):
+        with open(fileName, 'rb') as f:
+            return f.read(4) == magic
+
+    def valueRange(self):
+        return tuple(self.header['valueRange'])
+
+    def histogram(self):
+        # (counts, bin edges) of the voxel values, as np.histogram
+        hist = self.header['histogram']
+        return np.array(hist['counts']), np.linspace(hist['range'][0], hist['range'][1], hist['bins'] + 1)
+
+    def readBrick(self, bz, by, bx):
+        # brick in native byte order, shape cropped at the volume border
+        offset, size = self.index[(bz * self.bricks[1] + by) * self.bricks[2] + bx]
+        with self.fileLock:
+            self.file.seek(int(offset))
+            data = self.file.read(int(size))
+        shape = tuple(s.stop - s.start for s in brickSlices((bz, by, bx), self.brickSize, self.shape))
+        brick = np.frombuffer(self.decompress(data), dtype = self.dtype).reshape(shape)
+        return brick.astype(self.dtype.newbyteorder('='), copy = False)
+
+    def readSlab(self, z0, z1, out = None):
+        '''
+        slices [z0, z1) as a (z1-z0, sizeY, sizeX) array in native byte order (written to out if given)
+        '''
+        if out is None:
+            out = np.empty((z1 - z0,) + self.shape[1:], dtype = self.dtype.newbyteorder('='))
+        if self.pool is None:
+            self.pool = ThreadPoolExecutor(self.workers)
+
+        B = self.brickSize
+        layers = range(z0 // B, (z1 - 1) // B + 1)
+        bricksYX = [(by, bx) for by in range(self.bricks[1]) for bx in range(self.bricks[2])]
+
+        def copyBrick(bz, by, bx):
+            if bz == self.cachedLayer and (by, bx) in self.cachedBricks:
+                brick = self.cachedBricks[(by, bx)]
+            else:
+                brick = self.readBrick(bz, by, bx)
+            zs, ys, xs = brickSlices((bz, by, bx), B, self.shape)
+            bz0 = max(z0, zs.start)
+            bz1 = min(z1, zs.stop)
+            out[bz0 - z0 : bz1 - z0, ys, xs] = brick[bz0 - zs.start : bz1 - zs.start]
+            return brick
+
+        jobs = [(bz, by, bx) for bz in layers for by, bx in bricksYX]
+        decoded = list(self.pool.map(lambda job: copyBrick(*job), jobs))
+
+        # keep the last layer if the slab ends inside it, the next slab starts there
+        lastLayer = layers[-1]
+        if z1 % B != 0 and z1 < self.shape[0]:
+            self.cachedLayer = lastLayer
+            self.cachedBricks = {(by, bx) : brick for (bz, by, bx), brick in zip(jobs, decoded) if bz == lastLayer}
+        else:
+            self.cachedLayer = None
+            self.cachedBricks = {}
+        return out
+
+    def readAll(self):
+        return self.readSlab(0, self.shape[0])
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.shutdown()
+            self.pool = None
+        self.file.close()
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description = 'convert a raw volume file to a chunked volume file')
+    parser.add_argument('rawFile')
+    parser.add_argument('sizeX', type = int)
+    parser.add_argument('sizeY', type = int)
+    parser.add_argument('sizeZ', type = int)
+    parser.add_argument('bytesPerVoxel', type = int)
+    parser.add_argument('--little-endian', action = 'store_true')
+    parser.add_argument('--header-skip', type = int, default = 0)
+    parser.add_argument('--spacing', type = float, nargs = 3, default = [1.0, 1.0, 1.0])
+    parser.add_argument('--brick-size', type = int, default = 32)
+    parser.add_argument('--compression', choices = list(compressors), default = 'zlib')
+    parser.add_argument('--level', type = int, default = 6)
+    parser.add_argument('--out', default = None)
+    args = parser.parse_args()
+
+    outFile = convertRawVolume(args.rawFile, args.sizeX, args.sizeY, args.sizeZ, args.bytesPerVoxel,
+                               not args.little_endian, args.header_skip, args.out, spacing = args.spacing,
+                               brickSize = args.brick_size, compression = args.compression, level = args.level)
+    if outFile is not None:
+        print(f'{args.rawFile} ({os.path.getsize(args.rawFile)} bytes) -> {outFile} ({os.path.getsize(outFile)} bytes)')
@@ -0,0 +1,410 @@
+import math
+import multiprocessing
+from multiprocessing import shared_memory
+import numpy as np
+import glm
+import zpr
+from dataset import VolumeDataset
+from transfunc import TransFunc
+
+# headless reference implementation of raycaster.vert / raycaster.frag in numpy
+# it uses the same camera model as VolumeRaycaster and needs no opengl context,
+# so it can run on machines without a GPU (render nodes, CI)
+
+# shared volumes attached by this (worker) process, name -> (SharedMemory, ndarray)
+attachedVolumes = {}
+
+def attachSharedVolume(name, shape):
+    if name not in attachedVolumes:
+        shm = shared_memory.SharedMemory(name = name)
+        attachedVolumes[name] = (shm, np.ndarray(shape, dtype = np.float32, buffer = shm.buf))
+    return attachedVolumes[name][1]
+
+def renderTile(raycaster, tile):
+    # process pool task: march the rays of one tile (x0, y0, x1, y1), returns (pixel indices, rgb colors)
+    pixelIdx, entryPos = raycaster.generateRays(tile)
+    return pixelIdx, raycaster.shadeRays(pixelIdx, entryPos)
+
+class CPURaycaster:
+    def __init__(self, dataset : VolumeDataset, transFunc : TransFunc,
+                 w : int = 512, h : int = 512, noiseSeed = None):
+
+        self.dataset = dataset
+        self.transFunc = transFunc
+        self.transFuncDataSize = 1024
+        self.transFuncData = self.transFunc.getData(self.transFuncDataSize)
+        self.cubeSize = glm.vec3(1)
+        self.volMin = glm.vec3(0)
+        self.volMax = glm.vec3(1)
+        self.modelMat = glm.mat4(1)
+        self.viewMat = glm.mat4(1)
+        self.projMat = glm.mat4(1)
+        self.w = w
+        self.h = h
+
+        # noise for stochastic jittering, same size and semantics as the noise texture of VolumeRaycaster
+        self.noiseSize = glm.ivec2(32, 32)
+        noiseRng = np.random.default_rng(noiseSeed)
+        self.noise = noiseRng.integers(0, 256, size = [self.noiseSize[0], self.noiseSize[1]], dtype = np.uint8)
+
+        # init viewer params
+        self.viewerPos = glm.vec3(0.6, -1.0, 0)
+        self.lookAtPos = glm.vec3(0)
+        self.viewerUpDir = glm.vec3(0, 0, 1)
+        self.lightPos = glm.vec3(0.2, -0.9, 0)
+
+        self.backColor = glm.vec3(1.0)
+
+        self.interactSensitivity = 5.0
+
+        # ray marching constants of raycaster.frag
+        self.referenceStepSize = 0.001
+        self.samplingRate = 1.0
+        self.terminationAlpha = 0.99
+        self.enableLighting = True
+        self.lightingThreshold = 0.01
+        self.gradientDelta = 0.01
+
+        # number of rays marched together, bounds the size of the temporary arrays
+        self.rayBatchSize = 1 << 16
+
+        # tile-parallel rendering: with workers > 1, tiles of tileSize x tileSize pixels are marched
+        # in a process pool, the workers read the volume from shared memory
+        self.workers = 1
+        self.tileSize = 64
+        self.pool = None
+        self.poolSize = 0
+        self.sharedVolume = None
+        self.sharedVolumeName = None
+
+        self.volume = None
+        self.pixels = None
+        self.loadVolume()
+        self.resize(self.w, self.h)
+
+    def loadVolume(self):
+        '''
+        builds the float32 (sizeZ, sizeY, sizeX) array sampled by the ray marcher,
+        with values as the shader reads them from the 3D texture (normalized to [0, 1])
+        '''
+        scale = self.dataset.textureValueScale()
+
+        self.releaseSharedVolume()
+        ds = self.dataset
+        self.volume = np.empty((ds.sizeZ, ds.sizeY, ds.sizeX), dtype = np.float32)
+        for z0, z1, slab in ds.slabs(max(1, VolumeDataset.streamChunkVoxels // ds.voxelsPerSlice())):
+            self.volume[z0:z1] = slab
+        if scale != 1.0:
+            self.volume *= scale
+        np.clip(self.volume, 0.0, 1.0, out = self.volume)
+        self.volumeFlat = self.volume.reshape(-1)
+        self.volumeShape = self.volume.shape
+
+    def __getstate__(self):
+        # pickled for the worker processes: no dataset, volume, pool or previous frame, the volume is attached by name
+        state = self.__dict__.copy()
+        for key in ('dataset', 'transFunc', 'volume', 'volumeFlat', 'pool', 'sharedVolume', 'pixels'):
+            state[key] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if self.sharedVolumeName is not None:
+            self.volume = attachSharedVolume(self.sharedVolumeName, self.volumeShape)
+            self.volumeFlat = self.volume.reshape(-1)
+
+    def shareVolume(self):
+        # move the volume into shared memory, the process keeps using the shared copy
+        if self.sharedVolume is not None:
+            return
+        self.sharedVolume = shared_memory.SharedMemory(create = True, size = self.volume.nbytes)
+        sharedArray = np.ndarray(self.volume.shape, dtype = np.float32, buffer = self.sharedVolume.buf)
+        sharedArray[:] = self.volume
+        self.volume = sharedArray
+        self.volumeFlat = sharedArray.reshape(-1)
+        self.sharedVolumeName = self.sharedVolume.name
+
+    def releaseSharedVolume(self):
+        self.stopWorkers()
+        if self.sharedVolume is None:
+            return
+        # keep a private copy, views on the shared buffer must be gone before closing it
+        self.volume = np.array(self.volume)
+        self.volumeFlat = self.volume.reshape(-1)
+        self.sharedVolume.close()
+        self.sharedVolume.unlink()
+        self.sharedVolume = None
+        self.sharedVolumeName = None
+
+    def startWorkers(self):
+        if self.pool is not None and self.poolSize == self.workers:
+            return
+        self.stopWorkers()
+        self.shareVolume()
+        self.pool = multiprocessing.Pool(self.workers)
+        self.poolSize = self.workers
+
+    def stopWorkers(self):
+        if self.pool is not None:
+            self.pool.terminate()
+            self.pool.join()
+            self.pool = None
+            self.poolSize = 0
+
+    def close(self):
+        # release the process pool and the shared volume
+        self.releaseSharedVolume()
+
+    def worldToVolume(self, worldCoords):
+        volToCube = zpr.scaleMat(self.cubeSize) * zpr.translateMat(glm.vec3(-0.5))
+        volCoords = glm.inverse(self.modelMat * volToCube) * glm.vec4(worldCoords, 1.0)
+        return volCoords.xyz
+
+    def resize(self, w, h):
+        self.w = w
+        self.h = h
+        self.projMat = glm.perspective(45, w/h, 0.1, 100)
+        self.viewMat = glm.lookAt(self.viewerPos, self.lookAtPos, self.viewerUpDir)
+
+    def interactZoom(self, dy):
+        self.modelMat *= zpr.zoom(dy, self.viewMat * self.modelMat, self.interactSensitivity)
+
+    def interactPan(self, dx, dy):
+        self.modelMat *= zpr.pan(dx, dy, self.viewMat * self.modelMat, self.interactSensitivity)
+
+    def interactRotate(self, dx, dy):
+        self.modelMat *= zpr.rotate(dx, dy, self.viewMat * self.modelMat, self.interactSensitivity)
+
+    def copyView(self, raycaster):
+        # take over the camera / model state of another raycaster (e.g. a VolumeRaycaster)
+        self.modelMat = glm.mat4(raycaster.modelMat)
+        self.viewerPos = glm.vec3(raycaster.viewerPos)
+        self.lookAtPos = glm.vec3(raycaster.lookAtPos)
+        self.viewerUpDir = glm.vec3(raycaster.viewerUpDir)
+        self.lightPos = glm.vec3(raycaster.lightPos)
+        self.resize(self.w, self.h)
+
+    def getRayStepSize(self):
+        # same step as VolumeRaycaster.getRayStepSize, sizes taken from the volume as workers have no dataset
+        voxelSpacing = 1.0 / max(self.volume.shape)
+        return voxelSpacing / max(self.samplingRate, 1e-3)
+
+    def getMaxSteps(self):
+        return math.ceil(math.sqrt(3.0) / self.getRayStepSize()) + 1
+
+    def updateTransFunc(self):
+        self.transFuncData = self.transFunc.getData(self.transFuncDataSize)
+
+    def sampleVolume(self, pos):
+        # trilinear sampling with GL_LINEAR / GL_CLAMP_TO_EDGE semantics, pos is (n, 3) in texture coords
+        sizeZ, sizeY, sizeX = self.volume.shape
+        sizes = np.array([sizeX, sizeY, sizeZ])
+        t = pos * sizes - 0.5
+        i0 = np.floor(t)
+        f = (t - i0).astype(np.float32)
+        i0 = i0.astype(np.int64)
+        i1 = np.clip(i0 + 1, 0, sizes - 1)
+        i0 = np.clip(i0, 0, sizes - 1)
+
+        sx = 1
+        sy = sizeX
+        sz = sizeX * sizeY
+        x0, y0, z0 = i0[:, 0] * sx, i0[:, 1] * sy, i0[:, 2] * sz
+        x1, y1, z1 = i1[:, 0] * sx, i1[:, 1] * sy, i1[:, 2] * sz
+        fx, fy, fz = f[:, 0], f[:, 1], f[:, 2]
+        v = self.volumeFlat
+
+        c00 = v[x0 + y0 + z0] * (1 - fx) + v[x1 + y0 + z0] * fx
+        c10 = v[x0 + y1 + z0] * (1 - fx) + v[x1 + y1 + z0] * fx
+        c01 = v[x0 + y0 + z1] * (1 - fx) + v[x1 + y0 + z1] * fx
+        c11 = v[x0 + y1 + z1] * (1 - fx) + v[x1 + y1 + z1] * fx
+        c0 = c00 * (1 - fy) + c10 * fy
+        c1 = c01 * (1 - fy) + c11 * fy
+        return c0 * (1 - fz) + c1 * fz
+
+    def sampleTransFunc(self, s):
+        # linear lookup in the 1D transfer function texture, returns (n, 4) rgba in [0, 1]
+        table = self.transFuncData.reshape((-1, 4)).astype(np.float32) / 255
+        n = table.shape[0]
+        t = np.asarray(s, dtype = np.float32) * n - 0.5
+        i0 = np.floor(t)
+        f = (t - i0)[:, None]
+        i0 = i0.astype(np.int64)
+        i1 = np.clip(i0 + 1, 0, n - 1)
+        i0 = np.clip(i0, 0, n - 1)
+        return table[i0] * (1 - f) + table[i1] * f
+
+    def gradient(self, pos):
+        delta = self.gradientDelta
+        grad = np.empty_like(pos, dtype = np.float32)
+        for axis in range(3):
+            offset = np.zeros(3, dtype = pos.dtype)
+            offset[axis] = delta
+            grad[:, axis] = self.sampleVolume(pos + offset) - self.sampleVolume(pos - offset)
+        return grad
+
+    def normalize(v):
+        # unlike GLSL, zero vectors stay zero instead of producing undefined values
+        length = np.linalg.norm(v, axis = 1, keepdims = True)
+        return np.divide(v, length, out = np.zeros_like(v), where = length > 0)
+
+    def phongLighting(self, normalVec, lightVec, viewerVec,
+                      ambientColor, diffuseColor, specularColor, specExponent):
+        dist = np.linalg.norm(lightVec, axis = 1)
+        N = CPURaycaster.normalize(normalVec)
+        L = CPURaycaster.normalize(lightVec)
+        C = CPURaycaster.normalize(viewerVec)
+
+        constAttenuation = 0.2
+        linearAttenuation = 0.5
+        attenuation = 1.0 / (constAttenuation + linearAttenuation * dist)
+        nxDir = np.maximum(0.0, np.sum(N * L, axis = 1))
+        diffuse = diffuseColor * (nxDir * attenuation)[:, None]
+
+        halfVec = CPURaycaster.normalize(L + C)
+        nxHalf = np.maximum(0.0, np.sum(N * halfVec, axis = 1))
+        specPower = nxHalf ** specExponent
+        specular = specularColor * (specPower * attenuation)[:, None]
+
+        return ambientColor + diffuse + specular
+
+    def generateRays(self, tile = None):
+        '''
+        entry points of the view rays into the volume, equivalent to rasterizing the proxy cube
+        tile (x0, y0, x1, y1) restricts the rays to a pixel rectangle, the whole image if None
+        returns the indices of the covered pixels and the entry positions in texture coords
+        '''
+        x0, y0, x1, y1 = tile if tile is not None else (0, 0, self.w, self.h)
+        volToCube = zpr.scaleMat(self.cubeSize) * zpr.translateMat(glm.vec3(-0.5))
+        mvp = self.projMat * self.viewMat * self.modelMat * volToCube
+        invMVP = np.array(glm.inverse(mvp), dtype = np.float64)
+
+        # pixel centers (gl_FragCoord) in normalized device coords, rows from bottom to top like glReadPixels
+        px, py = np.meshgrid(np.arange(x0, x1) + 0.5, np.arange(y0, y1) + 0.5)
+        ndcX = (2 * px / self.w - 1).ravel()
+        ndcY = (2 * py / self.h - 1).ravel()
+        ones = np.ones_like(ndcX)
+
+        nearPts = invMVP @ np.stack([ndcX, ndcY, -ones, ones])
+        farPts = invMVP @ np.stack([ndcX, ndcY, ones, ones])
+        nearPts = (nearPts[:3] / nearPts[3]).T
+        farPts = (farPts[:3] / farPts[3]).T
+        dirs = farPts - nearPts
+
+        # slab intersection with the volume box
+        volMin = np.array(self.volMin)
+        volMax = np.array(self.volMax)
+        with np.errstate(divide = 'ignore', invalid = 'ignore'):
+            t0 = (volMin - nearPts) / dirs
+            t1 = (volMax - nearPts) / dirs
+        tNear = np.nanmax(np.minimum(t0, t1), axis = 1)
+        tFar = np.nanmin(np.maximum(t0, t1), axis = 1)
+        # the near plane clips the cube when the viewer is inside the volume
+        tNear = np.maximum(tNear, 0.0)
+        hit = np.nonzero((tNear < tFar) & (tNear <= 1.0))[0]
+        entryPos = nearPts[hit] + tNear[hit, None] * dirs[hit]
+        pixelIdx = (px.ravel()[hit] - 0.5).astype(np.int64) + self.w * (py.ravel()[hit] - 0.5).astype(np.int64)
+        return pixelIdx, entryPos
+
+    def marchRays(self, rayPos, fragCoord):
+        '''
+        front-to-back compositing along all rays at once
+        rayPos: (n, 3) entry points in texture coords, fragCoord: (n, 2) integer pixel coords
+        returns (n, 4) accumulated rgba
+        '''
+        viewerPos = np.array(self.worldToVolume(self.viewerPos), dtype = np.float32)
+        lightPos = np.array(self.worldToVolume(self.lightPos), dtype = np.float32)
+        volMin = np.array(self.volMin, dtype = np.float32)
+        volMax = np.array(self.volMax, dtype = np.float32)
+
+        rayPos = rayPos.astype(np.float32)
+        rayDir = CPURaycaster.normalize(rayPos - viewerPos)
+
+        noiseVals = self.noise[fragCoord[:, 1] % self.noiseSize[1], fragCoord[:, 0] % self.noiseSize[0]]
+        rayStepSize = self.getRayStepSize()
+        rayPos += (noiseVals.astype(np.float32) / 255 * rayStepSize)[:, None] * rayDir
+
+        alphaExp = rayStepSize / self.referenceStepSize
+        rayStep = rayDir * rayStepSize
+        dst = np.zeros((rayPos.shape[0], 4), dtype = np.float32)
+
+        ambient = np.float32(0.1)
+        diffuse = np.float32(0.6)
+        specular = np.float32(0.3)
+        specPower = 64
+
+        # indices of the rays still being marched
+        active = np.arange(rayPos.shape[0])
+        for i in range(self.getMaxSteps()):
+            pos = rayPos[active]
+            dataSample = self.sampleVolume(pos)
+            src = self.sampleTransFunc(dataSample)
+
+            src[:, 3] = 1.0 - (1.0 - src[:, 3]) ** alphaExp # opacity correction
+
+            if self.enableLighting:
+                lit = dataSample > self.lightingThreshold
+                if np.any(lit):
+                    litPos = pos[lit]
+                    N = self.gradient(litPos)
+                    L = litPos - lightPos
+                    V = litPos - viewerPos
+                    src[lit, :3] *= self.phongLighting(N, L, V, ambient, diffuse, specular, specPower)
+
+            d = dst[active]
+            d[:, :3] += ((1.0 - d[:, 3]) * src[:, 3])[:, None] * src[:, :3]
+            d[:, 3] += (1.0 - d[:, 3]) * src[:, 3]
+            dst[active] = d
+
+            pos += rayStep[active]
+            rayPos[active] = pos
+
+            # rays leaving the volume stop, as do rays whose opacity reached terminationAlpha
+            inside = np.all((pos > volMin) & (pos < volMax), axis = 1) & (d[:, 3] < self.terminationAlpha)
+            active = active[inside]
+            if active.size == 0:
+                break
+
+        return dst
+
+    def shadeRays(self, pixelIdx, entryPos):
+        # final rgb colors of the given rays, marched in batches of rayBatchSize
+        backColor = np.array(self.backColor, dtype = np.float32)
+        colors = np.empty((pixelIdx.size, 3), dtype = np.float32)
+        fragCoord = np.stack([pixelIdx % self.w, pixelIdx // self.w], axis = 1)
+
+        for start in range(0, pixelIdx.size, self.rayBatchSize):
+            batch = slice(start, start + self.rayBatchSize)
+            dst = self.marchRays(entryPos[batch], fragCoord[batch])
+            # fragColor = vec4(mix(backColor, dst.rgb, dst.a), 1.0)
+            colors[batch] = backColor + (dst[:, :3] - backColor) * dst[:, 3:]
+        return colors
+
+    def tiles(self):
+        ts = max(int(self.tileSize), 1)
+        return [(x0, y0, min(x0 + ts, self.w), min(y0 + ts, self.h)) 
+                for y0 in range(0, self.h, ts) for x0 in range(0, self.w, ts)]
+
+    def render(self):
+        image = np.empty((self.w * self.h, 3), dtype = np.float32)
+        image[:] = np.array(self.backColor, dtype = np.float32)
+
+        if self.workers > 1:
+            self.startWorkers()
+            for pixelIdx, colors in self.pool.starmap(renderTile, [(self, tile) for tile in self.tiles()]):
+                image[pixelIdx] = colors
+        else:
+            pixelIdx, entryPos = self.generateRays()
+            image[pixelIdx] = self.shadeRays(pixelIdx, entryPos)
+
+        rgba = np.empty((self.w * self.h, 4), dtype = np.uint8)
+        rgba[:, :3] = np.round(np.clip(image, 0.0, 1.0) * 255)
+        rgba[:, 3] = 255
+        self.pixels = rgba.reshape(-1)
+
+    def getPixels(self):
+        '''
+        rendered pixels in the layout of VolumeRenderer.getPixels:
+        w*h RGBA uint8 values, rows from bottom to top
+        '''
+        return self.pixels
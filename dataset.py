@@ -1,29 +1,65 @@
 import os
+import glob
+import json
+import math
+import time
+import threading
+from collections import deque
 import numpy as np
+from chunkedvolume import ChunkedVolume, writeChunkedVolume
 
 # for now, assume volume scaling is (1, 1, 1)
 
 class VolumeDataset:
+    # number of voxels processed at once by streaming passes over the data
+    streamChunkVoxels = 1 << 24
+
     def __init__(self, dataFile, 
                  sizeX, sizeY, sizeZ, 
                  bytesPerVoxel, 
                  bigEndian = True, 
                  normalizeToFloat = False, 
-                 headerSkip = 0):
+                 headerSkip = 0,
+                 memoryMapped = False):
         
         # purpose of headerSkip: if a volume data file has a header, 
         # we can skip the first headerSkip bytes when reading voxel data
         
+        # memoryMapped: voxelData is a read-only np.memmap of the file instead of an in-memory copy,
+        # normalization to float is then deferred and applied per slab when the data is read with getSlab / slabs
+
+        # chunked volume files (see chunkedvolume.py) carry sizes and voxel type in their header, 
+        # the size / type arguments are ignored for them (use VolumeDataset.openChunked)
+        # with memoryMapped, bricks are decompressed slab by slab when read instead of all at load time
+
+        self.dataFile = dataFile
+        self.headerSkip = headerSkip
         self.sizeX = sizeX
         self.sizeY = sizeY
         self.sizeZ = sizeZ
         noVoxels = self.sizeX * self.sizeY * self.sizeZ
         self.dataType = None
+        self.rawDataType = None
+        self.memoryMapped = memoryMapped
+        self.normalizeToFloat = normalizeToFloat
+        # divisor applied by getSlab when normalization is deferred, 1 if the data is used as is
+        self.normalizeDivisor = 1
+        self.minValue = None
+        self.maxValue = None
+        self.chunkedVolume = None
+        # mip pyramid, levels[0] is this dataset (see buildPyramid)
+        self.levels = [self]
+        # value statistics of the raw voxel data (see computeStatistics)
+        self.statistics = None
         
         if not os.path.exists(dataFile):
             print(f'Error: file not found: {dataFile}')
             return
 
+        if ChunkedVolume.isChunkedFile(dataFile):
+            self.loadChunked()
+            return
+
         fileSize = os.path.getsize(dataFile)
 
         dataSize = noVoxels * bytesPerVoxel + headerSkip;
@@ -39,17 +75,553 @@ class VolumeDataset:
         if bytesPerVoxel == 2: self.dataType = f'{endianChar}u2' # unsigned short
         if bytesPerVoxel == 4: self.dataType = f'{endianChar}f' # probably 32 bit float
 
-        self.voxelData = np.fromfile(dataFile, dtype = self.dataType, offset = headerSkip)
+        self.rawDataType = self.dataType
+
+        if memoryMapped:
+            self.voxelData = np.memmap(dataFile, dtype = self.dataType, mode = 'r',
+                                       offset = headerSkip, shape = (noVoxels,))
+        else:
+            self.voxelData = np.fromfile(dataFile, dtype = self.dataType, offset = headerSkip)
 
         #self.voxelData[self.voxelData > 1.e+10] = 0.001
         #self.voxelData.tofile('datasets/QVAPORf28_1.bin')
         
         if normalizeToFloat:
-            maxVoxel = np.max(self.voxelData)
-            self.voxelData = self.voxelData.astype(np.float32)/maxVoxel
+            # the maximum comes from the statistics sidecar when it is up to date, without a pass over the data
+            maxVoxel = self.computeStatistics()['max']
+            if memoryMapped:
+                # slabs are normalized as they are read
+                self.normalizeDivisor = maxVoxel
+            else:
+                self.voxelData = self.voxelData.astype(np.float32)/maxVoxel
             self.dataType = f'{endianChar}f' # 32 bit float
             
+    def openChunked(dataFile, normalizeToFloat = False, memoryMapped = False):
+        return VolumeDataset(dataFile, 0, 0, 0, 0, normalizeToFloat = normalizeToFloat, memoryMapped = memoryMapped)
+
+    def loadChunked(self):
+        volume = ChunkedVolume(self.dataFile)
+        if volume.header is None:
+            return
+        self.chunkedVolume = volume
+        self.sizeZ, self.sizeY, self.sizeX = volume.shape
+        self.rawDataType = volume.dtype.str
+        # slabs come out of the container in native byte order, type names as for raw files
+        endianChar = '<' if np.little_endian else '>'
+        dataTypes = {'u1' : 'B', 'u2' : f'{endianChar}u2', 'f4' : f'{endianChar}f'}
+        self.dataType = dataTypes.get(volume.dtype.str[1:], volume.dtype.newbyteorder('=').str)
+        self.minValue, self.maxValue = volume.valueRange()
+
+        if self.memoryMapped:
+            # streamed: getSlab decompresses the bricks it needs
+            self.voxelData = None
+            if self.normalizeToFloat:
+                self.normalizeDivisor = self.maxValue
+        else:
+            self.voxelData = volume.readAll().reshape(-1)
+            if self.normalizeToFloat:
+                self.voxelData = self.voxelData.astype(np.float32) / self.maxValue
+        if self.normalizeToFloat:
+            self.dataType = f'{endianChar}f'
 
+    def voxelsPerSlice(self):
+        return self.sizeX * self.sizeY
+
+    def computeValueRange(self):
+        # min / max of the voxel data in a streaming pass over chunks of at most streamChunkVoxels
+        if self.chunkedVolume is not None:
+            # stored in the header
+            self.minValue, self.maxValue = self.chunkedVolume.valueRange()
+            return self.minValue, self.maxValue
+        if self.statistics is not None and not (self.normalizeToFloat and not self.memoryMapped):
+            # raw value range, unless voxelData has been normalized in memory
+            self.minValue, self.maxValue = self.statistics['min'], self.statistics['max']
+            return self.minValue, self.maxValue
+        chunkSize = max(self.streamChunkVoxels, 1)
+        minVal = None
+        maxVal = None
+        for start in range(0, self.voxelData.size, chunkSize):
+            chunk = self.voxelData[start : start + chunkSize]
+            chunkMin = chunk.min()
+            chunkMax = chunk.max()
+            minVal = chunkMin if minVal is None else min(minVal, chunkMin)
+            maxVal = chunkMax if maxVal is None else max(maxVal, chunkMax)
+        self.minValue = minVal
+        self.maxValue = maxVal
+        return minVal, maxVal
         
+    def statisticsFile(self):
+        # sidecar file of computeStatistics, next to the data file
+        return f'{self.dataFile}.stats.json'
+
+    def rawSlabs(self):
+        # the voxel data as stored in the file (not normalized), in slabs of about streamChunkVoxels voxels
+        slabDepth = max(1, self.streamChunkVoxels // max(self.voxelsPerSlice(), 1))
+        if self.chunkedVolume is not None:
+            for z0 in range(0, self.sizeZ, slabDepth):
+                yield self.chunkedVolume.readSlab(z0, min(z0 + slabDepth, self.sizeZ)).reshape(-1)
+            return
+        raw = np.memmap(self.dataFile, dtype = self.rawDataType, mode = 'r', offset = self.headerSkip, 
+                        shape = (self.sizeX * self.sizeY * self.sizeZ,))
+        chunkSize = slabDepth * self.voxelsPerSlice()
+        for start in range(0, raw.size, chunkSize):
+            yield raw[start : start + chunkSize]
+
+    def computeStatistics(self, bins = 256, percentiles = (1, 5, 25, 50, 75, 95, 99), useCache = True):
+        '''
+        min, max, mean, a histogram over [min, max] with linear bins, one over the positive values with 
+        logarithmic bins, and percentiles of the raw voxel values
+        integer data is counted exactly with one bincount pass over the slabs, float data takes a value range pass 
+        and a pass into fineBins bins (percentiles are then accurate to (max - min) / fineBins)
+        the result is stored in a sidecar file (statisticsFile) keyed by file size, mtime and the load / statistics 
+        parameters, later loads of the same file read it from there
+        '''
+        fineBins = 1 << 16
+        key = {'fileSize' : os.path.getsize(self.dataFile),
+               'mtime' : os.path.getmtime(self.dataFile),
+               'rawDataType' : self.rawDataType,
+               'headerSkip' : self.headerSkip,
+               'bins' : bins,
+               'percentiles' : list(percentiles)}
+
+        if self.statistics is not None and self.statistics['key'] == key:
+            return self.statistics
+        statsFile = self.statisticsFile()
+        if useCache and os.path.exists(statsFile):
+            try:
+                with open(statsFile) as f:
+                    cached = json.load(f)
+                if cached['key'] == key:
+                    self.statistics = VolumeDataset.statisticsFromJson(cached)
+                    return self.statistics
+            except (ValueError, KeyError):
+                print(f'Warning: ignoring unreadable statistics file {statsFile}')
+
+        rawType = np.dtype(self.rawDataType)
+        count = self.sizeX * self.sizeY * self.sizeZ
+        if rawType.kind in 'ui' and rawType.itemsize <= 2:
+            # every value has its own bin
+            values = np.arange(1 << (8 * rawType.itemsize), dtype = np.float64)
+            counts = np.zeros(values.size, dtype = np.int64)
+            for chunk in self.rawSlabs():
+                counts += np.bincount(chunk.astype(np.intp), minlength = values.size)
+            nonEmpty = np.flatnonzero(counts)
+            minValue = values[nonEmpty[0]]
+            maxValue = values[nonEmpty[-1]]
+            mean = float(np.dot(counts, values)) / count
+        else:
+            minValue = None
+            maxValue = None
+            total = 0.0
+            for chunk in self.rawSlabs():
+                chunkMin = chunk.min()
+                chunkMax = chunk.max()
+                minValue = chunkMin if minValue is None else min(minValue, chunkMin)
+                maxValue = chunkMax if maxValue is None else max(maxValue, chunkMax)
+                total += float(chunk.sum(dtype = np.float64))
+            minValue = float(minValue)
+            maxValue = float(maxValue)
+            mean = total / count
+            counts = np.zeros(fineBins, dtype = np.int64)
+            for chunk in self.rawSlabs():
+                counts += np.histogram(chunk, bins = fineBins, range = (minValue, maxValue))[0]
+            edges = np.linspace(minValue, maxValue, fineBins + 1)
+            values = 0.5 * (edges[:-1] + edges[1:])
+
+        # the histograms and percentiles follow from the per-value (or fine bin) counts
+        linearCounts, linearEdges = np.histogram(values, bins = bins, range = (minValue, maxValue), weights = counts)
+        # logarithmic bins start at the smallest positive value present
+        present = (values > 0) & (counts > 0)
+        if np.any(present):
+            logEdges = np.geomspace(values[present][0], maxValue, bins + 1)
+            logCounts = np.histogram(values[present], bins = logEdges, weights = counts[present])[0]
+        else:
+            logEdges = np.zeros(bins + 1)
+            logCounts = np.zeros(bins)
+        cumulative = np.cumsum(counts)
+        ranks = np.ceil(np.array(percentiles, dtype = np.float64) / 100 * count).clip(1, count)
+        percentileValues = values[np.searchsorted(cumulative, ranks)]
+
+        stats = {'key' : key,
+                 'count' : count,
+                 'min' : minValue if rawType.kind == 'f' else int(minValue),
+                 'max' : maxValue if rawType.kind == 'f' else int(maxValue),
+                 'mean' : mean,
+                 'histogram' : {'counts' : linearCounts.astype(np.int64).tolist(), 'edges' : linearEdges.tolist()},
+                 'logHistogram' : {'counts' : logCounts.astype(np.int64).tolist(), 'edges' : logEdges.tolist()},
+                 'percentiles' : {str(p) : float(v) for p, v in zip(percentiles, percentileValues)}}
+        if useCache:
+            try:
+                with open(statsFile, 'w') as f:
+                    json.dump(stats, f)
+            except OSError as err:
+                print(f'Warning: could not write statistics file {statsFile}: {err}')
+        self.statistics = VolumeDataset.statisticsFromJson(stats)
+        return self.statistics
+
+    def statisticsFromJson(stats):
+        # histogram counts / edges as arrays
+        for hist in ('histogram', 'logHistogram'):
+            stats[hist] = {'counts' : np.array(stats[hist]['counts'], dtype = np.int64), 
+                           'edges' : np.array(stats[hist]['edges'], dtype = np.float64)}
+        return stats
+
+    def textureHistogram(self):
+        '''
+        (counts, edges) of the linear histogram with the edges mapped to the values the shader reads, 
+        i.e. to the transfer function domain
+        '''
+        stats = self.computeStatistics()
+        hist = stats['histogram']
+        if self.normalizeToFloat:
+            scale = 1.0 / stats['max']
+        elif np.dtype(self.rawDataType).kind in 'ui':
+            scale = 1.0 / np.iinfo(np.dtype(self.rawDataType)).max
+        else:
+            scale = 1.0
+        return hist['counts'], hist['edges'] * scale
+
+    def textureValueScale(self):
+        # factor mapping slab values to the values the shader reads (integer textures are normalized)
+        dataType = np.dtype(self.dataType)
+        if dataType.kind in 'ui':
+            return 1.0 / np.iinfo(dataType).max
+        return 1.0
+
+    def computeBrickMinMax(self, brickSize, volume = None):
+        '''
+        per-brick min / max of the texture values, for bricks of brickSize^3 voxels
+        each brick is extended by one voxel on every side to cover the footprint of trilinear sampling
+        returns two float32 arrays of shape (bricksZ, bricksY, bricksX)
+        the volume is read one row of bricks at a time with getSlab, so memory-mapped volumes are streamed
+        volume: a (sizeZ, sizeY, sizeX) array with the same type as getSlab's slabs to use instead of the dataset's data
+        '''
+        getSlab = self.getSlab if volume is None else (lambda z0, z1: volume[z0:z1])
+        brickMin, brickMax = self.emptyBrickMinMax(brickSize)
+        for z0 in range(0, self.sizeZ, brickSize):
+            z1 = min(z0 + brickSize, self.sizeZ)
+            self.accumulateBrickMinMax(brickSize, z0, getSlab(z0, z1), brickMin, brickMax)
+        return brickMin, brickMax
+
+    def emptyBrickMinMax(self, brickSize):
+        # (brickMin, brickMax) for accumulateBrickMinMax, +inf / -inf until slabs are merged in
+        shape = tuple(math.ceil(n / brickSize) for n in (self.sizeZ, self.sizeY, self.sizeX))
+        return np.full(shape, np.inf, dtype = np.float32), np.full(shape, -np.inf, dtype = np.float32)
+
+    def accumulateBrickMinMax(self, brickSize, z0, slab, brickMin, brickMax):
+        '''
+        merges the slices [z0, z0 + len(slab)) into the per-brick ranges brickMin / brickMax (see emptyBrickMinMax),
+        so the ranges can be gathered from any sequence of slabs covering the volume, e.g. while it is uploaded
+        a slice also counts for the neighbouring brick rows whose extended range contains it
+        '''
+        B = brickSize
+        bricksZ, bricksY, bricksX = brickMin.shape
+        z1 = z0 + slab.shape[0]
+        padding = ((0, bricksY * B - self.sizeY), (0, bricksX * B - self.sizeX))
+        scale = np.float32(self.textureValueScale())
+
+        def filter3(a, op):
+            # combine each voxel with its x and y neighbours
+            for axis in (0, 1):
+                b = a.copy()
+                lo = [slice(None)] * 2
+                hi = [slice(None)] * 2
+                lo[axis] = slice(None, -1)
+                hi[axis] = slice(1, None)
+                op(b[tuple(hi)], a[tuple(lo)], out = b[tuple(hi)])
+                op(b[tuple(lo)], a[tuple(hi)], out = b[tuple(lo)])
+                a = b
+            return a
+
+        # brick row bz covers the slices [bz * B - 1, (bz + 1) * B + 1)
+        for bz in range(max((z0 - 1) // B, 0), min(z1 // B, bricksZ - 1) + 1):
+            s0 = max(bz * B - 1, z0)
+            s1 = min((bz + 1) * B + 1, z1)
+            if s0 >= s1:
+                continue
+            part = slab[s0 - z0 : s1 - z0]
+            sliceMin = np.pad(filter3(part.min(axis = 0).astype(np.float32), np.minimum), padding, mode = 'edge')
+            sliceMax = np.pad(filter3(part.max(axis = 0).astype(np.float32), np.maximum), padding, mode = 'edge')
+            np.minimum(brickMin[bz], sliceMin.reshape((bricksY, B, bricksX, B)).min(axis = (1, 3)) * scale, out = brickMin[bz])
+            np.maximum(brickMax[bz], sliceMax.reshape((bricksY, B, bricksX, B)).max(axis = (1, 3)) * scale, out = brickMax[bz])
+
+    def gradientSlabs(self, slabDepth):
+        '''
+        generator over the central-difference gradients of the volume, in slabs of slabDepth slices
+        yields (z0, z1, gradient) with gradient a (z1-z0, sizeY, sizeX, 3) float32 array of (d/dx, d/dy, d/dz)
+        per unit of texture coordinates, one-sided differences at the volume border
+        each slab is read with one slice of overlap, so memory-mapped volumes are streamed
+        '''
+        slabDepth = max(int(slabDepth), 1)
+        spacing = (1.0 / self.sizeZ, 1.0 / self.sizeY, 1.0 / self.sizeX)
+        for z0 in range(0, self.sizeZ, slabDepth):
+            z1 = min(z0 + slabDepth, self.sizeZ)
+            haloZ0 = max(z0 - 1, 0)
+            haloZ1 = min(z1 + 1, self.sizeZ)
+            slab = self.getSlab(haloZ0, haloZ1).astype(np.float32)
+            gradient = np.empty((z1 - z0, self.sizeY, self.sizeX, 3), dtype = np.float32)
+            for axis in range(3):
+                if slab.shape[axis] < 2:
+                    gradient[..., 2 - axis] = 0
+                    continue
+                # channel order x, y, z while the slab axes are z, y, x
+                gradient[..., 2 - axis] = np.gradient(slab, spacing[axis], axis = axis)[z0 - haloZ0 : z1 - haloZ0]
+            yield z0, z1, gradient
+
+    def reduceSlab(slab, reduction = 'mean'):
+        # halves each dimension of a (d, h, w) slab by 2x2x2 block mean or max, odd sizes repeat the last voxel
+        padding = [(0, n % 2) for n in slab.shape]
+        if any(p[1] for p in padding):
+            slab = np.pad(slab, padding, mode = 'edge')
+        d, h, w = slab.shape
+        blocks = slab.reshape((d // 2, 2, h // 2, 2, w // 2, 2))
+        if reduction == 'max':
+            return blocks.max(axis = (1, 3, 5))
+        reduced = blocks.mean(axis = (1, 3, 5), dtype = np.float32)
+        if slab.dtype.kind in 'ui':
+            reduced = np.rint(reduced).astype(slab.dtype)
+        return reduced
+
+    def pyramidFile(self, level, reduction):
+        # the texel type (and normalization) of the levels is part of the name, loads with other settings do not share them
+        texelType = np.dtype(self.dataType).str[1:] + ('n' if self.normalizeToFloat else '')
+        return f'{os.path.splitext(self.dataFile)[0]}.{reduction}{level}.{texelType}.cvol'
+
+    def writeReducedLevel(self, fileName, reduction = 'mean'):
+        # the next coarser level of this dataset, computed in a streaming pass over even-depth slabs
+        slabDepth = 2 * max(1, min(self.streamChunkVoxels // self.voxelsPerSlice(), self.sizeZ) // 2)
+        reduced = None
+        for z0, z1, slab in self.slabs(slabDepth):
+            reducedSlab = VolumeDataset.reduceSlab(slab, reduction)
+            if reduced is None:
+                reduced = np.empty(((self.sizeZ + 1) // 2,) + reducedSlab.shape[1:], dtype = reducedSlab.dtype)
+            reduced[z0 // 2 : z0 // 2 + reducedSlab.shape[0]] = reducedSlab
+        return writeChunkedVolume(fileName, reduced)
+
+    def buildPyramid(self, minSize = 32, reduction = 'mean', useCache = True):
+        '''
+        builds (or loads) the mip pyramid of the dataset: each level halves every dimension of the previous one
+        (by 2x2x2 block mean or max), down to minSize voxels on the longest axis
+        levels are stored next to the data file as chunked volume files holding the texture values 
+        (normalized if the dataset is), they are reused while newer than the data file
+        '''
+        self.levels = [self]
+        parent = self
+        level = 1
+        while max(parent.sizeX, parent.sizeY, parent.sizeZ) > minSize:
+            levelFile = self.pyramidFile(level, reduction)
+            upToDate = (useCache and os.path.exists(levelFile) and 
+                        os.path.getmtime(levelFile) >= os.path.getmtime(self.dataFile))
+            if not upToDate and not parent.writeReducedLevel(levelFile, reduction):
+                break
+            parent = VolumeDataset.openChunked(levelFile, memoryMapped = self.memoryMapped)
+            self.levels.append(parent)
+            level += 1
+        return self.levels
+
+    def getSlab(self, z0, z1):
+        '''
+        returns slices [z0, z1) as a contiguous (z1-z0, sizeY, sizeX) array in native byte order,
+        normalized to float if normalization was deferred
+        only this slab is held in memory, which keeps memory-mapped volumes out of RAM
+        '''
+        sliceSize = self.voxelsPerSlice()
+        if self.voxelData is None:
+            raw = self.chunkedVolume.readSlab(z0, z1).reshape(-1)
+        else:
+            raw = self.voxelData[z0 * sliceSize : z1 * sliceSize]
+        if self.normalizeToFloat and self.memoryMapped:
+            slab = raw.astype(np.float32) / np.float32(self.normalizeDivisor)
+        else:
+            slab = np.ascontiguousarray(raw, dtype = raw.dtype.newbyteorder('='))
+        return slab.reshape((z1 - z0, self.sizeY, self.sizeX))
+
+    def slabs(self, slabDepth):
+        # generator over the volume in slabs of slabDepth slices, yields (z0, z1, slab)
+        slabDepth = max(int(slabDepth), 1)
+        for z0 in range(0, self.sizeZ, slabDepth):
+            z1 = min(z0 + slabDepth, self.sizeZ)
+            yield z0, z1, self.getSlab(z0, z1)
+
+class TimeSeriesDataset:
+    '''
+    time-varying volume, one data file per timestep (all with the same size and voxel type)
+    a loader thread reads and normalizes the timesteps after the displayed one into a ring buffer of 
+    prefetchCount preallocated volumes, nextFrame() hands out the next timestep without waiting for the disk
+    normalization uses the maximum of the first timestep for all timesteps, so values are comparable over time
+    '''
+    def __init__(self, dataFiles, 
+                 sizeX, sizeY, sizeZ, 
+                 bytesPerVoxel, 
+                 bigEndian = True, 
+                 normalizeToFloat = False, 
+                 headerSkip = 0,
+                 prefetchCount = 4,
+                 loop = True):
+        self.dataFiles = list(dataFiles)
+        self.datasetArgs = (sizeX, sizeY, sizeZ, bytesPerVoxel, bigEndian)
+        self.headerSkip = headerSkip
+        self.normalizeToFloat = normalizeToFloat
+        self.prefetchCount = max(1, prefetchCount)
+        self.loop = loop
+
+        # the first timestep, the renderer is set up with this dataset
+        self.dataset = VolumeDataset(self.dataFiles[0], sizeX, sizeY, sizeZ, bytesPerVoxel, 
+                                     bigEndian, normalizeToFloat, headerSkip)
+        self.normalizeDivisor = None
+        if normalizeToFloat:
+            self.normalizeDivisor = self.dataset.computeStatistics()['max']
+
+        # brick size of the per-timestep brick min / max (for empty-space skipping), None to skip it
+        self.brickSize = None
+
+        # ring buffer: one more slot than prefetched timesteps, for the frame being displayed
+        frameType = np.float32 if normalizeToFloat else self.dataset.getSlab(0, 1).dtype
+        shape = (self.dataset.sizeZ, self.dataset.sizeY, self.dataset.sizeX)
+        self.slots = [np.empty(shape, dtype = frameType) for _ in range(self.prefetchCount + 1)]
+        self.freeSlots = deque(range(len(self.slots)))
+        # (timestep, slot, brick ranges) ready for display, in playback order
+        self.ready = deque()
+        self.displayedSlot = None
+        self.condition = threading.Condition()
+        self.nextLoad = 0
+        # incremented by seek, loads started before are discarded
+        self.generation = 0
+        self.loaderThread = None
+        self.stopping = False
+
+        # playback statistics, currentTimestep stays None until the first frame is shown
+        self.currentTimestep = None
+        # frames shown since the last start
+        self.framesShown = 0
+        self.framesDropped = 0
+        self.firstFrameTime = None
+        self.lastFrameTime = None
+        self.frameTimes = deque(maxlen = 120)
+        self.loadTimes = deque(maxlen = 120)
+
+    def __len__(self):
+        return len(self.dataFiles)
+
+    def fromPattern(pattern, *datasetArgs, **kwargs):
+        # timesteps from the files matching a glob pattern, in sorted order
+        return TimeSeriesDataset(sorted(glob.glob(pattern)), *datasetArgs, **kwargs)
+
+    def loadTimestep(self, t, out):
+        # reads timestep t into out, normalized like the first timestep
+        sizeX, sizeY, sizeZ, bytesPerVoxel, bigEndian = self.datasetArgs
+        ds = VolumeDataset(self.dataFiles[t], sizeX, sizeY, sizeZ, bytesPerVoxel, bigEndian, False, self.headerSkip, True)
+        for z0, z1, slab in ds.slabs(max(1, self.dataset.streamChunkVoxels // ds.voxelsPerSlice())):
+            if self.normalizeDivisor is not None:
+                np.divide(slab, np.float32(self.normalizeDivisor), out = out[z0:z1], casting = 'unsafe')
+            else:
+                out[z0:z1] = slab
+        if self.brickSize is None:
+            return None
+        return self.dataset.computeBrickMinMax(self.brickSize, out)
+
+    def followingTimestep(self, t):
+        if t + 1 < len(self):
+            return t + 1
+        return 0 if self.loop else None
+
+    def loaderLoop(self):
+        while True:
+            with self.condition:
+                while not self.stopping and (self.nextLoad is None or not self.freeSlots or 
+                                             len(self.ready) >= self.prefetchCount):
+                    self.condition.wait()
+                if self.stopping:
+                    return
+                t = self.nextLoad
+                slot = self.freeSlots.popleft()
+                generation = self.generation
+
+            start = time.perf_counter()
+            brickRanges = self.loadTimestep(t, self.slots[slot])
+            loadTime = time.perf_counter() - start
+
+            with self.condition:
+                self.loadTimes.append(loadTime)
+                if generation == self.generation:
+                    self.ready.append((t, slot, brickRanges))
+                    self.nextLoad = self.followingTimestep(t)
+                else:
+                    self.freeSlots.append(slot)
+                self.condition.notify_all()
+
+    def start(self, t = 0):
+        # playback statistics restart with every start
+        self.framesShown = 0
+        self.framesDropped = 0
+        self.firstFrameTime = None
+        self.lastFrameTime = None
+        self.frameTimes.clear()
+        if self.loaderThread is None:
+            self.stopping = False
+            self.loaderThread = threading.Thread(target = self.loaderLoop, name = 'TimeSeriesLoader', daemon = True)
+            self.loaderThread.start()
+        self.seek(t)
+
+    def stop(self):
+        if self.loaderThread is None:
+            return
+        with self.condition:
+            self.stopping = True
+            self.condition.notify_all()
+        self.loaderThread.join()
+        self.loaderThread = None
+
+    def seek(self, t):
+        # drops the prefetched timesteps, loading restarts at t
+        with self.condition:
+            self.generation += 1
+            while self.ready:
+                self.freeSlots.append(self.ready.popleft()[1])
+            self.nextLoad = t
+            self.condition.notify_all()
+
+    def nextFrame(self, timeout = 0):
+        '''
+        the next timestep as (t, volume, brickRanges), waiting at most timeout seconds for it
+        returns None (a dropped frame) if it is not loaded yet; volume is a ring buffer slot, valid until the next call
+        '''
+        with self.condition:
+            if not self.ready and timeout:
+                self.condition.wait_for(lambda: self.ready, timeout)
+            if not self.ready:
+                self.framesDropped += 1
+                return None
+            t, slot, brickRanges = self.ready.popleft()
+            if self.displayedSlot is not None:
+                self.freeSlots.append(self.displayedSlot)
+            self.displayedSlot = slot
+            self.condition.notify_all()
+
+        now = time.perf_counter()
+        if self.firstFrameTime is None:
+            self.firstFrameTime = now
+        elif self.lastFrameTime is not None:
+            self.frameTimes.append(now - self.lastFrameTime)
+        self.lastFrameTime = now
+        self.currentTimestep = t
+        self.framesShown += 1
+        return t, self.slots[slot], brickRanges
 
+    def playbackStats(self):
+        # sustained fps over the whole playback, fps over the recent frames, dropped frames and loader timings
+        elapsed = (self.lastFrameTime - self.firstFrameTime) if self.firstFrameTime is not None else 0.0
+        recent = sum(self.frameTimes)
+        return {'framesShown' : self.framesShown,
+                'framesDropped' : self.framesDropped,
+                'fps' : (self.framesShown - 1) / elapsed if elapsed > 0 else 0.0,
+                'recentFps' : len(self.frameTimes) / recent if recent > 0 else 0.0,
+                'meanLoadTime' : sum(self.loadTimes) / len(self.loadTimes) if self.loadTimes else 0.0,
+                'maxLoadTime' : max(self.loadTimes) if self.loadTimes else 0.0}
 
+    def playbackReport(self):
+        stats = self.playbackStats()
+        shown = '-' if self.currentTimestep is None else self.currentTimestep + 1
+        return (f'timestep {shown}/{len(self)}: {stats["fps"]:.1f} fps sustained '
+                f'({stats["recentFps"]:.1f} recent), {stats["framesDropped"]} dropped, '
+                f'load {1000*stats["meanLoadTime"]:.1f} ms (max {1000*stats["maxLoadTime"]:.1f})')
@@ -0,0 +1,154 @@
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+
+# image-based fitness metrics of rendered candidates, computed for a whole batch at once
+# images are the (N, h, w, 4) uint8 output of VolumeRenderer.renderBatch (or one (h, w, 4) image from getPixels),
+# the metrics are numpy operations over the batch axis; scoreBatch runs them on chunks of images
+# whose float temporaries are preallocated and bounded in size
+
+# Rec. 709 luma weights, for rgb values in [0, 255]
+lumaWeights = np.array([0.2126, 0.7152, 0.0722], dtype = np.float32) / 255
+
+def asBatch(images):
+    # (h, w, 4) -> (1, h, w, 4)
+    images = np.asarray(images)
+    return images[None] if images.ndim == 3 else images
+
+def luminance(images, out = None, work = None):
+    # (N, h, w) float32 luminance in [0, 1] of the rgb channels, work is an optional buffer of the same shape
+    images = asBatch(images)
+    if out is None:
+        out = np.empty(images.shape[:3], dtype = np.float32)
+    if work is None:
+        work = np.empty_like(out)
+    np.multiply(images[..., 0], lumaWeights[0], out = out)
+    for c in (1, 2):
+        np.multiply(images[..., c], lumaWeights[c], out = work)
+        out += work
+    return out
+
+def gradientMagnitude(lum, out = None, work = None):
+    '''
+    (N, h, w) magnitude of the luminance gradient, central differences inside the image, one-sided at the border
+    (as np.gradient); out and work are optional float32 buffers of the same shape, lum is not modified
+    '''
+    if out is None:
+        out = np.empty_like(lum)
+    if work is None:
+        work = np.empty_like(lum)
+    gx = out
+    gy = work
+    np.subtract(lum[:, :, 2:], lum[:, :, :-2], out = gx[:, :, 1:-1])
+    gx[:, :, 1:-1] *= 0.5
+    np.subtract(lum[:, :, 1], lum[:, :, 0], out = gx[:, :, 0])
+    np.subtract(lum[:, :, -1], lum[:, :, -2], out = gx[:, :, -1])
+    np.subtract(lum[:, 2:], lum[:, :-2], out = gy[:, 1:-1])
+    gy[:, 1:-1] *= 0.5
+    np.subtract(lum[:, 1], lum[:, 0], out = gy[:, 0])
+    np.subtract(lum[:, -1], lum[:, -2], out = gy[:, -1])
+    return np.hypot(gx, gy, out = out)
+
+def gradientHistograms(gradMag, bins = 64, maxMagnitude = 1.0, work = None, binIdx = None):
+    '''
+    (N, bins) histograms of the gradient magnitudes over [0, maxMagnitude] (larger values go to the last bin),
+    normalized to fractions of the pixel count
+    all images are counted by one bincount, image i using bins [i * bins, (i + 1) * bins)
+    work (float32) and binIdx (intp) are optional buffers shaped like gradMag
+    '''
+    noImages = gradMag.shape[0]
+    if work is None:
+        work = np.empty_like(gradMag)
+    if binIdx is None:
+        binIdx = np.empty(gradMag.shape, dtype = np.intp)
+    np.multiply(gradMag, bins / maxMagnitude, out = work)
+    np.minimum(work, bins - 1, out = work)
+    np.copyto(binIdx, work, casting = 'unsafe')
+    binIdx += (np.arange(noImages, dtype = np.intp) * bins)[:, None, None]
+    counts = np.bincount(binIdx.reshape(-1), minlength = noImages * bins).reshape((noImages, bins))
+    return counts.astype(np.float32) / (gradMag.shape[1] * gradMag.shape[2])
+
+def chi2(histograms, reference = None):
+    '''
+    chi-squared distance of each histogram to a reference histogram ((bins,) or (N, bins)),
+    a uniform histogram by default, i.e. how far the gradient distribution is from being flat
+    '''
+    if reference is None:
+        reference = np.full(histograms.shape[-1], 1.0 / histograms.shape[-1], dtype = np.float32)
+    expected = np.maximum(reference, 1e-12)
+    return np.sum((histograms - reference) ** 2 / expected, axis = -1)
+
+def entropy(histograms):
+    # Shannon entropy (bits) of each histogram, empty bins contribute 0
+    p = histograms / np.maximum(histograms.sum(axis = -1, keepdims = True), 1e-12)
+    logP = np.log2(np.where(p > 0, p, 1))
+    return -np.sum(p * logP, axis = -1)
+
+def edgeDensity(gradMag, threshold = 0.05):
+    # fraction of the pixels of each image whose gradient magnitude exceeds threshold
+    return np.count_nonzero(gradMag > threshold, axis = (1, 2)) / (gradMag.shape[1] * gradMag.shape[2])
+
+def gradientMapImages(gradMag, maxMagnitude = 1.0, out = None, work = None):
+    # (N, h, w) uint8 gradient maps for display (e.g. GradMapViewer)
+    if out is None:
+        out = np.empty(gradMag.shape, dtype = np.uint8)
+    if work is None:
+        work = np.empty_like(gradMag)
+    np.multiply(gradMag, 255 / maxMagnitude, out = work)
+    np.minimum(work, 255, out = work)
+    np.copyto(out, work, casting = 'unsafe')
+    return out
+
+def scoreBatch(images, bins = 64, maxMagnitude = 1.0, edgeThreshold = 0.05, reference = None, chunkPixels = 1 << 16):
+    '''
+    all metrics of a batch of images, as a dict of arrays with the images along the first axis:
+    'gradientMaps' (N, h, w) uint8, 'histograms' (N, bins), 'chi2', 'entropy' and 'edgeDensity' (N,)
+    each stage runs on as many images at once as fit into chunkPixels pixels (64 images of 32x32, one of 256x256),
+    so the float32 temporaries (about 20 bytes per pixel) stay cache-sized and are reused instead of growing with the batch
+    '''
+    images = asBatch(images)
+    noImages, h, w = images.shape[:3]
+    gradientMaps = np.empty((noImages, h, w), dtype = np.uint8)
+    histograms = np.empty((noImages, bins), dtype = np.float32)
+    density = np.empty(noImages)
+
+    chunkSize = max(1, min(chunkPixels // (h * w), noImages))
+    lum = np.empty((chunkSize, h, w), dtype = np.float32)
+    gradMag = np.empty_like(lum)
+    work = np.empty_like(lum)
+    binIdx = np.empty(lum.shape, dtype = np.intp)
+    for i0 in range(0, noImages, chunkSize):
+        i1 = min(i0 + chunkSize, noImages)
+        n = i1 - i0
+        luminance(images[i0:i1], lum[:n], work[:n])
+        gradientMagnitude(lum[:n], gradMag[:n], work[:n])
+        histograms[i0:i1] = gradientHistograms(gradMag[:n], bins, maxMagnitude, work[:n], binIdx[:n])
+        density[i0:i1] = edgeDensity(gradMag[:n], edgeThreshold)
+        gradientMapImages(gradMag[:n], maxMagnitude, gradientMaps[i0:i1], work[:n])
+
+    return {'gradientMaps' : gradientMaps,
+            'histograms' : histograms,
+            'chi2' : chi2(histograms, reference),
+            'entropy' : entropy(histograms),
+            'edgeDensity' : density}
+
+class FitnessEvaluator:
+    '''
+    scores batches with scoreBatch, submit() scores in a background thread and returns a Future, 
+    so scoring one batch overlaps rendering the next (the numpy operations release the GIL)
+    '''
+    def __init__(self, **scoreArgs):
+        self.scoreArgs = scoreArgs
+        self.worker = None
+
+    def evaluate(self, images):
+        return scoreBatch(images, **self.scoreArgs)
+
+    def submit(self, images):
+        if self.worker is None:
+            self.worker = ThreadPoolExecutor(1)
+        return self.worker.submit(self.evaluate, images)
+
+    def close(self):
+        if self.worker is not None:
+            self.worker.shutdown()
+            self.worker = None
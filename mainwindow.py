@@ -14,6 +14,7 @@ class VEMainWindow(QMainWindow):
         self.transFunc = TransFunc()
         self.renderer = VolumeRaycaster(self.dataset, self.transFunc)
         self.transFuncWidget = TransFuncWidget(self.renderer.transFunc)
+        self.transFuncWidget.setHistogram(*self.dataset.textureHistogram())
         self.renderWidget = VolumeRenderWidget(self.renderer)
         self.setWindowTitle('VolEvol Renderer')
         self.setCentralWidget(self.renderWidget)
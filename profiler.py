@@ -0,0 +1,146 @@
+import time
+from collections import deque
+import numpy as np
+import OpenGL.GL as gl
+
+class StageStats:
+    '''
+    rolling statistics of one stage, over its last windowSize timings (in seconds)
+    '''
+    def __init__(self, windowSize = 120):
+        self.samples = deque(maxlen = windowSize)
+        self.count = 0
+
+    def add(self, seconds):
+        self.samples.append(seconds)
+        self.count += 1
+
+    def last(self):
+        return self.samples[-1] if self.samples else 0.0
+
+    def mean(self):
+        return sum(self.samples) / len(self.samples) if self.samples else 0.0
+
+    def min(self):
+        return min(self.samples) if self.samples else 0.0
+
+    def max(self):
+        return max(self.samples) if self.samples else 0.0
+
+    def percentile(self, p):
+        return float(np.percentile(self.samples, p)) if self.samples else 0.0
+
+    def summary(self):
+        # milliseconds, for display / logging
+        return {'last' : 1000 * self.last(),
+                'mean' : 1000 * self.mean(),
+                'min' : 1000 * self.min(),
+                'max' : 1000 * self.max(),
+                'p95' : 1000 * self.percentile(95),
+                'count' : self.count}
+
+class ProfileSpan:
+    # times the enclosed block on the CPU and, for gpu spans, on the GPU with a GL_TIME_ELAPSED query
+    def __init__(self, profiler, stage, gpu):
+        self.profiler = profiler
+        self.stage = stage
+        self.gpu = gpu
+        self.query = None
+        self.start = 0.0
+
+    def __enter__(self):
+        if self.gpu:
+            self.query = self.profiler.beginQuery()
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, excType, excValue, traceback):
+        self.profiler.addSample(f'cpu/{self.stage}', time.perf_counter() - self.start)
+        if self.query is not None:
+            self.profiler.endQuery(self.stage, self.query)
+        return False
+
+class NullSpan:
+    # what span() returns while profiling is disabled
+    def __enter__(self):
+        return self
+
+    def __exit__(self, excType, excValue, traceback):
+        return False
+
+nullSpan = NullSpan()
+
+class FrameProfiler:
+    '''
+    per-stage timings of a renderer: 'cpu/<stage>' from perf_counter spans, 'gpu/<stage>' from GL_TIME_ELAPSED queries
+    query results are collected asynchronously by collect(), which only reads queries whose result is
+    available, so measuring never stalls the pipeline
+    time-elapsed queries cannot be nested, a gpu span inside another gpu span is timed on the CPU only
+    disabled (the default), span() returns a shared no-op object and nothing is measured
+    '''
+    def __init__(self, windowSize = 120):
+        self.enabled = False
+        self.windowSize = windowSize
+        self.stats = {}
+        # unused query objects, and (stage, query) in the order the queries were issued
+        self.freeQueries = []
+        self.pendingQueries = deque()
+        # more pending queries than this are dropped instead of growing the pool (e.g. collect() never called)
+        self.maxPendingQueries = 64
+        self.gpuSpanActive = False
+
+    def span(self, stage, gpu = False):
+        if not self.enabled:
+            return nullSpan
+        return ProfileSpan(self, stage, gpu and not self.gpuSpanActive)
+
+    def addSample(self, name, seconds):
+        stats = self.stats.get(name)
+        if stats is None:
+            stats = self.stats[name] = StageStats(self.windowSize)
+        stats.add(seconds)
+
+    def beginQuery(self):
+        if len(self.pendingQueries) >= self.maxPendingQueries:
+            return None
+        query = self.freeQueries.pop() if self.freeQueries else gl.glGenQueries(1)
+        gl.glBeginQuery(gl.GL_TIME_ELAPSED, query)
+        self.gpuSpanActive = True
+        return query
+
+    def endQuery(self, stage, query):
+        gl.glEndQuery(gl.GL_TIME_ELAPSED)
+        self.gpuSpanActive = False
+        self.pendingQueries.append((stage, query))
+
+    def collect(self):
+        # read the finished queries, requires the renderer's opengl context to be current
+        while self.pendingQueries:
+            stage, query = self.pendingQueries[0]
+            if not gl.glGetQueryObjectiv(query, gl.GL_QUERY_RESULT_AVAILABLE):
+                # queries finish in order, the later ones are not available either
+                break
+            self.pendingQueries.popleft()
+            elapsedNs = gl.glGetQueryObjectui64v(query, gl.GL_QUERY_RESULT)
+            self.addSample(f'gpu/{stage}', int(elapsedNs) * 1e-9)
+            self.freeQueries.append(query)
+
+    def reset(self):
+        self.stats = {}
+
+    def summary(self):
+        # {name : {'last', 'mean', 'min', 'max', 'p95' in ms, 'count'}} for all stages seen so far
+        return {name : stats.summary() for name, stats in sorted(self.stats.items())}
+
+    def report(self):
+        # one line per stage, as shown by the overlay of VolumeRenderWidget
+        return '\n'.join(f'{name:<24} {s["mean"]:7.2f} ms  (p95 {s["p95"]:.2f})'
+                         for name, s in self.summary().items())
+
+    def release(self):
+        # delete the query objects, requires the renderer's opengl context to be current
+        queries = self.freeQueries + [query for _, query in self.pendingQueries]
+        if queries:
+            gl.glDeleteQueries(len(queries), queries)
+        self.freeQueries = []
+        self.pendingQueries.clear()
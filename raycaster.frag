@@ -6,7 +6,18 @@ out vec4 fragColor;
 
 uniform sampler3D dataTex;
 uniform sampler1D transFuncTex;
+uniform sampler1DArray transFuncArrayTex;
+uniform bool useTransFuncArray;
+uniform int transFuncLayer;
 uniform sampler2D noiseTex;
+uniform sampler2D preintegratedTex;
+uniform bool usePreintegration;
+uniform sampler3D gradientTex;
+uniform bool usePrecomputedGradients;
+uniform sampler3D occupancyTex;
+uniform bool useEmptySpaceSkipping;
+uniform ivec3 brickCount;
+uniform vec3 volumeToBrick;
 uniform ivec2 noiseSize;
 uniform vec3 viewerPos;
 uniform vec3 lightPos;
@@ -14,6 +25,17 @@ uniform vec3 volMin;
 uniform vec3 volMax;
 uniform vec3 backColor;
 uniform ivec2 viewportSize;
+uniform float rayStepSize;
+uniform int maxSteps;
+uniform float terminationAlpha;
+
+vec4 transFunc(float dataSample)
+{
+	// batch rendering reads the lookup table of the current candidate from a layer of the array
+	if (useTransFuncArray)
+		return texture(transFuncArrayTex, vec2(dataSample, float(transFuncLayer)));
+	return texture(transFuncTex, dataSample);
+}
 
 void composit(inout vec4 dst, in vec4 src)
 {
@@ -29,6 +51,10 @@ float jitter(float jitterScale)
 
 vec3 gradient(vec3 position)
 {
+	// normalized gradients stored as unsigned normalized values
+	if (usePrecomputedGradients)
+		return texture(gradientTex, position).rgb * 2.0 - 1.0;
+
 	vec3 sample1, sample2;
 	float delta = 0.01;
 	sample1.x = texture(dataTex, position - vec3(delta, 0.0, 0.0)).r;
@@ -62,6 +88,21 @@ vec3 phongLighting(vec3 normalVec, vec3 lightVec, vec3 viewerVec,
 	return ambientColor + diffuseColor + specularColor;
 }
 
+bool brickEmpty(vec3 position)
+{
+	ivec3 brick = clamp(ivec3(floor(position * volumeToBrick)), ivec3(0), brickCount - 1);
+	return texelFetch(occupancyTex, brick, 0).r == 0.0;
+}
+
+float stepsToBrickExit(vec3 position, vec3 dir, float stepSize)
+{
+	// whole ray steps needed to leave the current brick, so samples stay on the same positions as without skipping
+	vec3 boundary = (floor(position * volumeToBrick) + step(0.0, dir)) / volumeToBrick;
+	vec3 t = mix(vec3(1.0e9), (boundary - position) / dir, notEqual(dir, vec3(0.0)));
+	float tExit = min(t.x, min(t.y, t.z));
+	return max(1.0, ceil(tExit / stepSize));
+}
+
 bool insideVolume(vec3 position, vec3 volMin, vec3 volMax)
 {
 	vec3 temp1 = sign(position - volMin);
@@ -76,23 +117,42 @@ void main()
 	vec3 rayPos = texCoord;
 	vec3 rayDir = normalize(rayPos - viewerPos);
 
-	float jitterScale = 0.003;
-	rayPos += jitter(jitterScale) * rayDir;	
+	// jitter the start by up to one step
+	rayPos += jitter(rayStepSize) * rayDir;	
 
+	// opacity correction relative to a fixed reference step, so the image does not depend on the step size
 	float referenceStepSize = 0.001; 
-	float rayStepSize = 0.003;
 	float alphaExp = rayStepSize / referenceStepSize;
 	vec3 rayStep = rayDir * rayStepSize;
 	vec4 dst = vec4(0.0);
 	bool enableLighting = true;
 
-	for(int i = 0; i < 1024; i++)
+	for(int i = 0; i < maxSteps; i++)
 	{
+		if (useEmptySpaceSkipping && brickEmpty(rayPos))
+		{
+			rayPos += rayStep * stepsToBrickExit(rayPos, rayDir, rayStepSize);
+			if (!insideVolume(rayPos, volMin, volMax)) 
+				break;
+			continue;
+		}
+
 		float dataSample = texture(dataTex, rayPos).r;
 
-		vec4 src = texture(transFuncTex, dataSample);
+		vec4 src;
+		if (usePreintegration && !useTransFuncArray)
+		{
+			// segment from this sample to the next, the table holds premultiplied colors for the current step
+			float backSample = texture(dataTex, rayPos + rayStep).r;
+			src = texture(preintegratedTex, vec2(dataSample, backSample));
+			src.rgb /= max(src.a, 1.0e-6);
+		}
+		else
+		{
+			src = transFunc(dataSample);
 		
-		src.a = 1.0 - pow((1.0 - src.a), alphaExp); //opacity correction
+			src.a = 1.0 - pow((1.0 - src.a), alphaExp); //opacity correction
+		}
 
 		if (enableLighting && dataSample > 0.01)
 		{
@@ -109,6 +169,10 @@ void main()
 		
 		composit(dst, src);
 
+		// early ray termination, the remaining samples are (almost) fully occluded
+		if (dst.a >= terminationAlpha)
+			break;
+
 		rayPos += rayStep;
 
 		if (!insideVolume(rayPos, volMin, volMax)) 
@@ -1,4 +1,5 @@
 import numpy as np
+import math
 import ctypes
 import OpenGL.GL as gl
 import OpenGL.GLU as glu
@@ -6,7 +7,8 @@ import glm
 import zpr
 from dataset import VolumeDataset
 from shader import GLSLShader
-from transfunc import TransFunc
+from profiler import FrameProfiler
+from transfunc import TransFunc, PreintegratedTable
 
 class VolumeRaycaster:
     def __init__(self, dataset : VolumeDataset, transFunc : TransFunc):
@@ -14,9 +16,28 @@ class VolumeRaycaster:
         self.dataset = dataset
         self.transFunc = transFunc
         self.dataTex = 0
+        # dataset texture upload: slices per slab (0 = automatic), optional pixel unpack buffers,
+        # progress callback called as callback(slicesUploaded, totalSlices)
+        self.uploadSlabDepth = 0
+        self.usePixelUnpackBuffers = False
+        self.uploadProgressCallback = None
+        # if True, initialize only allocates the dataset texture and the owner drives the upload
+        # by calling uploadDatasetSlabs, e.g. between frames
+        self.incrementalDatasetUpload = False
+        self.datasetUpload = None
+        # second dataset texture for time series playback, swapped with dataTex by uploadVolumeFrame
+        self.backDataTex = 0
         self.transFuncDataSize = 1024
-        self.transFuncData = self.transFunc.getData(self.transFuncDataSize)
+        # own copy of the lookup table, updateTransFunc resamples it in place where the control points changed
+        self.transFuncData = self.transFunc.getData(self.transFuncDataSize).copy()
+        # control points / interpolation the lookup table was sampled from
+        self.transFuncCPs = self.transFunc.controlPointsToArray()
+        self.transFuncInterpolation = self.transFunc.interpolationFunc
         self.transFuncTex = 0
+        self.transFuncArrayTex = 0 # lookup tables of a batch of transfer functions, one per layer
+        self.transFuncArraySize = None
+        self.useTransFuncArray = False
+        self.transFuncLayer = 0
         self.alphaTransFuncTex = 0
         self.cubeVBO = 0
         self.cubeVAO = 0
@@ -27,6 +48,65 @@ class VolumeRaycaster:
         self.viewMat = glm.mat4(1)
         self.projMat = glm.mat4(1)
 
+        # sampling quality: samplingRate samples per voxel along the ray, rays stop once their opacity
+        # reaches terminationAlpha (1.0 disables early termination)
+        # one sample per voxel by default, 2-5 for final-quality renders of thin features (cost grows linearly)
+        self.samplingRate = 1.0
+        self.terminationAlpha = 0.99
+
+        # pre-integrated classification: segments between consecutive samples are looked up in a 2D table 
+        # built for the current step size, which allows lower sampling rates at the same quality
+        self.usePreintegration = False
+        self.preintegratedTable = PreintegratedTable(256)
+        self.preintegratedTex = 0
+        self.preintegratedTableStale = True
+
+        # empty-space skipping: the volume is split into bricks of brickSize^3 voxels, the bricks 
+        # the current transfer function maps to zero opacity are marked empty in occupancyTex
+        self.enableEmptySpaceSkipping = True
+        self.brickSize = 8
+        self.brickMin = None
+        self.brickMax = None
+        self.occupancyTex = 0
+        # (brickMin, brickMax) gathered from the slabs of the running dataset upload, see setupOccupancyTexture
+        self.brickRangeUpload = None
+        self.occupancyAwaitsUpload = False
+
+        # precomputed gradients: None computes gradients on the fly in the shader (six extra fetches per lit sample),
+        # 'RGB8' or 'RGB10_A2' stores the normalized gradients in a 3D texture read with a single fetch
+        # with level of detail, each resident pyramid level has its own gradient texture (levelGradientTextures),
+        # gradientTex is the one of the active level
+        self.gradientFormat = None
+        self.gradientTex = 0
+        self.levelGradientTextures = {}
+        self.gradientFormats = {'RGB8' : (gl.GL_RGB8, gl.GL_RGB, gl.GL_UNSIGNED_BYTE, 3),
+                                'RGB10_A2' : (gl.GL_RGB10_A2, gl.GL_RGBA, gl.GL_UNSIGNED_INT_2_10_10_10_REV, 4)}
+
+        # level of detail: with enableLevelOfDetail the dataset's mip pyramid is built at initialize, and each frame
+        # renders the finest level that fits textureMemoryBudget (bytes, None asks the driver), has at most 
+        # lodVoxelsPerPixel voxels across per viewport pixel and, while interacting, is interactionLevelBias levels coarser
+        self.enableLevelOfDetail = False
+        self.pyramidMinSize = 32
+        self.pyramidReduction = 'mean'
+        self.textureMemoryBudget = None
+        self.lodVoxelsPerPixel = 1.0
+        self.interactionLevelBias = 1
+        self.interacting = False
+        self.activeLevel = 0
+        # resident 3D textures by pyramid level, level 0 is dataTex
+        self.levelTextures = {}
+        self.viewportW = 0
+        self.viewportH = 0
+
+        # per-stage cpu / gpu timings, disabled by default (set profiler.enabled = True)
+        self.profiler = FrameProfiler()
+
+        # reduced-resolution render target of renderReduced, upscaled into the current framebuffer
+        self.reducedFBO = 0
+        self.reducedRenderTex = 0
+        self.reducedDepthTex = 0
+        self.reducedSize = (0, 0)
+
         # noise for stochastic jittering
         self.noiseSize = glm.ivec2(32, 32)
         self.noiseTex = 0 
@@ -51,34 +131,166 @@ class VolumeRaycaster:
         
         self.shader = GLSLShader('raycaster', 'raycaster.vert', 'raycaster.frag')
 
+        # texture bindings made through bindTexture / bindTextureUnit, (unit, target) -> texture, 
+        # so setupShader can skip rebinding textures that did not change
+        self.cacheTextureBindings = True
+        self.textureBindings = {}
+        self.activeTextureUnit = 0
+
     def rebuildShader(self):
         self.shader.build()
 
     
-    def setupDatasetTexture(self):
-        gl.glDeleteTextures(1, self.dataTex)
-        self.dataTex = gl.glGenTextures(1)
-        gl.glBindTexture(gl.GL_TEXTURE_3D, self.dataTex)
-
+    def createVolumeTexture(self, dataset):
+        # allocate only, contents are uploaded slab by slab by datasetUploadSteps
+        tex = gl.glGenTextures(1)
+        self.bindTexture(gl.GL_TEXTURE_3D, tex)
         gl.glTexImage3D(gl.GL_TEXTURE_3D, 0, gl.GL_RED, 
-                        self.dataset.sizeX, self.dataset.sizeY, self.dataset.sizeZ, 
-                        0, gl.GL_RED, self.texelType[self.dataset.dataType], 
-                        self.dataset.voxelData)
+                        dataset.sizeX, dataset.sizeY, dataset.sizeZ, 
+                        0, gl.GL_RED, self.texelType[dataset.dataType], None)
 
         gl.glTexParameteri(gl.GL_TEXTURE_3D, gl.GL_TEXTURE_WRAP_S, gl.GL_CLAMP_TO_EDGE)
         gl.glTexParameteri(gl.GL_TEXTURE_3D, gl.GL_TEXTURE_WRAP_T, gl.GL_CLAMP_TO_EDGE)
         gl.glTexParameteri(gl.GL_TEXTURE_3D, gl.GL_TEXTURE_WRAP_R, gl.GL_CLAMP_TO_EDGE)
         gl.glTexParameteri(gl.GL_TEXTURE_3D, gl.GL_TEXTURE_MIN_FILTER, gl.GL_LINEAR)
         gl.glTexParameteri(gl.GL_TEXTURE_3D, gl.GL_TEXTURE_MAG_FILTER, gl.GL_LINEAR)
+        return tex
+
+    def setupDatasetTexture(self):
+        self.deleteTexture(self.dataTex)
+        self.dataTex = self.createVolumeTexture(self.dataset)
+        self.levelTextures[0] = self.dataTex
+
+        # the brick ranges for empty-space skipping are gathered from the same slabs, not by a pass of their own
+        self.brickRangeUpload = self.dataset.emptyBrickMinMax(self.brickSize)
+        self.datasetUpload = self.datasetUploadSteps(brickRanges = self.brickRangeUpload)
+        if not self.incrementalDatasetUpload:
+            self.uploadDatasetSlabs()
+
+    def getUploadSlabDepth(self, dataset = None):
+        # number of slices per upload slab, uploadSlabDepth = 0 picks it from VolumeDataset.streamChunkVoxels
+        dataset = dataset or self.dataset
+        if self.uploadSlabDepth > 0:
+            return min(self.uploadSlabDepth, dataset.sizeZ)
+        return max(1, min(VolumeDataset.streamChunkVoxels // dataset.voxelsPerSlice(), dataset.sizeZ))
+
+    def datasetUploadSteps(self, dataset = None, tex = None, brickRanges = None):
+        '''
+        generator uploading the dataset (default: self.dataset into dataTex) into its already allocated 
+        3D texture, one slab per step
+        slabs are read from the dataset generator, so a memory-mapped dataset is never fully 
+        loaded / normalized in host memory
+        brickRanges: optional (brickMin, brickMax) from VolumeDataset.emptyBrickMinMax, each slab is merged into them
+        '''
+        dataset = dataset or self.dataset
+        tex = tex or self.dataTex
+        texelType = self.texelType[dataset.dataType]
+        pbos = None
+        if self.usePixelUnpackBuffers:
+            # two buffers used alternately, so filling one can overlap the transfer from the other
+            pbos = gl.glGenBuffers(2)
+
+        for slabIdx, (z0, z1, slab) in enumerate(dataset.slabs(self.getUploadSlabDepth(dataset))):
+            self.bindTexture(gl.GL_TEXTURE_3D, tex)
+            gl.glPixelStorei(gl.GL_UNPACK_ALIGNMENT, 1)
+            if pbos is None:
+                gl.glTexSubImage3D(gl.GL_TEXTURE_3D, 0, 0, 0, z0, 
+                                   dataset.sizeX, dataset.sizeY, z1 - z0, 
+                                   gl.GL_RED, texelType, slab)
+            else:
+                gl.glBindBuffer(gl.GL_PIXEL_UNPACK_BUFFER, pbos[slabIdx % 2])
+                gl.glBufferData(gl.GL_PIXEL_UNPACK_BUFFER, slab.nbytes, None, gl.GL_STREAM_DRAW)
+                bufPtr = gl.glMapBufferRange(gl.GL_PIXEL_UNPACK_BUFFER, 0, slab.nbytes, 
+                                             gl.GL_MAP_WRITE_BIT | gl.GL_MAP_INVALIDATE_BUFFER_BIT)
+                ctypes.memmove(bufPtr, slab.ctypes.data, slab.nbytes)
+                gl.glUnmapBuffer(gl.GL_PIXEL_UNPACK_BUFFER)
+                gl.glTexSubImage3D(gl.GL_TEXTURE_3D, 0, 0, 0, z0, 
+                                   dataset.sizeX, dataset.sizeY, z1 - z0, 
+                                   gl.GL_RED, texelType, ctypes.c_void_p(0))
+                gl.glBindBuffer(gl.GL_PIXEL_UNPACK_BUFFER, 0)
+
+            if brickRanges is not None:
+                dataset.accumulateBrickMinMax(self.brickSize, z0, slab, *brickRanges)
+            if self.uploadProgressCallback is not None:
+                self.uploadProgressCallback(z1, dataset.sizeZ)
+            yield z1
+
+        if pbos is not None:
+            gl.glDeleteBuffers(2, pbos)
+
+    def uploadDatasetSlabs(self, maxSlabs = None):
+        '''
+        advance the pending dataset upload by at most maxSlabs slabs (all remaining slabs if None)
+        returns True while part of the dataset still has to be uploaded
+        requires the renderer's opengl context to be current
+        '''
+        if self.datasetUpload is None:
+            return False
+        with self.profiler.span('datasetUpload', gpu = True):
+            slabCount = 0
+            while maxSlabs is None or slabCount < maxSlabs:
+                if next(self.datasetUpload, None) is None:
+                    self.datasetUpload = None
+                    if self.occupancyAwaitsUpload:
+                        self.setupOccupancyTexture()
+                    return False
+                slabCount += 1
+            return True
+
+    def datasetUploadPending(self):
+        return self.datasetUpload is not None
+
+    def uploadVolumeFrame(self, volume, brickRanges = None):
+        '''
+        replaces the dataset texture with one timestep of a time series, a (sizeZ, sizeY, sizeX) array 
+        of the dataset's voxel type (see TimeSeriesDataset.nextFrame)
+        the frame is uploaded into a second texture which is then swapped with dataTex, so the upload never 
+        overwrites the texture the previous frame's draw may still be reading (which would stall the upload)
+        brickRanges: the frame's (brickMin, brickMax) for empty-space skipping, computed here if not given
+        requires the renderer's opengl context to be current
+        '''
+        if self.enableLevelOfDetail or self.gradientTex != 0:
+            # pyramid levels and precomputed gradients belong to the first timestep
+            print('Warning: level of detail and precomputed gradients are disabled for time series playback')
+            self.enableLevelOfDetail = False
+            for level in [l for l in self.levelTextures if l != 0]:
+                self.deleteTexture(self.levelTextures.pop(level))
+            self.activeLevel = 0
+            self.gradientFormat = None
+            self.deleteGradientTextures()
+
+        with self.profiler.span('timestepUpload', gpu = True):
+            if self.backDataTex == 0:
+                self.backDataTex = self.createVolumeTexture(self.dataset)
+            self.bindTexture(gl.GL_TEXTURE_3D, self.backDataTex)
+            gl.glPixelStorei(gl.GL_UNPACK_ALIGNMENT, 1)
+            gl.glTexSubImage3D(gl.GL_TEXTURE_3D, 0, 0, 0, 0, 
+                               self.dataset.sizeX, self.dataset.sizeY, self.dataset.sizeZ, 
+                               gl.GL_RED, self.texelType[self.dataset.dataType], volume)
+            self.dataTex, self.backDataTex = self.backDataTex, self.dataTex
+            self.levelTextures[0] = self.dataTex
+            self.datasetUpload = None
+            self.brickRangeUpload = None
+
+        if self.occupancyTex != 0 or self.occupancyAwaitsUpload:
+            if brickRanges is None:
+                brickRanges = self.dataset.computeBrickMinMax(self.brickSize, volume)
+            self.brickMin, self.brickMax = brickRanges
+            if self.occupancyTex == 0:
+                # the frame replaced the dataset whose upload skipping was waiting for
+                self.occupancyAwaitsUpload = False
+                self.createOccupancyTexture()
+            else:
+                self.updateOccupancy()
 
     def setupNoiseTexture(self):
         noise2D = np.random.randint(0, 256, 
                                     size = [self.noiseSize[0], self.noiseSize[1]], 
                                     dtype = np.uint8)
 
-        gl.glDeleteTextures(1, self.noiseTex)
+        self.deleteTexture(self.noiseTex)
         self.noiseTex = gl.glGenTextures(1)
-        gl.glBindTexture(gl.GL_TEXTURE_2D, self.noiseTex)
+        self.bindTexture(gl.GL_TEXTURE_2D, self.noiseTex)
         
         gl.glTexImage2D(gl.GL_TEXTURE_2D, 0, gl.GL_RED, 
                         self.noiseSize[0], self.noiseSize[1], 
@@ -134,9 +346,9 @@ class VolumeRaycaster:
         return volCoords.xyz
 
     def setupTransFuncTexture(self):
-        gl.glDeleteTextures(1, self.transFuncTex)
+        self.deleteTexture(self.transFuncTex)
         self.transFuncTex = gl.glGenTextures(1)
-        gl.glBindTexture(gl.GL_TEXTURE_1D, self.transFuncTex)
+        self.bindTexture(gl.GL_TEXTURE_1D, self.transFuncTex)
 
         gl.glTexImage1D(gl.GL_TEXTURE_1D, 0, gl.GL_RGBA, self.transFuncDataSize, 
                         0, gl.GL_RGBA, gl.GL_UNSIGNED_BYTE, self.transFuncData)
@@ -145,21 +357,316 @@ class VolumeRaycaster:
         gl.glTexParameteri(gl.GL_TEXTURE_1D, gl.GL_TEXTURE_MIN_FILTER, gl.GL_LINEAR)
         gl.glTexParameteri(gl.GL_TEXTURE_1D, gl.GL_TEXTURE_MAG_FILTER, gl.GL_LINEAR)
     
+    def updatePreintegratedTexture(self):
+        # (re)computes the changed parts of the pre-integrated table and uploads only those
+        if self.preintegratedTex == 0:
+            n = self.preintegratedTable.n
+            self.preintegratedTex = gl.glGenTextures(1)
+            self.bindTexture(gl.GL_TEXTURE_2D, self.preintegratedTex)
+            gl.glTexImage2D(gl.GL_TEXTURE_2D, 0, gl.GL_RGBA32F, n, n, 0, gl.GL_RGBA, gl.GL_FLOAT, None)
+            gl.glTexParameteri(gl.GL_TEXTURE_2D, gl.GL_TEXTURE_WRAP_S, gl.GL_CLAMP_TO_EDGE)
+            gl.glTexParameteri(gl.GL_TEXTURE_2D, gl.GL_TEXTURE_WRAP_T, gl.GL_CLAMP_TO_EDGE)
+            gl.glTexParameteri(gl.GL_TEXTURE_2D, gl.GL_TEXTURE_MIN_FILTER, gl.GL_LINEAR)
+            gl.glTexParameteri(gl.GL_TEXTURE_2D, gl.GL_TEXTURE_MAG_FILTER, gl.GL_LINEAR)
+            # the new texture has no contents yet
+            self.preintegratedTable.samples = None
+
+        self.preintegratedTable.setStepSize(self.getRayStepSize())
+        dirty = self.preintegratedTable.update(self.transFunc)
+        self.bindTexture(gl.GL_TEXTURE_2D, self.preintegratedTex)
+        gl.glPixelStorei(gl.GL_UNPACK_ALIGNMENT, 4)
+        for row0, row1, col0, col1 in dirty:
+            block = np.ascontiguousarray(self.preintegratedTable.table[row0:row1, col0:col1])
+            gl.glTexSubImage2D(gl.GL_TEXTURE_2D, 0, col0, row0, col1 - col0, row1 - row0, 
+                               gl.GL_RGBA, gl.GL_FLOAT, block)
+        self.preintegratedTableStale = False
+
+    def packGradients(gradient, gradientFormat):
+        '''
+        normalized gradients mapped from [-1, 1] to the unsigned normalized texel format
+        RGB8: (..., 3) uint8, RGB10_A2: (...) uint32 with r in the low bits (GL_UNSIGNED_INT_2_10_10_10_REV)
+        '''
+        length = np.sqrt(np.sum(gradient * gradient, axis = -1, keepdims = True))
+        normal = np.divide(gradient, length, out = np.zeros_like(gradient), where = length > 0)
+        unorm = normal * 0.5 + 0.5
+        if gradientFormat == 'RGB8':
+            return np.rint(unorm * 255).astype(np.uint8)
+        q = np.rint(unorm * 1023).astype(np.uint32)
+        return q[..., 0] | (q[..., 1] << 10) | (q[..., 2] << 20) | np.uint32(3 << 30)
+
+    def createGradientTexture(self, level):
+        # gradient texture of a pyramid level, 0 without (valid) gradient format
+        if self.gradientFormat is None:
+            return 0
+        if self.gradientFormat not in self.gradientFormats:
+            print(f'Warning: unknown gradient format {self.gradientFormat}, gradients are computed on the fly')
+            return 0
+
+        dataset = self.getLevelDataset(level)
+        internalFormat, texelFormat, texelType, _ = self.gradientFormats[self.gradientFormat]
+        tex = gl.glGenTextures(1)
+        self.bindTexture(gl.GL_TEXTURE_3D, tex)
+        gl.glTexImage3D(gl.GL_TEXTURE_3D, 0, internalFormat, 
+                        dataset.sizeX, dataset.sizeY, dataset.sizeZ, 
+                        0, texelFormat, texelType, None)
+        gl.glTexParameteri(gl.GL_TEXTURE_3D, gl.GL_TEXTURE_WRAP_S, gl.GL_CLAMP_TO_EDGE)
+        gl.glTexParameteri(gl.GL_TEXTURE_3D, gl.GL_TEXTURE_WRAP_T, gl.GL_CLAMP_TO_EDGE)
+        gl.glTexParameteri(gl.GL_TEXTURE_3D, gl.GL_TEXTURE_WRAP_R, gl.GL_CLAMP_TO_EDGE)
+        gl.glTexParameteri(gl.GL_TEXTURE_3D, gl.GL_TEXTURE_MIN_FILTER, gl.GL_LINEAR)
+        gl.glTexParameteri(gl.GL_TEXTURE_3D, gl.GL_TEXTURE_MAG_FILTER, gl.GL_LINEAR)
+
+        # computed and uploaded slab by slab, the full float gradient volume is never held in memory
+        gl.glPixelStorei(gl.GL_UNPACK_ALIGNMENT, 1)
+        for z0, z1, gradient in dataset.gradientSlabs(self.getUploadSlabDepth(dataset)):
+            packed = VolumeRaycaster.packGradients(gradient, self.gradientFormat)
+            gl.glTexSubImage3D(gl.GL_TEXTURE_3D, 0, 0, 0, z0, 
+                               dataset.sizeX, dataset.sizeY, z1 - z0, 
+                               texelFormat, texelType, packed)
+        return tex
+
+    def deleteGradientTextures(self):
+        for tex in self.levelGradientTextures.values():
+            if tex != 0:
+                self.deleteTexture(tex)
+        self.levelGradientTextures = {}
+        self.gradientTex = 0
+
+    def setupGradientTexture(self):
+        # (re)builds the gradients of the active level for the current gradientFormat, other levels follow on activation
+        self.deleteGradientTextures()
+        self.gradientTex = self.levelGradientTextures[self.activeLevel] = self.createGradientTexture(self.activeLevel)
+
+    def gradientTextureBytes(self, level = None):
+        # texture memory of the precomputed gradients of a level, the active one by default (0 when computed on the fly)
+        if self.gradientFormat not in self.gradientFormats:
+            return 0
+        ds = self.getLevelDataset(level)
+        bytesPerTexel = self.gradientFormats[self.gradientFormat][3]
+        return ds.sizeX * ds.sizeY * ds.sizeZ * bytesPerTexel
+
+    def getLevelDataset(self, level = None):
+        # dataset of a pyramid level, the active one by default
+        level = self.activeLevel if level is None else level
+        return self.dataset.levels[level]
+
+    def levelTextureBytes(self, level):
+        # data texture plus precomputed gradients of a level
+        ds = self.getLevelDataset(level)
+        return ds.sizeX * ds.sizeY * ds.sizeZ * np.dtype(ds.dataType).itemsize + self.gradientTextureBytes(level)
+
+    def queryTextureMemory(self):
+        # dedicated video memory in bytes (NVX_gpu_memory_info), None if the driver does not report it
+        try:
+            dedicatedKB = gl.glGetIntegerv(0x9047) # GL_GPU_MEMORY_INFO_DEDICATED_VIDMEM_NVX
+        except Exception:
+            return None
+        return int(dedicatedKB) * 1024
+
+    def selectLevel(self):
+        # finest pyramid level within the memory budget and the viewport resolution, coarser while interacting
+        lastLevel = len(self.dataset.levels) - 1
+        level = 0
+        while level < lastLevel:
+            ds = self.getLevelDataset(level)
+            fitsMemory = self.textureMemoryBudget is None or self.levelTextureBytes(level) <= self.textureMemoryBudget
+            viewportSize = max(self.viewportW, self.viewportH)
+            fitsViewport = viewportSize == 0 or max(ds.sizeX, ds.sizeY, ds.sizeZ) <= self.lodVoxelsPerPixel * viewportSize
+            if fitsMemory and fitsViewport:
+                break
+            level += 1
+        if self.interacting:
+            level += self.interactionLevelBias
+        return min(level, lastLevel)
+
+    def activateLevel(self, level):
+        '''
+        makes level the rendered pyramid level, uploading its texture if it is not resident
+        other levels stay resident while all fit into textureMemoryBudget, the shader is left untouched
+        '''
+        if level not in self.levelTextures:
+            if level == 0:
+                self.setupDatasetTexture()
+            else:
+                levelDataset = self.getLevelDataset(level)
+                tex = self.createVolumeTexture(levelDataset)
+                for _ in self.datasetUploadSteps(levelDataset, tex):
+                    pass
+                self.levelTextures[level] = tex
+        if level not in self.levelGradientTextures:
+            self.levelGradientTextures[level] = self.createGradientTexture(level)
+        self.activeLevel = level
+        self.gradientTex = self.levelGradientTextures[level]
+
+        if self.textureMemoryBudget is None:
+            return
+        # evict the largest inactive levels until the resident ones fit
+        resident = sorted((l for l in self.levelTextures if l != level), key = self.levelTextureBytes, reverse = True)
+        residentBytes = sum(self.levelTextureBytes(l) for l in self.levelTextures)
+        for evicted in resident:
+            if residentBytes <= self.textureMemoryBudget:
+                break
+            self.deleteTexture(self.levelTextures.pop(evicted))
+            gradientTex = self.levelGradientTextures.pop(evicted, 0)
+            if gradientTex != 0:
+                self.deleteTexture(gradientTex)
+            residentBytes -= self.levelTextureBytes(evicted)
+            if evicted == 0:
+                self.dataTex = 0
+                self.datasetUpload = None
+                self.brickRangeUpload = None
+                if self.occupancyAwaitsUpload:
+                    self.setupOccupancyTexture()
+
+    def activeDataTexture(self):
+        return self.levelTextures.get(self.activeLevel, self.dataTex)
+
+    def getRayStepSize(self):
+        # step in texture coords, the smallest voxel extent (of the rendered level) divided by the sampling rate
+        ds = self.getLevelDataset()
+        voxelSpacing = 1.0 / max(ds.sizeX, ds.sizeY, ds.sizeZ)
+        return voxelSpacing / max(self.samplingRate, 1e-3)
+
+    def getMaxSteps(self):
+        # enough steps to cross the diagonal of the volume
+        return math.ceil(math.sqrt(3.0) / self.getRayStepSize()) + 1
+
+    def setupOccupancyTexture(self):
+        '''
+        per-brick value ranges only depend on the dataset, the occupancy is rebuilt whenever the TF changes
+        the ranges come from the dataset upload if setupDatasetTexture started one, otherwise from a pass over the dataset
+        while an incremental upload is still running, skipping stays off (occupancyTex = 0) 
+        and uploadDatasetSlabs calls this again once the last slab is in
+        '''
+        self.deleteTexture(self.occupancyTex)
+        self.occupancyTex = 0
+        self.occupancyAwaitsUpload = False
+        if self.brickRangeUpload is not None:
+            if self.datasetUpload is not None:
+                self.occupancyAwaitsUpload = True
+                return
+            self.brickMin, self.brickMax = self.brickRangeUpload
+            self.brickRangeUpload = None
+        else:
+            self.brickMin, self.brickMax = self.dataset.computeBrickMinMax(self.brickSize)
+        self.createOccupancyTexture()
+
+    def createOccupancyTexture(self):
+        self.occupancyTex = gl.glGenTextures(1)
+        self.bindTexture(gl.GL_TEXTURE_3D, self.occupancyTex)
+        gl.glTexParameteri(gl.GL_TEXTURE_3D, gl.GL_TEXTURE_WRAP_S, gl.GL_CLAMP_TO_EDGE)
+        gl.glTexParameteri(gl.GL_TEXTURE_3D, gl.GL_TEXTURE_WRAP_T, gl.GL_CLAMP_TO_EDGE)
+        gl.glTexParameteri(gl.GL_TEXTURE_3D, gl.GL_TEXTURE_WRAP_R, gl.GL_CLAMP_TO_EDGE)
+        gl.glTexParameteri(gl.GL_TEXTURE_3D, gl.GL_TEXTURE_MIN_FILTER, gl.GL_NEAREST)
+        gl.glTexParameteri(gl.GL_TEXTURE_3D, gl.GL_TEXTURE_MAG_FILTER, gl.GL_NEAREST)
+        self.updateOccupancy()
+
+    def classifyBricks(self, transFuncData):
+        '''
+        True for the bricks in which some value of the brick's range has non-zero opacity
+        transFuncData holds one or more lookup tables (n*4 or N x n x 4), a brick is occupied if any of them 
+        is non-transparent in its range
+        '''
+        lut = transFuncData.reshape((-1, self.transFuncDataSize, 4))
+        opaque = np.any(lut[:, :, 3] > 0, axis = 0)
+        n = opaque.size
+        opaqueCount = np.concatenate([[0], np.cumsum(opaque)])
+        # lookup table entries touched by linear filtering of values in [brickMin, brickMax]
+        lo = np.clip(np.floor(self.brickMin * n - 0.5), 0, n - 1).astype(np.int64)
+        hi = np.clip(np.ceil(self.brickMax * n - 0.5), 0, n - 1).astype(np.int64)
+        return opaqueCount[hi + 1] - opaqueCount[lo] > 0
+
+    def updateOccupancy(self, transFuncData = None):
+        if self.occupancyTex == 0:
+            return
+        if transFuncData is None:
+            transFuncData = self.transFuncData
+        occupancy = self.classifyBricks(transFuncData).astype(np.uint8) * 255
+        self.bindTexture(gl.GL_TEXTURE_3D, self.occupancyTex)
+        gl.glPixelStorei(gl.GL_UNPACK_ALIGNMENT, 1)
+        bricksZ, bricksY, bricksX = occupancy.shape
+        gl.glTexImage3D(gl.GL_TEXTURE_3D, 0, gl.GL_R8, bricksX, bricksY, bricksZ, 
+                        0, gl.GL_RED, gl.GL_UNSIGNED_BYTE, occupancy)
+
+    def uploadTransFuncArray(self, transFuncData):
+        '''
+        upload the lookup tables of a batch of transfer functions in one call,
+        transFuncData is an (N, n, 4) uint8 array, e.g. from TransFuncPopulation.getData
+        '''
+        noTransFuncs, lutSize = transFuncData.shape[:2]
+        if self.transFuncArrayTex == 0:
+            self.transFuncArrayTex = gl.glGenTextures(1)
+        self.bindTexture(gl.GL_TEXTURE_1D_ARRAY, self.transFuncArrayTex)
+        gl.glPixelStorei(gl.GL_UNPACK_ALIGNMENT, 1)
+        if (noTransFuncs, lutSize) != self.transFuncArraySize:
+            gl.glTexImage2D(gl.GL_TEXTURE_1D_ARRAY, 0, gl.GL_RGBA, lutSize, noTransFuncs, 
+                            0, gl.GL_RGBA, gl.GL_UNSIGNED_BYTE, np.ascontiguousarray(transFuncData))
+            gl.glTexParameteri(gl.GL_TEXTURE_1D_ARRAY, gl.GL_TEXTURE_WRAP_S, gl.GL_CLAMP_TO_EDGE)
+            gl.glTexParameteri(gl.GL_TEXTURE_1D_ARRAY, gl.GL_TEXTURE_MIN_FILTER, gl.GL_LINEAR)
+            gl.glTexParameteri(gl.GL_TEXTURE_1D_ARRAY, gl.GL_TEXTURE_MAG_FILTER, gl.GL_LINEAR)
+            self.transFuncArraySize = (noTransFuncs, lutSize)
+        else:
+            gl.glTexSubImage2D(gl.GL_TEXTURE_1D_ARRAY, 0, 0, 0, lutSize, noTransFuncs, 
+                               gl.GL_RGBA, gl.GL_UNSIGNED_BYTE, np.ascontiguousarray(transFuncData))
+
+    def bindTexture(self, target, tex):
+        # bind on the active texture unit, keeping track of the binding
+        gl.glBindTexture(target, tex)
+        self.textureBindings[(self.activeTextureUnit, target)] = tex
+
+    def deleteTexture(self, tex):
+        # deleting unbinds the texture everywhere, and its name may be reused by the next glGenTextures
+        gl.glDeleteTextures(1, tex)
+        self.textureBindings = {key : val for key, val in self.textureBindings.items() if val != tex}
+
+    def bindTextureUnit(self, unit, target, tex):
+        # bind tex to the given unit, skipped if it is still bound there
+        if self.cacheTextureBindings and self.textureBindings.get((unit, target)) == tex:
+            return
+        if unit != self.activeTextureUnit or not self.cacheTextureBindings:
+            gl.glActiveTexture(gl.GL_TEXTURE0 + unit)
+            self.activeTextureUnit = unit
+        self.bindTexture(target, tex)
+
     def setupShader(self):
         self.shader.use()
 
-        gl.glActiveTexture(gl.GL_TEXTURE0)
-        gl.glBindTexture(gl.GL_TEXTURE_3D, self.dataTex)
+        self.bindTextureUnit(0, gl.GL_TEXTURE_3D, self.activeDataTexture())
         self.shader.uniformInt('dataTex', 0)
 
-        gl.glActiveTexture(gl.GL_TEXTURE1)
-        gl.glBindTexture(gl.GL_TEXTURE_1D, self.transFuncTex)
+        self.bindTextureUnit(1, gl.GL_TEXTURE_1D, self.transFuncTex)
         self.shader.uniformInt('transFuncTex', 1)
 
-        gl.glActiveTexture(gl.GL_TEXTURE3)
-        gl.glBindTexture(gl.GL_TEXTURE_2D, self.noiseTex)
+        self.bindTextureUnit(2, gl.GL_TEXTURE_1D_ARRAY, self.transFuncArrayTex)
+        self.shader.uniformInt('transFuncArrayTex', 2)
+        self.shader.uniformInt('useTransFuncArray', int(self.useTransFuncArray))
+        self.shader.uniformInt('transFuncLayer', self.transFuncLayer)
+
+        self.bindTextureUnit(3, gl.GL_TEXTURE_2D, self.noiseTex)
         self.shader.uniformInt('noiseTex', 3)
 
+        if self.usePreintegration and (self.preintegratedTableStale or 
+                                       self.preintegratedTable.stepSize != self.getRayStepSize()):
+            self.updatePreintegratedTexture()
+        self.bindTextureUnit(6, gl.GL_TEXTURE_2D, self.preintegratedTex)
+        self.shader.uniformInt('preintegratedTex', 6)
+        self.shader.uniformInt('usePreintegration', int(self.usePreintegration and self.preintegratedTex != 0))
+
+        self.bindTextureUnit(5, gl.GL_TEXTURE_3D, self.gradientTex)
+        self.shader.uniformInt('gradientTex', 5)
+        self.shader.uniformInt('usePrecomputedGradients', int(self.gradientTex != 0))
+
+        self.bindTextureUnit(4, gl.GL_TEXTURE_3D, self.occupancyTex)
+        self.shader.uniformInt('occupancyTex', 4)
+        self.shader.uniformInt('useEmptySpaceSkipping', int(self.enableEmptySpaceSkipping and self.occupancyTex != 0))
+        if self.brickMin is not None:
+            bricksZ, bricksY, bricksX = self.brickMin.shape
+            self.shader.uniformIVec3('brickCount', glm.ivec3(bricksX, bricksY, bricksZ))
+            self.shader.uniformVec3('volumeToBrick', glm.vec3(self.dataset.sizeX, self.dataset.sizeY, self.dataset.sizeZ) / self.brickSize)
+
+        self.shader.uniformFloat('rayStepSize', self.getRayStepSize())
+        self.shader.uniformInt('maxSteps', self.getMaxSteps())
+        self.shader.uniformFloat('terminationAlpha', self.terminationAlpha)
+
         self.shader.uniformMat4('mvp', self.projMat * self.viewMat * self.modelMat)
         self.shader.uniformVec3('viewerPos', self.worldToVolume(self.viewerPos))
         self.shader.uniformVec3('lightPos', self.worldToVolume(self.lightPos))
@@ -170,20 +677,99 @@ class VolumeRaycaster:
         self.shader.uniformIVec2('noiseSize', self.noiseSize)
 
     def initialize(self):
+        # a new context starts with nothing bound and unit 0 active, the cache must not outlive the old one
+        self.textureBindings = {}
+        self.activeTextureUnit = 0
         gl.glEnable(gl.GL_DEPTH_TEST)
         self.setupProxyCube(self.cubeSize.x, self.cubeSize.y, self.cubeSize.z)
-        self.setupDatasetTexture()
+        if self.enableLevelOfDetail:
+            self.dataset.buildPyramid(self.pyramidMinSize, self.pyramidReduction)
+            if self.textureMemoryBudget is None:
+                self.textureMemoryBudget = self.queryTextureMemory()
+            # the full-resolution texture is only uploaded if its level gets selected,
+            # gradients are built with each level
+            self.levelGradientTextures = {}
+            self.activateLevel(self.selectLevel())
+        else:
+            self.setupDatasetTexture()
+            self.setupGradientTexture()
         self.setupTransFuncTexture()
         self.setupNoiseTexture()
-        self.shader.build()
+        self.setupOccupancyTexture()
+        self.shader.build(force = True)
         gl.glClearColor(self.backColor.r, self.backColor.g, self.backColor.b, 1.0)
 
     def render(self):
-        gl.glClear(gl.GL_COLOR_BUFFER_BIT | gl.GL_DEPTH_BUFFER_BIT)
-        self.setupShader()
-        gl.glDrawArrays(gl.GL_TRIANGLES, 0, 36)
+        profiler = self.profiler
+        if profiler.enabled:
+            profiler.collect()
+        with profiler.span('frame'):
+            if self.enableLevelOfDetail:
+                self.activateLevel(self.selectLevel())
+            gl.glClear(gl.GL_COLOR_BUFFER_BIT | gl.GL_DEPTH_BUFFER_BIT)
+            with profiler.span('setupShader'):
+                self.setupShader()
+            with profiler.span('draw', gpu = True):
+                gl.glDrawArrays(gl.GL_TRIANGLES, 0, 36)
+
+    def setupReducedTarget(self, w, h):
+        if self.reducedSize == (w, h):
+            return
+        if self.reducedFBO == 0:
+            self.reducedFBO = gl.glGenFramebuffers(1)
+            self.reducedRenderTex = gl.glGenTextures(1)
+            self.reducedDepthTex = gl.glGenTextures(1)
+
+        self.bindTexture(gl.GL_TEXTURE_2D, self.reducedRenderTex)
+        gl.glTexImage2D(gl.GL_TEXTURE_2D, 0, gl.GL_RGBA, w, h, 
+                        0, gl.GL_RGBA, gl.GL_UNSIGNED_BYTE, None)
+        gl.glTexParameteri(gl.GL_TEXTURE_2D, gl.GL_TEXTURE_MIN_FILTER, gl.GL_LINEAR)
+        gl.glTexParameteri(gl.GL_TEXTURE_2D, gl.GL_TEXTURE_MAG_FILTER, gl.GL_LINEAR)
+
+        self.bindTexture(gl.GL_TEXTURE_2D, self.reducedDepthTex)
+        gl.glTexImage2D(gl.GL_TEXTURE_2D, 0, gl.GL_DEPTH_COMPONENT16, w, h, 
+                        0, gl.GL_DEPTH_COMPONENT, gl.GL_UNSIGNED_SHORT, None)
+        gl.glTexParameteri(gl.GL_TEXTURE_2D, gl.GL_TEXTURE_MIN_FILTER, gl.GL_NEAREST)
+        gl.glTexParameteri(gl.GL_TEXTURE_2D, gl.GL_TEXTURE_MAG_FILTER, gl.GL_NEAREST)
+
+        gl.glBindFramebuffer(gl.GL_FRAMEBUFFER, self.reducedFBO)
+        gl.glFramebufferTexture2D(gl.GL_FRAMEBUFFER, gl.GL_COLOR_ATTACHMENT0, 
+                                  gl.GL_TEXTURE_2D, self.reducedRenderTex, 0)
+        gl.glFramebufferTexture2D(gl.GL_FRAMEBUFFER, gl.GL_DEPTH_ATTACHMENT, 
+                                  gl.GL_TEXTURE_2D, self.reducedDepthTex, 0)
+        self.reducedSize = (w, h)
+
+    def renderReduced(self, w, h, scale, samplingScale = 1.0):
+        '''
+        render a w x h frame at scale times the resolution and samplingScale times the sampling rate,
+        the low-resolution image is upscaled into the framebuffer bound when called
+        '''
+        savedSamplingRate = self.samplingRate
+        self.samplingRate = savedSamplingRate * samplingScale
+        if scale >= 1.0:
+            self.render()
+            self.samplingRate = savedSamplingRate
+            return
+
+        targetFBO = int(gl.glGetIntegerv(gl.GL_DRAW_FRAMEBUFFER_BINDING))
+        reducedW = max(1, round(w * scale))
+        reducedH = max(1, round(h * scale))
+        self.setupReducedTarget(reducedW, reducedH)
+
+        gl.glBindFramebuffer(gl.GL_FRAMEBUFFER, self.reducedFBO)
+        gl.glViewport(0, 0, reducedW, reducedH)
+        self.render()
+        self.samplingRate = savedSamplingRate
+
+        gl.glBindFramebuffer(gl.GL_READ_FRAMEBUFFER, self.reducedFBO)
+        gl.glBindFramebuffer(gl.GL_DRAW_FRAMEBUFFER, targetFBO)
+        gl.glBlitFramebuffer(0, 0, reducedW, reducedH, 0, 0, w, h, gl.GL_COLOR_BUFFER_BIT, gl.GL_LINEAR)
+        gl.glBindFramebuffer(gl.GL_FRAMEBUFFER, targetFBO)
+        gl.glViewport(0, 0, w, h)
 
     def resize(self, w, h):
+        self.viewportW = w
+        self.viewportH = h
         gl.glViewport(0, 0, w, h)
         self.projMat = glm.perspective(45, w/h, 0.1, 100)
         self.viewMat = glm.lookAt(self.viewerPos, self.lookAtPos, self.viewerUpDir)
@@ -198,8 +784,28 @@ class VolumeRaycaster:
         self.modelMat *= zpr.rotate(dx, dy, self.viewMat * self.modelMat, self.interactSensitivity)
 
     def updateTransFunc(self):
-        self.transFuncData = self.transFunc.getData(self.transFuncDataSize)
-        gl.glBindTexture(gl.GL_TEXTURE_1D, self.transFuncTex)
-        gl.glTexImage1D(gl.GL_TEXTURE_1D, 0, gl.GL_RGBA, self.transFuncDataSize, 
-                        0, gl.GL_RGBA, gl.GL_UNSIGNED_BYTE, self.transFuncData)
+        '''
+        brings the transfer function texture up to date with transFunc
+        only the lookup table entries between the neighbours of the changed control points are resampled, 
+        and only that range is uploaded (glTexSubImage1D into the texture allocated by setupTransFuncTexture)
+        '''
+        with self.profiler.span('transFuncUpdate', gpu = True):
+            if self.transFunc.interpolationFunc is self.transFuncInterpolation:
+                dirtyRange = self.transFunc.changedRange(self.transFuncCPs)
+            else:
+                dirtyRange = (0.0, 1.0)
+            if dirtyRange is None:
+                return
+            self.transFuncCPs = self.transFunc.controlPointsToArray()
+            self.transFuncInterpolation = self.transFunc.interpolationFunc
+            i0, i1 = self.transFunc.updateData(self.transFuncData, self.transFuncDataSize, *dirtyRange)
+
+            self.bindTexture(gl.GL_TEXTURE_1D, self.transFuncTex)
+            gl.glTexSubImage1D(gl.GL_TEXTURE_1D, 0, i0, i1 - i0, 
+                               gl.GL_RGBA, gl.GL_UNSIGNED_BYTE, self.transFuncData[4 * i0 : 4 * i1])
+            self.updateOccupancy()
+            if self.usePreintegration:
+                self.updatePreintegratedTexture()
+            else:
+                self.preintegratedTableStale = True
 
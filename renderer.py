@@ -1,5 +1,9 @@
+import math
+import ctypes
+from collections import deque
+import glm
 from dataset import VolumeDataset
-from transfunc import TransFunc
+from transfunc import TransFunc, TransFuncPopulation
 from raycaster import VolumeRaycaster
 from PySide2.QtGui import QOpenGLContext, QOffscreenSurface, QSurfaceFormat
 import OpenGL.GL as gl
@@ -15,12 +19,28 @@ class VolumeRenderer(VolumeRaycaster):
     def __init__(self, dataset : VolumeDataset, 
                  transFunc : TransFunc, alphaTransFunc : TransFunc,
                  w : int, h : int):
-        super().__init__(dataset, transFunc, alphaTransFunc)
+        super().__init__(dataset, transFunc)
+        self.alphaTransFunc = alphaTransFunc
         self.fbo = 0
         self.renderTex = 0
         self.depthTex = 0
         self.w = w
         self.h = h
+        # atlas framebuffer used by renderBatch, (re)allocated when the atlas size changes
+        self.batchFBO = 0
+        self.batchRenderTex = 0
+        self.batchDepthTex = 0
+        self.batchAtlasSize = None
+        # pixel pack buffers: a ring for asynchronous readbacks (getPixelsAsync / poll) 
+        # and one more for synchronous getPixels
+        self.readbackPBOCount = 3
+        self.readbackPBOs = []
+        self.readbackPBOSize = 0
+        self.readbackNext = 0
+        self.readbackCounter = 0
+        self.pendingReadbacks = deque() # (ticket, pbo, fence) in issue order
+        self.syncReadbackPBO = 0
+        self.mappedPBO = 0
         self.surfaceFormat = QSurfaceFormat()
         self.surfaceFormat.setVersion(4.4, 3.0)
         self.openglContext = QOpenGLContext()
@@ -41,14 +61,14 @@ class VolumeRenderer(VolumeRaycaster):
 
         # setup FBO and render / depth textures
         self.renderTex = gl.glGenTextures(1)
-        gl.glBindTexture(gl.GL_TEXTURE_2D, self.renderTex)
+        self.bindTexture(gl.GL_TEXTURE_2D, self.renderTex)
         gl.glTexParameteri(gl.GL_TEXTURE_2D, gl.GL_TEXTURE_WRAP_S, gl.GL_CLAMP_TO_EDGE)
         gl.glTexParameteri(gl.GL_TEXTURE_2D, gl.GL_TEXTURE_WRAP_T, gl.GL_CLAMP_TO_EDGE)
         gl.glTexParameteri(gl.GL_TEXTURE_2D, gl.GL_TEXTURE_MIN_FILTER, gl.GL_NEAREST)
         gl.glTexParameteri(gl.GL_TEXTURE_2D, gl.GL_TEXTURE_MAG_FILTER, gl.GL_NEAREST)
 
         self.depthTex = gl.glGenTextures(1)
-        gl.glBindTexture(gl.GL_TEXTURE_2D, self.depthTex)
+        self.bindTexture(gl.GL_TEXTURE_2D, self.depthTex)
         gl.glTexParameteri(gl.GL_TEXTURE_2D, gl.GL_TEXTURE_WRAP_S, gl.GL_CLAMP_TO_EDGE)
         gl.glTexParameteri(gl.GL_TEXTURE_2D, gl.GL_TEXTURE_WRAP_T, gl.GL_CLAMP_TO_EDGE)
         gl.glTexParameteri(gl.GL_TEXTURE_2D, gl.GL_TEXTURE_MIN_FILTER, gl.GL_NEAREST)
@@ -67,28 +87,210 @@ class VolumeRenderer(VolumeRaycaster):
         #self.w = w
         #self.h = h
         
-        gl.glBindTexture(gl.GL_TEXTURE_2D, self.renderTex)
+        self.bindTexture(gl.GL_TEXTURE_2D, self.renderTex)
         gl.glTexImage2D(gl.GL_TEXTURE_2D, 0, gl.GL_RGBA, self.w, self.h, 
                         0, gl.GL_RGBA, gl.GL_UNSIGNED_BYTE, None)
 
-        gl.glBindTexture(gl.GL_TEXTURE_2D, self.depthTex)
+        self.bindTexture(gl.GL_TEXTURE_2D, self.depthTex)
         gl.glTexImage2D(gl.GL_TEXTURE_2D, 0, gl.GL_DEPTH_COMPONENT16, self.w, self.h, 
                         0, gl.GL_DEPTH_COMPONENT, gl.GL_UNSIGNED_SHORT, None)
         
+        self.setupReadbackBuffers()
+
         super().resize(self.w, self.h)
+
+    def setupReadbackBuffers(self):
+        # (re)allocate the pixel pack buffers for the current image size, pending readbacks are dropped
+        size = self.w * self.h * 4
+        if size == self.readbackPBOSize:
+            return
+        self.unmapReadback()
+        while self.pendingReadbacks:
+            gl.glDeleteSync(self.pendingReadbacks.popleft()[2])
+        if self.readbackPBOs:
+            gl.glDeleteBuffers(len(self.readbackPBOs), self.readbackPBOs)
+            gl.glDeleteBuffers(1, [self.syncReadbackPBO])
+
+        self.readbackPBOs = [int(pbo) for pbo in np.atleast_1d(gl.glGenBuffers(self.readbackPBOCount))]
+        self.syncReadbackPBO = int(gl.glGenBuffers(1))
+        for pbo in self.readbackPBOs + [self.syncReadbackPBO]:
+            gl.glBindBuffer(gl.GL_PIXEL_PACK_BUFFER, pbo)
+            gl.glBufferData(gl.GL_PIXEL_PACK_BUFFER, size, None, gl.GL_STREAM_READ)
+        gl.glBindBuffer(gl.GL_PIXEL_PACK_BUFFER, 0)
+        self.readbackPBOSize = size
+        self.readbackNext = 0
+
+    def readIntoPBO(self, pbo):
+        # starts the transfer of the framebuffer into pbo, returns immediately
+        gl.glBindBuffer(gl.GL_PIXEL_PACK_BUFFER, pbo)
+        gl.glReadPixels(0, 0, self.w, self.h, gl.GL_RGBA, gl.GL_UNSIGNED_BYTE, ctypes.c_void_p(0))
+        gl.glBindBuffer(gl.GL_PIXEL_PACK_BUFFER, 0)
+
+    def mapReadback(self, pbo):
+        '''
+        maps pbo and returns a read-only zero-copy numpy view of its w*h*4 bytes
+        the view is only valid until the buffer is unmapped by the next readback call
+        '''
+        gl.glBindBuffer(gl.GL_PIXEL_PACK_BUFFER, pbo)
+        ptr = gl.glMapBufferRange(gl.GL_PIXEL_PACK_BUFFER, 0, self.readbackPBOSize, gl.GL_MAP_READ_BIT)
+        gl.glBindBuffer(gl.GL_PIXEL_PACK_BUFFER, 0)
+        self.mappedPBO = pbo
+        address = ptr.value if hasattr(ptr, 'value') else ptr
+        pixels = np.ctypeslib.as_array((ctypes.c_ubyte * self.readbackPBOSize).from_address(address))
+        pixels.flags.writeable = False
+        return pixels
+
+    def unmapReadback(self):
+        if self.mappedPBO:
+            gl.glBindBuffer(gl.GL_PIXEL_PACK_BUFFER, self.mappedPBO)
+            gl.glUnmapBuffer(gl.GL_PIXEL_PACK_BUFFER)
+            gl.glBindBuffer(gl.GL_PIXEL_PACK_BUFFER, 0)
+            self.mappedPBO = 0
+
+    def getPixelsAsync(self):
+        '''
+        starts a non-blocking readback of the current frame into the next buffer of the ring
+        returns a ticket identifying the frame, or None if all buffers are in flight (poll first)
+        '''
+        self.unmapReadback()
+        if len(self.pendingReadbacks) >= len(self.readbackPBOs):
+            return None
+        pbo = self.readbackPBOs[self.readbackNext]
+        self.readbackNext = (self.readbackNext + 1) % len(self.readbackPBOs)
+        self.readIntoPBO(pbo)
+        fence = gl.glFenceSync(gl.GL_SYNC_GPU_COMMANDS_COMPLETE, 0)
+        ticket = self.readbackCounter
+        self.readbackCounter += 1
+        self.pendingReadbacks.append((ticket, pbo, fence))
+        return ticket
+
+    def poll(self, timeoutNs = 0):
+        '''
+        returns (ticket, pixels) for the oldest readback started by getPixelsAsync once it has completed,
+        None if it is still in flight after timeoutNs nanoseconds (or nothing is pending)
+        pixels is a zero-copy view of the mapped buffer, valid until the next readback call
+        '''
+        self.unmapReadback()
+        if not self.pendingReadbacks:
+            return None
+        ticket, pbo, fence = self.pendingReadbacks[0]
+        status = gl.glClientWaitSync(fence, gl.GL_SYNC_FLUSH_COMMANDS_BIT, timeoutNs)
+        if status not in (gl.GL_ALREADY_SIGNALED, gl.GL_CONDITION_SATISFIED):
+            return None
+        self.pendingReadbacks.popleft()
+        gl.glDeleteSync(fence)
+        return ticket, self.mapReadback(pbo)
         
     def getPixels(self):
         '''
         retrieve pixels from framebuffer-bound texture
-        
+        blocks until the frame is available and returns an owned copy, the buffer is unmapped right away
+        (use getPixelsAsync / poll for zero-copy views)
         '''
-        # TODO this is probably an expensive operation, should use a pixel buffer in the future
         # TODO consider using glGetTextureSubImage (opengl 4.5 only!)
         
         #gl.glBindTexture(gl.GL_TEXTURE_2D, self.renderTex)
         #return gl.glGetTexImage(gl.GL_TEXTURE_2D, 0, gl.GL_RGBA, gl.GL_UNSIGNED_BYTE)
 
-        return gl.glReadPixels(0, 0, self.w, self.h, gl.GL_RGBA, gl.GL_UNSIGNED_BYTE)
+        with self.profiler.span('readback', gpu = True):
+            self.unmapReadback()
+            self.readIntoPBO(self.syncReadbackPBO)
+        with self.profiler.span('readbackMap'):
+            pixels = self.mapReadback(self.syncReadbackPBO).copy()
+            self.unmapReadback()
+            return pixels
+
+    def setupBatchAtlas(self, atlasW, atlasH):
+        if self.batchAtlasSize == (atlasW, atlasH):
+            return
+        if self.batchFBO == 0:
+            self.batchFBO = gl.glGenFramebuffers(1)
+            self.batchRenderTex = gl.glGenTextures(1)
+            self.batchDepthTex = gl.glGenTextures(1)
+
+        self.bindTexture(gl.GL_TEXTURE_2D, self.batchRenderTex)
+        gl.glTexImage2D(gl.GL_TEXTURE_2D, 0, gl.GL_RGBA, atlasW, atlasH, 
+                        0, gl.GL_RGBA, gl.GL_UNSIGNED_BYTE, None)
+        gl.glTexParameteri(gl.GL_TEXTURE_2D, gl.GL_TEXTURE_MIN_FILTER, gl.GL_NEAREST)
+        gl.glTexParameteri(gl.GL_TEXTURE_2D, gl.GL_TEXTURE_MAG_FILTER, gl.GL_NEAREST)
+
+        self.bindTexture(gl.GL_TEXTURE_2D, self.batchDepthTex)
+        gl.glTexImage2D(gl.GL_TEXTURE_2D, 0, gl.GL_DEPTH_COMPONENT16, atlasW, atlasH, 
+                        0, gl.GL_DEPTH_COMPONENT, gl.GL_UNSIGNED_SHORT, None)
+        gl.glTexParameteri(gl.GL_TEXTURE_2D, gl.GL_TEXTURE_MIN_FILTER, gl.GL_NEAREST)
+        gl.glTexParameteri(gl.GL_TEXTURE_2D, gl.GL_TEXTURE_MAG_FILTER, gl.GL_NEAREST)
+
+        gl.glBindFramebuffer(gl.GL_FRAMEBUFFER, self.batchFBO)
+        gl.glFramebufferTexture2D(gl.GL_FRAMEBUFFER, gl.GL_COLOR_ATTACHMENT0, 
+                                  gl.GL_TEXTURE_2D, self.batchRenderTex, 0)
+        gl.glFramebufferTexture2D(gl.GL_FRAMEBUFFER, gl.GL_DEPTH_ATTACHMENT, 
+                                  gl.GL_TEXTURE_2D, self.batchDepthTex, 0)
+        self.batchAtlasSize = (atlasW, atlasH)
 
+    def renderBatch(self, transFuncs, views = None):
+        '''
+        render one image per candidate transfer function and return them as an (N, h, w, 4) uint8 array
+        (rows from bottom to top, like getPixels)
+        transFuncs: a TransFuncPopulation or a sequence of TransFunc
+        views: None to use the current modelMat for all candidates, 
+               otherwise a sequence of model matrices, one per candidate
+        all lookup tables are uploaded at once to a 1D texture array, each candidate is rendered into 
+        its own tile of an atlas and every atlas is read back in a single transfer
+        '''
+        if isinstance(transFuncs, TransFuncPopulation):
+            transFuncData = transFuncs.getData(self.transFuncDataSize)
+        else:
+            transFuncData = np.stack([tf.getData(self.transFuncDataSize).reshape((-1, 4)) for tf in transFuncs])
+        noCandidates = transFuncData.shape[0]
+        if views is not None and len(views) != noCandidates:
+            print(f'Error: renderBatch got {len(views)} views for {noCandidates} transfer functions')
+            return None
+
+        self.openglContext.makeCurrent(self.renderSurface)
+        if self.profiler.enabled:
+            self.profiler.collect()
+        self.uploadTransFuncArray(transFuncData)
+        # skip only the bricks that are empty for all candidates
+        self.updateOccupancy(transFuncData)
+
+        # tile grid within the maximum texture size, candidates that do not fit go to further passes
+        maxTexSize = int(gl.glGetIntegerv(gl.GL_MAX_TEXTURE_SIZE))
+        cols = max(1, min(noCandidates, maxTexSize // self.w, math.ceil(math.sqrt(noCandidates))))
+        rows = max(1, min(math.ceil(noCandidates / cols), maxTexSize // self.h))
+        self.setupBatchAtlas(cols * self.w, rows * self.h)
+
+        images = np.empty((noCandidates, self.h, self.w, 4), dtype = np.uint8)
+        savedModelMat = glm.mat4(self.modelMat)
+        self.useTransFuncArray = True
+
+        with self.profiler.span('renderBatch', gpu = True):
+            for passStart in range(0, noCandidates, cols * rows):
+                passCount = min(cols * rows, noCandidates - passStart)
+                gl.glBindFramebuffer(gl.GL_FRAMEBUFFER, self.batchFBO)
+                gl.glViewport(0, 0, cols * self.w, rows * self.h)
+                gl.glClear(gl.GL_COLOR_BUFFER_BIT | gl.GL_DEPTH_BUFFER_BIT)
+
+                for tileIdx in range(passCount):
+                    candidate = passStart + tileIdx
+                    gl.glViewport((tileIdx % cols) * self.w, (tileIdx // cols) * self.h, self.w, self.h)
+                    if views is not None:
+                        self.modelMat = glm.mat4(views[candidate])
+                    self.transFuncLayer = candidate
+                    self.setupShader()
+                    gl.glDrawArrays(gl.GL_TRIANGLES, 0, 36)
+
+                usedRows = math.ceil(passCount / cols)
+                gl.glPixelStorei(gl.GL_PACK_ALIGNMENT, 1)
+                atlas = gl.glReadPixels(0, 0, cols * self.w, usedRows * self.h, gl.GL_RGBA, gl.GL_UNSIGNED_BYTE)
+                atlas = np.frombuffer(atlas, dtype = np.uint8).reshape((usedRows, self.h, cols, self.w, 4))
+                tiles = atlas.transpose((0, 2, 1, 3, 4)).reshape((-1, self.h, self.w, 4))
+                images[passStart : passStart + passCount] = tiles[:passCount]
+
+        self.useTransFuncArray = False
+        self.transFuncLayer = 0
+        self.updateOccupancy()
+        self.modelMat = savedModelMat
+        gl.glBindFramebuffer(gl.GL_FRAMEBUFFER, self.fbo)
+        gl.glViewport(0, 0, self.w, self.h)
 
-    
+        return images
@@ -1,24 +1,159 @@
-from PySide2.QtCore import Qt, Signal, Slot
-from PySide2.QtWidgets import QWidget, QOpenGLWidget
+from PySide2.QtCore import Qt, Signal, Slot, QTimer
+from PySide2.QtWidgets import QWidget, QOpenGLWidget, QLabel
 from PySide2.QtGui import QMouseEvent
 from raycaster import VolumeRaycaster
 
 class VolumeRenderWidget(QOpenGLWidget):
+    # emitted as (slicesUploaded, totalSlices) while the dataset streams into the 3D texture
+    uploadProgress = Signal(int, int)
+    # emitted with TimeSeriesDataset.playbackReport when playback stops
+    playbackStopped = Signal(str)
+
     def __init__(self, renderer : VolumeRaycaster, parent : QWidget = None):
         super().__init__(parent)
         self.renderer = renderer
         self.mouseX = 0
         self.mouseY = 0
 
+        # the dataset is uploaded uploadSlabsPerFrame slabs per frame, so the widget keeps painting while large volumes stream in
+        self.uploadSlabsPerFrame = 1
+        self.renderer.incrementalDatasetUpload = True
+        self.renderer.uploadProgressCallback = self.uploadProgress.emit
+
+        # progressive rendering: while the user drags, frames are rendered at reduced resolution and sampling rate,
+        # once input stops refineTimer steps through refinementLevels up to the full-quality frame
+        # each level is (resolution scale, sampling rate scale), the last one is full quality
+        self.progressiveRendering = True
+        self.refinementLevels = [(0.25, 0.25), (0.5, 0.5), (1.0, 1.0)]
+        self.refinementLevel = len(self.refinementLevels) - 1
+        # idle time after the last input event before refinement starts
+        self.refineDelay = 150
+        self.refineTimer = QTimer(self)
+        self.refineTimer.setSingleShot(True)
+        self.refineTimer.timeout.connect(self.refine)
+        self.viewW = 0
+        self.viewH = 0
+
+        # optional text overlay with the per-stage timings of the renderer's profiler
+        self.profilerOverlay = None
+
+        # time series playback (see startPlayback), the latest frame taken from the series waits in pendingFrame 
+        # for the next paintGL, which has the context current for the upload
+        self.timeSeries = None
+        self.pendingFrame = None
+        self.playbackTimer = QTimer(self)
+        self.playbackTimer.timeout.connect(self.playbackTick)
+
+        # transfer function changes are applied once per frame, in paintGL, however many arrive in between
+        self.transFuncDirty = False
+        self.setFocusPolicy(Qt.StrongFocus)
+
     def initializeGL(self):
         self.renderer.initialize()
 
     def paintGL(self):
-        self.renderer.render()
+        if self.transFuncDirty:
+            self.transFuncDirty = False
+            self.renderer.updateTransFunc()
+
+        if self.pendingFrame is not None:
+            _, volume, brickRanges = self.pendingFrame
+            self.pendingFrame = None
+            self.renderer.uploadVolumeFrame(volume, brickRanges)
+
+        if self.renderer.datasetUploadPending():
+            if self.renderer.uploadDatasetSlabs(self.uploadSlabsPerFrame):
+                QTimer.singleShot(0, self.update)
+
+        # the coarsest refinement level is rendered while the user is dragging
+        self.renderer.interacting = self.progressiveRendering and self.refinementLevel == 0
+        if self.progressiveRendering and self.refinementLevel < len(self.refinementLevels) - 1:
+            scale, samplingScale = self.refinementLevels[self.refinementLevel]
+            self.renderer.renderReduced(self.viewW, self.viewH, scale, samplingScale)
+            # refinement steps follow each other on idle frames, the first one waits for refineDelay
+            if self.refinementLevel > 0:
+                self.refineTimer.start(0)
+        else:
+            self.renderer.render()
+
+        if self.profilerOverlay is not None:
+            report = self.renderer.profiler.report()
+            if self.timeSeries is not None:
+                report = self.timeSeries.playbackReport() + '\n' + report
+            self.profilerOverlay.setText(report)
+            self.profilerOverlay.adjustSize()
+
+    def showProfilerOverlay(self, show = True):
+        # the overlay enables the profiler, hiding it disables profiling again
+        self.renderer.profiler.enabled = show
+        if show and self.profilerOverlay is None:
+            self.profilerOverlay = QLabel(self)
+            self.profilerOverlay.setStyleSheet('background-color: rgba(0, 0, 0, 160); color: white; font-family: monospace; padding: 4px;')
+            self.profilerOverlay.setAttribute(Qt.WA_TransparentForMouseEvents)
+            self.profilerOverlay.move(4, 4)
+            self.profilerOverlay.show()
+        elif not show and self.profilerOverlay is not None:
+            self.profilerOverlay.deleteLater()
+            self.profilerOverlay = None
+        self.update()
+
+    def startPlayback(self, series, fps = 10.0):
+        '''
+        plays a TimeSeriesDataset (whose first timestep is the renderer's dataset) at the given frame rate
+        a timestep that is not loaded when its frame is due is dropped, playback never waits for the disk
+        '''
+        self.stopPlayback()
+        self.timeSeries = series
+        if self.renderer.enableEmptySpaceSkipping:
+            series.brickSize = self.renderer.brickSize
+        # resuming continues after the timestep shown last
+        t = 0 if series.currentTimestep is None else series.followingTimestep(series.currentTimestep)
+        series.start(t or 0)
+        self.playbackTimer.start(max(1, round(1000 / fps)))
+
+    def stopPlayback(self):
+        self.playbackTimer.stop()
+        if self.timeSeries is not None:
+            self.timeSeries.stop()
+            self.playbackStopped.emit(self.timeSeries.playbackReport())
+        self.pendingFrame = None
+
+    @Slot()
+    def playbackTick(self):
+        frame = self.timeSeries.nextFrame()
+        if frame is not None:
+            self.pendingFrame = frame
+            self.update()
 
     def resizeGL(self, w, h):
+        self.viewW = w
+        self.viewH = h
         self.renderer.resize(w, h)
 
+    def interact(self):
+        # a new interaction restarts at the coarsest level, cancelling any pending refinement
+        if self.progressiveRendering:
+            self.refinementLevel = 0
+            self.refineTimer.start(self.refineDelay)
+        self.update()
+
+    @Slot()
+    def refine(self):
+        if self.refinementLevel < len(self.refinementLevels) - 1:
+            self.refinementLevel += 1
+            self.update()
+
+    def keyPressEvent(self, event):
+        if event.key() == Qt.Key_P:
+            self.showProfilerOverlay(self.profilerOverlay is None)
+        elif event.key() == Qt.Key_Space and self.timeSeries is not None:
+            if self.playbackTimer.isActive():
+                self.stopPlayback()
+            else:
+                self.startPlayback(self.timeSeries, 1000 / self.playbackTimer.interval())
+        else:
+            super().keyPressEvent(event)
+
     def mousePressEvent(self, event):
         self.mouseX = event.x()
         self.mouseY = event.y()
@@ -32,17 +167,17 @@ class VolumeRenderWidget(QOpenGLWidget):
                 self.renderer.interactPan(dx, dy)
             else:
                 self.renderer.interactRotate(dx, dy)
-            self.update()
+            self.interact()
         elif event.buttons() & Qt.RightButton:
             self.renderer.interactZoom(dy)
-            self.update()
+            self.interact()
 
         self.mouseX = event.x()
         self.mouseY = event.y()
 
     @Slot()
     def updateTransFunc(self):
-        self.renderer.updateTransFunc()
+        self.transFuncDirty = True
         self.update()
         
 
@@ -1,9 +1,14 @@
 import os
+import hashlib
 import glm
+import numpy as np
 import OpenGL.GL as gl
 import OpenGL.GLU as glu
 
 class GLSLShader:
+    # directory of the on-disk program binary cache, None disables the cache
+    binaryCacheDir = os.path.join(os.path.expanduser('~'), '.cache', 'volevol', 'shaders')
+
     def __init__(self, name, vertFile, fragFile):
         self.name = name
         self.programHandle = 0
@@ -11,6 +16,15 @@ class GLSLShader:
         self.fragHandle = 0
         self.vertFile = vertFile
         self.fragFile = fragFile
+        # uniform locations resolved after linking and the last value uploaded to each location,
+        # both only valid for the current program
+        self.cacheUniforms = True
+        self.uniformLocations = {}
+        self.uniformValues = {}
+        # preprocessor defines inserted after the #version line of both shaders, name -> value
+        self.defines = {}
+        # hash of the sources and defines the current program was built from
+        self.sourceHash = None
         
     def getVersion():
         version = gl.glGetString(gl.GL_SHADING_LANGUAGE_VERSION)
@@ -55,16 +69,54 @@ class GLSLShader:
         gl.glLinkProgram(self.programHandle)
         isLinked = gl.glGetProgramiv(self.programHandle, gl.GL_LINK_STATUS)
         if isLinked == gl.GL_FALSE:
-            infolog = gl.glGetProgramInfolog(self.programHandle)
+            infolog = gl.glGetProgramInfoLog(self.programHandle)
             gl.glDeleteProgram(self.programHandle)
             gl.glDeleteShader(self.vertHandle)
             gl.glDeleteShader(self.fragHandle)
             self.vertHandle = 0
             self.fragHandle = 0
             print(f'{self.name} program output:\n{infolog.decode()}\n')
-            return
+            self.programHandle = 0
+            return False
         gl.glDetachShader(self.programHandle, self.vertHandle)
         gl.glDetachShader(self.programHandle, self.fragHandle)
+        self.cacheUniformLocations()
+        return True
+
+    def cacheUniformLocations(self):
+        # resolve the locations of all active uniforms once per program
+        self.uniformLocations = {}
+        self.uniformValues = {}
+        noUniforms = gl.glGetProgramiv(self.programHandle, gl.GL_ACTIVE_UNIFORMS)
+        for i in range(noUniforms):
+            uniformName = gl.glGetActiveUniform(self.programHandle, i)[0]
+            if isinstance(uniformName, bytes):
+                uniformName = uniformName.decode()
+            uniformName = uniformName.rstrip('\x00')
+            loc = gl.glGetUniformLocation(self.programHandle, uniformName)
+            self.uniformLocations[uniformName] = loc
+            if uniformName.endswith('[0]'): # arrays may be referred to without the index
+                self.uniformLocations[uniformName[:-3]] = loc
+
+    def uniformLocation(self, uniformName : str):
+        if not self.cacheUniforms:
+            return gl.glGetUniformLocation(self.programHandle, uniformName)
+        loc = self.uniformLocations.get(uniformName)
+        if loc is None:
+            loc = gl.glGetUniformLocation(self.programHandle, uniformName)
+            self.uniformLocations[uniformName] = loc
+        return loc
+
+    def uniformChanged(self, loc, val):
+        # records val as the value of the uniform at loc, returns False if it already had this value
+        if not self.cacheUniforms:
+            return True
+        if loc < 0: # inactive uniform, nothing to upload
+            return False
+        if loc in self.uniformValues and self.uniformValues[loc] == val:
+            return False
+        self.uniformValues[loc] = val
+        return True
 
     def cleanup(self):
         if self.vertHandle: 
@@ -76,50 +128,145 @@ class GLSLShader:
         if self.programHandle:
             gl.glDeleteProgram(self.programHandle)
             self.programHandle = 0
+        self.uniformLocations = {}
+        self.uniformValues = {}
     
-    def build(self):
+    def applyDefines(self, source):
+        if not self.defines:
+            return source
+        defineLines = ''.join(f'#define {name} {val}\n' for name, val in self.defines.items())
+        lines = source.split('\n')
+        versionIdx = next((i for i, line in enumerate(lines) if line.strip().startswith('#version')), -1)
+        lines.insert(versionIdx + 1, defineLines.rstrip('\n'))
+        return '\n'.join(lines)
+
+    def getDriverString():
+        return '|'.join(gl.glGetString(param).decode() 
+                        for param in (gl.GL_VENDOR, gl.GL_RENDERER, gl.GL_VERSION))
+
+    def binaryCachePath(self):
+        # cache entries are keyed by the sources, defines and the driver that compiled them
+        key = hashlib.sha256((self.sourceHash + GLSLShader.getDriverString()).encode()).hexdigest()
+        return os.path.join(GLSLShader.binaryCacheDir, f'{self.name}_{key[:32]}.bin')
+
+    def loadProgramBinary(self):
+        '''
+        try to create the program from the binary cache, returns False if there is no usable entry
+        a binary rejected by the driver (e.g. after a driver update) is removed from the cache
+        '''
+        if GLSLShader.binaryCacheDir is None:
+            return False
+        cachePath = None
+        try:
+            cachePath = self.binaryCachePath()
+            if not os.path.exists(cachePath):
+                return False
+            with open(cachePath, 'rb') as cacheFile:
+                data = cacheFile.read()
+            binaryFormat = int(np.frombuffer(data[:4], dtype = '<u4')[0])
+            binary = np.frombuffer(data[4:], dtype = np.uint8)
+            gl.glProgramBinary(self.programHandle, binaryFormat, binary, binary.size)
+            if gl.glGetProgramiv(self.programHandle, gl.GL_LINK_STATUS) == gl.GL_TRUE:
+                return True
+        except Exception as e:
+            print(f'Warning: could not load cached program binary for {self.name}: {e}')
+        # the program object cannot be reused for compiling after a failed glProgramBinary on every driver
+        gl.glDeleteProgram(self.programHandle)
+        self.programHandle = gl.glCreateProgram()
+        if cachePath is not None and os.path.exists(cachePath):
+            os.remove(cachePath)
+        return False
+
+    def saveProgramBinary(self):
+        if GLSLShader.binaryCacheDir is None or self.programHandle == 0:
+            return
+        try:
+            if gl.glGetIntegerv(gl.GL_NUM_PROGRAM_BINARY_FORMATS) == 0:
+                return
+            binaryLength = gl.glGetProgramiv(self.programHandle, gl.GL_PROGRAM_BINARY_LENGTH)
+            binary = np.empty(binaryLength, dtype = np.uint8)
+            lengthOut = np.zeros(1, dtype = np.int32)
+            formatOut = np.zeros(1, dtype = np.uint32)
+            gl.glGetProgramBinary(self.programHandle, binaryLength, lengthOut, formatOut, binary)
+            os.makedirs(GLSLShader.binaryCacheDir, exist_ok = True)
+            with open(self.binaryCachePath(), 'wb') as cacheFile:
+                cacheFile.write(formatOut.astype('<u4').tobytes())
+                cacheFile.write(binary[:lengthOut[0]].tobytes())
+        except Exception as e:
+            print(f'Warning: could not save program binary for {self.name}: {e}')
+
+    def build(self, force = False):
+        '''
+        build the program from vertFile / fragFile
+        skipped if the program was already built from identical sources, unless force is True 
+        (force is needed when the opengl context changed)
+        '''
+        vertSource = self.applyDefines(GLSLShader.readSourceFile(self.vertFile))
+        fragSource = self.applyDefines(GLSLShader.readSourceFile(self.fragFile))
+        sourceHash = hashlib.sha256((vertSource + '\0' + fragSource).encode()).hexdigest()
+        if not force and self.programHandle and sourceHash == self.sourceHash:
+            return
+
         self.cleanup()
-        vertSource = GLSLShader.readSourceFile(self.vertFile)
-        fragSource = GLSLShader.readSourceFile(self.fragFile)
+        self.sourceHash = sourceHash
         self.programHandle = gl.glCreateProgram()
         if self.programHandle == 0:
             print(f'Error: failed to create shader program for: {self.name}\n')
             return
+        if self.loadProgramBinary():
+            self.cacheUniformLocations()
+            return
+
         self.vertHandle = self.compile(gl.GL_VERTEX_SHADER, vertSource)
         self.fragHandle = self.compile(gl.GL_FRAGMENT_SHADER, fragSource)
-        self.link()
+        gl.glProgramParameteri(self.programHandle, gl.GL_PROGRAM_BINARY_RETRIEVABLE_HINT, gl.GL_TRUE)
+        if self.link():
+            self.saveProgramBinary()
 
     def uniformInt(self, uniformName : str, val : int):
-        loc = gl.glGetUniformLocation(self.programHandle, uniformName)
-        gl.glUniform1i(loc, val)
+        loc = self.uniformLocation(uniformName)
+        if self.uniformChanged(loc, val):
+            gl.glUniform1i(loc, val)
 
     def uniformFloat(self, uniformName : str, val : float):
-        loc = gl.glGetUniformLocation(self.programHandle, uniformName)
-        gl.glUniform1f(loc, val)
+        loc = self.uniformLocation(uniformName)
+        if self.uniformChanged(loc, val):
+            gl.glUniform1f(loc, val)
 
     def uniformFloatArray(self, uniformName : str, arr):
-        loc = gl.glGetUniformLocation(self.programHandle, uniformName)
-        gl.glUniform1fv(loc, len(arr), arr)
+        loc = self.uniformLocation(uniformName)
+        if self.uniformChanged(loc, tuple(arr)):
+            gl.glUniform1fv(loc, len(arr), arr)
 
     def uniformVec2(self, uniformName : str, vec : glm.vec2):
-        loc = gl.glGetUniformLocation(self.programHandle, uniformName)
-        gl.glUniform2f(loc, vec.x, vec.y)
+        loc = self.uniformLocation(uniformName)
+        if self.uniformChanged(loc, glm.vec2(vec)):
+            gl.glUniform2f(loc, vec.x, vec.y)
 
     def uniformIVec2(self, uniformName : str, vec : glm.ivec2):
-        loc = gl.glGetUniformLocation(self.programHandle, uniformName)
-        gl.glUniform2i(loc, vec.x, vec.y)
+        loc = self.uniformLocation(uniformName)
+        if self.uniformChanged(loc, glm.ivec2(vec)):
+            gl.glUniform2i(loc, vec.x, vec.y)
+
+    def uniformIVec3(self, uniformName : str, vec : glm.ivec3):
+        loc = self.uniformLocation(uniformName)
+        if self.uniformChanged(loc, glm.ivec3(vec)):
+            gl.glUniform3i(loc, vec.x, vec.y, vec.z)
 
     def uniformVec3(self, uniformName : str, vec : glm.vec3):
-        loc = gl.glGetUniformLocation(self.programHandle, uniformName)
-        gl.glUniform3f(loc, vec.x, vec.y, vec.z)
+        loc = self.uniformLocation(uniformName)
+        if self.uniformChanged(loc, glm.vec3(vec)):
+            gl.glUniform3f(loc, vec.x, vec.y, vec.z)
 
     def uniformVec4(self, uniformName : str, vec : glm.vec4):
-        loc = gl.glGetUniformLocation(self.programHandle, uniformName)
-        gl.glUniform4f(loc, vec.x, vec.y, vec.z, vec.w)
+        loc = self.uniformLocation(uniformName)
+        if self.uniformChanged(loc, glm.vec4(vec)):
+            gl.glUniform4f(loc, vec.x, vec.y, vec.z, vec.w)
 
     def uniformMat4(self, uniformName : str, matrix : glm.mat4):
-        loc = gl.glGetUniformLocation(self.programHandle, uniformName)
-        gl.glUniformMatrix4fv(loc, 1, gl.GL_FALSE, glm.value_ptr(matrix))
+        loc = self.uniformLocation(uniformName)
+        if self.uniformChanged(loc, glm.mat4(matrix)):
+            gl.glUniformMatrix4fv(loc, 1, gl.GL_FALSE, glm.value_ptr(matrix))
 
 
     
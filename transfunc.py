@@ -1,3 +1,4 @@
+import math
 import glm
 import numpy as np
 
@@ -12,6 +13,64 @@ class CP:
     def __str__(self):
         return f'CP[{self.x}] : ({self.rgba.r}, {self.rgba.g}, {self.rgba.b}, {self.rgba.a}'
 
+def sampleControlPoints(cpArr, x, interpolationFunc):
+    '''
+    evaluates a batch of transfer functions at the positions in x
+    cpArr has shape (N, m, 5), each row holding m control points [x, r, g, b, a] sorted by x
+    returns a float32 array of shape (N, len(x), 4)
+    '''
+    cpArr = np.asarray(cpArr, dtype = np.float32)
+    x = np.asarray(x, dtype = np.float32)
+    noTFs, noCPs = cpArr.shape[:2]
+    noX = x.shape[0]
+    cpX = cpArr[:, :, 0]
+
+    # per-segment table with one row per quantity (x0, 1 / dx, rgba0, rgba1 - rgba0), one column per segment, 
+    # indexed by the flat index of the segment's left control point; channel-major, so that all arithmetic 
+    # below runs on contiguous rows of N * len(x) samples
+    # a segment of zero width (overlapping control points) evaluates to its right control point,
+    # the entry of the last control point of a row evaluates to that point, and an extra entry after it
+    # to the transparent color of the first control point, used before the spline
+    seg = np.zeros((10, noTFs, noCPs + 1), dtype = np.float32)
+    seg[0, :, :noCPs] = cpX
+    seg[2:6, :, :noCPs] = np.moveaxis(cpArr[:, :, 1:], 2, 0)
+    seg[2:5, :, noCPs] = seg[2:5, :, 0]
+    if noCPs > 1:
+        dx = cpX[:, 1:] - cpX[:, :-1]
+        valid = dx > 0
+        np.divide(1.0, dx, out = seg[1, :, :noCPs - 1], where = valid)
+        rgba = seg[2:6, :, :noCPs].copy()
+        seg[6:, :, :noCPs - 1] = np.where(valid, rgba[:, :, 1:] - rgba[:, :, :-1], 0.0)
+        seg[2:6, :, :noCPs - 1] = np.where(valid, rgba[:, :, :-1], rgba[:, :, 1:])
+    seg = seg.reshape((10, -1))
+
+    # number of control points at or left of each x (the index returned by TransFunc.findRightIdx), for all rows 
+    # at once: the control points are located in the sorted x, and counted up along x by one cumsum
+    order = None if np.all(x[1:] >= x[:-1]) else np.argsort(x, kind = 'stable')
+    pos = np.searchsorted(x if order is None else x[order], cpX, side = 'left')
+    pos += (noX + 1) * np.arange(noTFs)[:, None]
+    rIdx = np.bincount(pos.reshape(-1), minlength = noTFs * (noX + 1)).reshape((noTFs, noX + 1))[:, :noX]
+    rIdx = np.cumsum(rIdx, axis = 1)
+    if order is not None:
+        unsorted = np.empty_like(rIdx)
+        unsorted[:, order] = rIdx
+        rIdx = unsorted
+    lIdx = np.minimum(rIdx - 1, max(noCPs - 2, 0), out = rIdx)
+    lIdx[lIdx < 0] = noCPs
+    lIdx += (noCPs + 1) * np.arange(noTFs)[:, None]
+    s = np.take(seg, lIdx.reshape(-1), axis = 1)
+
+    # clamping u gives the last control point after the spline
+    u = np.subtract(np.broadcast_to(x, (noTFs, noX)).reshape(-1), s[0])
+    u *= s[1]
+    np.clip(u, 0.0, 1.0, out = u)
+    v = np.asarray(interpolationFunc(u), dtype = np.float32)
+    samples = s[6:]
+    samples *= v
+    samples += s[2:6]
+
+    return samples.T.reshape((noTFs, noX, 4))
+
 class TransFunc:
 
     defaultCPColor = glm.vec3(0.8)
@@ -21,7 +80,7 @@ class TransFunc:
         sets control points from an array containing formatted as:
        [x0, r0, g0, b0, a0, x1, r1, g1, b1, a1, ...]
         ''' 
-        self.cp = [CP(x, glm.vec4(r, g, b, a)) 
+        self.cp = [CP(float(x), glm.vec4(r, g, b, a)) 
                    for [x, r, g, b, a] in cpArray.reshape((-1, 5))] 
 
     def controlPointsToArray(self):
@@ -36,6 +95,8 @@ class TransFunc:
         self.cp = [CP(0.2, glm.vec4(0.9, 0.3, 0.0, 0.05)), 
                    CP(0.95, glm.vec4(0.7, 1.0, 1.0, 0.9))]
         self.interpolationFunc = TransFunc.smoothstep_1
+        # lookup tables memoized per sample count, keyed on the control point state
+        self.lutCache = {}
 
     def __str__(self):
         tfStr=''
@@ -61,7 +122,9 @@ class TransFunc:
         self.cp.pop(cpIdx)
     
     def comb(n, k):
-        return np.factorial(n) / (np.factorial(k) * np.factorial(n-k))
+        return math.comb(n, k)
+
+    # interpolation functions work on scalars as well as numpy arrays of u values
 
     def linear_0(u):
         return u
@@ -76,35 +139,60 @@ class TransFunc:
         return -20*u**7 + 70*u**6 - 84*u**5 + 35*u**4
 
     def smoothstep_n(u, n):
-        return u**(n+1) * sum([TFSpline.comb(n+k, k) * TransFunc.comb(2*n+1, n-k) * (-u)**k for k in range(n+1)])
+        return u**(n+1) * sum([TransFunc.comb(n+k, k) * TransFunc.comb(2*n+1, n-k) * (-u)**k for k in range(n+1)])
+
+    def lutCacheKey(self):
+        # the raw bytes of the control point array are hashed as the dictionary key
+        return (self.interpolationFunc, self.controlPointsToArray().tobytes())
 
     def getData(self, n):
         # take n samples from the spline at equidistant intervals on x
+        # the result is memoized, so an unchanged transfer function is not resampled
+        # note: the returned array is shared with the cache and should not be modified
         
-        samples = []
-
-        dx = 1/(n-1)
-        x = [i*dx for i in range(n)] 
-
-        for i in range(n):
-            if x[i] < self.cp[0].x:
-                yrgba = glm.vec4(self.cp[0].rgba.rgb, 0)                
-            elif x[i] > self.cp[-1].x:
-                yrgba = self.cp[-1].rgba
-                
-            else:    
-                rIdx = self.findRightIdx(x[i]) # inefficient for a sequence of ordered equidistant points, should improve this
-                p0 = self.cp[rIdx-1] # control point to the left of x
-                p1 = self.cp[rIdx] # control point to the right of x
-                u = (x[i] - p0.x) / (p1.x - p0.x)
-                v = self.interpolationFunc(u)
-                yrgba = p0.rgba + v * (p1.rgba - p0.rgba)
-
-            #samples.append(CP(x[i], yrgba)) # this list is only for drawing even samples
-            # for rendering based on transfer function only a list of rgba values is needed
-            samples.extend([yrgba.r, yrgba.g, yrgba.b, yrgba.a])
-
-        return (np.array(samples) * 255).astype(np.uint8)
+        key = self.lutCacheKey()
+        cached = self.lutCache.get(n)
+        if cached is not None and cached[0] == key:
+            return cached[1]
+
+        data = (self.sampleRGBA(np.linspace(0, 1, n)) * 255).astype(np.uint8).reshape(-1)
+        self.lutCache[n] = (key, data)
+        return data
+
+    def changedRange(self, prevCPArray):
+        '''
+        interval (x0, x1) of the domain where the spline can differ from the one with the control points
+        prevCPArray (as from controlPointsToArray); a segment only depends on its two control points, so it spans 
+        from the left to the right neighbour of the changed control points
+        returns None if nothing changed, (0, 1) if control points were added or removed
+        '''
+        cpArr = self.controlPointsToArray()
+        if cpArr.shape != np.shape(prevCPArray):
+            return (0.0, 1.0)
+        cpArr = cpArr.reshape((-1, 5))
+        changed = np.flatnonzero(np.any(cpArr != np.reshape(prevCPArray, (-1, 5)), axis = 1))
+        if changed.size == 0:
+            return None
+        x0 = cpArr[changed[0] - 1, 0] if changed[0] > 0 else 0.0
+        x1 = cpArr[changed[-1] + 1, 0] if changed[-1] + 1 < len(cpArr) else 1.0
+        return (float(x0), float(x1))
+
+    def updateData(self, data, n, x0, x1):
+        '''
+        resamples the entries of the lookup table data (n samples, laid out as by getData) lying in [x0, x1],
+        in place, with the same values getData gives; returns the updated entry range [i0, i1)
+        data must be a copy, not the array cached by getData
+        '''
+        i0 = max(math.floor(x0 * (n - 1)), 0)
+        i1 = min(math.ceil(x1 * (n - 1)) + 1, n)
+        x = np.linspace(0, 1, n)[i0:i1]
+        data[4 * i0 : 4 * i1] = (self.sampleRGBA(x) * 255).astype(np.uint8).reshape(-1)
+        return i0, i1
+
+    def sampleRGBA(self, x):
+        # evaluate the spline at all positions in x at once, returns a (len(x), 4) float array
+        cpArr = self.controlPointsToArray().reshape((1, -1, 5))
+        return sampleControlPoints(cpArr, x, self.interpolationFunc)[0]
 
     def getLinearSegmentLengths(self):
         # get linear length of each segment
@@ -114,44 +202,194 @@ class TransFunc:
             return [glm.length(self.cp[i].xa() - self.cp[i+1].xa()) for i in range(noCPs-1)]
 
     def samplesForDrawing(self, noSamples):
-        # take samples suitable for drawing spline
-        # noSamples is the number of samples for the entire spline
-        # samples are distributed across segments according to their length
-
-        cpLengths = self.getLinearSegmentLengths()
-        totalLength = sum(cpLengths)
-        cpLengths = [cpl / totalLength for cpl in cpLengths] # normalization
-
-        samplesPerSegment = [round(noSamples * cpl) for cpl in cpLengths]
-        samplesPerSegment[-1] += noSamples - sum(samplesPerSegment)
-        
-        samples = []
-
-        if self.cp[0].x > 0:
-            samples.extend([CP(0, glm.vec4(self.cp[0].rgba.rgb, 0)), 
-                            CP(self.cp[0].x, glm.vec4(self.cp[0].rgba.rgb, 0))])
-
-        for i in range(len(self.cp)-1):
-            p0 = self.cp[i]
-            p1 = self.cp[i+1]
-            
-            samples.append(p0)
-            
-            if samplesPerSegment[i] > 0:
-                du = 1/samplesPerSegment[i]
-                uVals = [j*du for j in range(1, samplesPerSegment[i])]
-                vVals = [self.interpolationFunc(u) for u in uVals]
-
-                uVals = [p0.x + u*(p1.x - p0.x) for u in uVals]
-                vVals = [p0.rgba + v*(p1.rgba - p0.rgba) for v in vVals]
-
-                samplesBetweenCPs = [CP(u, v) for u, v in zip(uVals, vVals)] 
-                samples.extend(samplesBetweenCPs)
-
-        samples.append(self.cp[-1])
-
-        if self.cp[-1].x < 1:
-            samples.append(CP(1, self.cp[-1].rgba))
-
-        return samples
+        '''
+        samples suitable for drawing the spline, as a (k, 5) float array of rows [x, r, g, b, a]
+        noSamples is the number of samples for the entire spline, distributed across segments 
+        according to their length in the (x, alpha) plane
+        each segment contributes its left control point and the samples inside it, all segments are evaluated at once
+        '''
+        cpArr = self.controlPointsToArray().reshape((-1, 5)).astype(np.float64)
+        noCPs = cpArr.shape[0]
+
+        if noCPs > 1:
+            segLengths = np.hypot(np.diff(cpArr[:, 0]), np.diff(cpArr[:, 4]))
+            totalLength = segLengths.sum()
+            segFractions = segLengths / totalLength if totalLength > 0 else np.zeros_like(segLengths)
+            samplesPerSegment = np.rint(noSamples * segFractions).astype(np.int64)
+            samplesPerSegment[-1] += noSamples - samplesPerSegment.sum()
+
+            # row j of segment i is the sample at u = j / samplesPerSegment[i], j = 0 being the left control point
+            rowsPerSegment = np.maximum(samplesPerSegment - 1, 0) + 1
+            segIdx = np.repeat(np.arange(noCPs - 1), rowsPerSegment)
+            j = np.arange(segIdx.size) - np.repeat(np.cumsum(rowsPerSegment) - rowsPerSegment, rowsPerSegment)
+            u = j / np.maximum(samplesPerSegment[segIdx], 1)
+            v = self.interpolationFunc(u)
+            p0 = cpArr[segIdx]
+            p1 = cpArr[segIdx + 1]
+            segSamples = np.empty((segIdx.size, 5))
+            segSamples[:, 0] = p0[:, 0] + u * (p1[:, 0] - p0[:, 0])
+            segSamples[:, 1:] = p0[:, 1:] + v[:, None] * (p1[:, 1:] - p0[:, 1:])
+        else:
+            segSamples = np.empty((0, 5))
+
+        parts = []
+        if cpArr[0, 0] > 0:
+            # transparent up to the first control point
+            first = cpArr[0]
+            parts.append([[0, first[1], first[2], first[3], 0], [first[0], first[1], first[2], first[3], 0]])
+        parts.append(segSamples)
+        parts.append(cpArr[-1:])
+        if cpArr[-1, 0] < 1:
+            parts.append([[1, *cpArr[-1, 1:]]])
+        return np.concatenate([np.asarray(p, dtype = np.float64).reshape((-1, 5)) for p in parts])
+
+class TransFuncPopulation:
+    '''
+    a population of N transfer functions with m control points each, stored as one packed
+    (N, m*5) array; each row has the layout used by TransFunc.controlPointsToArray
+    '''
+    def __init__(self, cpArrays, interpolationFunc = TransFunc.smoothstep_1):
+        cpArrays = np.asarray(cpArrays, dtype = np.float32)
+        self.cpData = cpArrays.reshape((cpArrays.shape[0], -1)).copy()
+        self.interpolationFunc = interpolationFunc
+        self.sortControlPoints()
+
+    def fromTransFuncs(transFuncs):
+        # all transfer functions must have the same number of control points
+        return TransFuncPopulation([tf.controlPointsToArray() for tf in transFuncs], 
+                                   transFuncs[0].interpolationFunc)
+
+    def random(size, noCPs, rng = None):
+        # random population, control points sorted by x
+        rng = np.random.default_rng(rng)
+        return TransFuncPopulation(rng.random((size, noCPs * 5)))
+
+    def __len__(self):
+        return self.cpData.shape[0]
+
+    def controlPoints(self):
+        # (N, m, 5) view on the packed data
+        return self.cpData.reshape((len(self), -1, 5))
+
+    def getTransFunc(self, idx):
+        tf = TransFunc()
+        tf.controlPointsFromArray(self.cpData[idx])
+        tf.interpolationFunc = self.interpolationFunc
+        return tf
+
+    def toTransFuncs(self):
+        return [self.getTransFunc(i) for i in range(len(self))]
+
+    def select(self, indices):
+        # new population made of the members at the given indices (repetitions allowed)
+        return TransFuncPopulation(self.cpData[indices], self.interpolationFunc)
+
+    def sortControlPoints(self):
+        cp = self.controlPoints()
+        order = np.argsort(cp[:, :, 0], axis = 1, kind = 'stable')
+        cp[:] = np.take_along_axis(cp, order[:, :, None], axis = 1)
 
+    def getData(self, n):
+        # lookup tables of all members in one call, as an (N, n, 4) uint8 array
+        samples = sampleControlPoints(self.controlPoints(), np.linspace(0, 1, n), self.interpolationFunc)
+        return (samples * 255).astype(np.uint8)
+
+    def mutate(self, rate = 0.1, sigma = 0.05, rng = None):
+        # in-place gaussian mutation of each control point component with probability rate
+        rng = np.random.default_rng(rng)
+        mask = rng.random(self.cpData.shape) < rate
+        noise = rng.normal(0.0, sigma, self.cpData.shape).astype(np.float32)
+        self.cpData += mask * noise
+        np.clip(self.cpData, 0.0, 1.0, out = self.cpData)
+        self.sortControlPoints()
+        return self
+
+    def crossover(self, parentsA, parentsB, rng = None):
+        '''
+        uniform crossover at control point granularity
+        parentsA, parentsB are index arrays of equal length, one child is produced for each pair
+        '''
+        rng = np.random.default_rng(rng)
+        cp = self.controlPoints()
+        cpA = cp[parentsA]
+        cpB = cp[parentsB]
+        mask = rng.random(cpA.shape[:2]) < 0.5
+        children = np.where(mask[:, :, None], cpA, cpB)
+        return TransFuncPopulation(children, self.interpolationFunc)
+
+
+class PreintegratedTable:
+    '''
+    pre-integrated 2D lookup table of a transfer function for ray segments of length stepSize
+    entry [back, front] holds the premultiplied rgba of a segment along which the data value goes linearly 
+    from the front to the back sample; opacities of the transfer function are per referenceStepSize, 
+    as in the opacity correction of the shader
+    update recomputes only the entries whose segments overlap the changed part of the transfer function
+    '''
+    def __init__(self, n = 256, stepSize = 0.003, referenceStepSize = 0.001):
+        self.n = n
+        self.stepSize = stepSize
+        self.referenceStepSize = referenceStepSize
+        self.table = np.zeros((n, n, 4), dtype = np.float32)
+        self.samples = None
+        self.extinction = None
+        self.extinctionColor = None
+        self.extinctionIntegral = None
+        self.colorIntegral = None
+
+    def setStepSize(self, stepSize):
+        if stepSize != self.stepSize:
+            self.stepSize = stepSize
+            # every entry depends on the segment length
+            self.samples = None
+
+    def update(self, transFunc):
+        '''
+        bring the table up to date with transFunc
+        returns the dirty regions as (row0, row1, col0, col1) index ranges, empty if nothing changed
+        '''
+        samples = transFunc.sampleRGBA(np.linspace(0, 1, self.n)).astype(np.float32)
+        if self.samples is None:
+            dirty = [(0, self.n, 0, self.n)]
+        else:
+            changed = np.nonzero(np.any(samples != self.samples, axis = 1))[0]
+            if changed.size == 0:
+                return []
+            # a segment changes if its value range [min(front, back), max(front, back)] meets [i0, i1],
+            # i.e. all entries except the squares with both samples below i0 or both above i1
+            i0, i1 = int(changed[0]), int(changed[-1]) + 1
+            dirty = [(0, i0, i0, self.n), (i0, i1, 0, self.n), (i1, self.n, 0, i1)]
+            dirty = [rect for rect in dirty if rect[0] < rect[1] and rect[2] < rect[3]]
+
+        self.samples = samples
+        # extinction per unit length, its integral over the data value (trapezoidal, in units of table entries)
+        alpha = np.minimum(samples[:, 3], 0.9999)
+        self.extinction = -np.log1p(-alpha) / self.referenceStepSize
+        self.extinctionColor = self.extinction[:, None] * samples[:, :3]
+        weighted = self.extinctionColor
+        self.extinctionIntegral = np.zeros(self.n, dtype = np.float32)
+        self.extinctionIntegral[1:] = np.cumsum(0.5 * (self.extinction[1:] + self.extinction[:-1]))
+        self.colorIntegral = np.zeros((self.n, 3), dtype = np.float32)
+        self.colorIntegral[1:] = np.cumsum(0.5 * (weighted[1:] + weighted[:-1]), axis = 0)
+
+        for row0, row1, col0, col1 in dirty:
+            self.table[row0:row1, col0:col1] = self.computeBlock(np.arange(row0, row1), np.arange(col0, col1))
+        return dirty
+
+    def computeBlock(self, back, front):
+        # entries for all pairs of back (rows) and front (columns) sample indices
+        diff = back[:, None] - front[None, :]
+        same = diff == 0
+        safeDiff = np.where(same, 1, diff)
+        # mean extinction and extinction-weighted color along the segment
+        meanExtinction = np.where(same, self.extinction[front][None, :],
+                                  (self.extinctionIntegral[back][:, None] - self.extinctionIntegral[front][None, :]) / safeDiff)
+        meanColor = np.where(same[:, :, None], self.extinctionColor[front][None, :, :],
+                             (self.colorIntegral[back][:, None] - self.colorIntegral[front][None, :]) / safeDiff[:, :, None])
+
+        block = np.empty(diff.shape + (4,), dtype = np.float32)
+        block[:, :, 3] = 1.0 - np.exp(-self.stepSize * meanExtinction)
+        color = np.divide(meanColor, meanExtinction[:, :, None], out = np.zeros_like(meanColor), 
+                          where = meanExtinction[:, :, None] > 0)
+        block[:, :, :3] = color * block[:, :, 3:]
+        return block
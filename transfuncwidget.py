@@ -2,8 +2,8 @@ import numpy as np
 from PySide2.QtWidgets import QWidget, QColorDialog
 from PySide2.QtGui import QMouseEvent, QKeyEvent, QPaintEvent, QResizeEvent
 from PySide2.QtGui import QPainter, QPen, QBrush, QColor, QLinearGradient, QPalette
-from PySide2.QtGui import QImage, QPixmap
-from PySide2.QtCore import Qt, Signal, Slot
+from PySide2.QtGui import QImage, QPixmap, QPolygonF
+from PySide2.QtCore import Qt, Signal, Slot, QPointF
 from transfunc import TransFunc
 import glm
 
@@ -23,6 +23,8 @@ class TransFuncWidget(QWidget):
     cpBrush = QBrush(cpFillColor, Qt.BrushStyle.SolidPattern)
     cpPen = QPen(cpOutlineColor, cpOutlineThickness, Qt.PenStyle.SolidLine)
 
+    histogramColor = QColor(80, 80, 80, 110)
+
     drawSampleFillColor = QColor(255, 0, 0)
     drawSampleOutlineColor = QColor(128, 0, 0)
     drawSampleOutlineThickness = 1.0
@@ -44,6 +46,16 @@ class TransFuncWidget(QWidget):
         self.mouseX = 0
         self.mouseY = 0
         self.backgroundImage = self.generateBackgroundImage()
+        # data histogram drawn behind the spline (see setHistogram), heights on a log scale, in [0, 1]
+        self.histogramEdges = None
+        self.histogramHeights = None
+        self.histogramImage = None
+        # cached by updateDrawCache, keyed on the control points and the widget size
+        self.drawCacheKey = None
+        self.gradientFillImage = None
+        self.splinePolyline = None
+        self.cpPositions = []
+        self.cpColors = []
         
     def sizeHint(self):
         return super().sizeHint()
@@ -61,6 +73,36 @@ class TransFuncWidget(QWidget):
         backImg = QImage(pattern, w, h, w, QImage.Format_Grayscale8)
         return QPixmap.fromImage(backImg)
 
+    def setHistogram(self, counts, edges, logScale = True):
+        '''
+        histogram of the data values over the transfer function domain, e.g. from VolumeDataset.textureHistogram
+        it is rendered into an image once per widget size, paintEvent only draws that image
+        '''
+        counts = np.asarray(counts, dtype = np.float64)
+        heights = np.log1p(counts) if logScale else counts
+        self.histogramEdges = np.asarray(edges, dtype = np.float64)
+        self.histogramHeights = heights / max(heights.max(), 1e-12)
+        self.histogramImage = self.generateHistogramImage()
+        self.update()
+
+    def generateHistogramImage(self):
+        if self.histogramHeights is None:
+            return None
+        w = self.width()
+        h = self.height()
+        # outline of the bars, from the bottom left to the bottom right corner
+        xs = np.repeat(np.clip(self.histogramEdges, 0, 1) * w, 2)
+        ys = h * (1.0 - np.concatenate([[0], np.repeat(self.histogramHeights, 2), [0]]))
+        outline = QPolygonF([QPointF(x, y) for x, y in zip(xs, ys)])
+        histImg = QImage(w, h, QImage.Format_ARGB32_Premultiplied)
+        histImg.fill(Qt.transparent)
+        painter = QPainter(histImg)
+        painter.setPen(Qt.NoPen)
+        painter.setBrush(QBrush(TransFuncWidget.histogramColor))
+        painter.drawPolygon(outline)
+        painter.end()
+        return QPixmap.fromImage(histImg)
+
     def mapToDrawArea(self, point : glm.vec2):
         return glm.vec2(point.x * self.width(), self.height() * (1.0 - point.y))
 
@@ -82,29 +124,36 @@ class TransFuncWidget(QWidget):
     def Vec3FromQColor(self, col : QColor):
         return glm.vec3(col.redF(), col.greenF(), col.blueF())
 
-    def paintEvent(self, event : QPaintEvent):
-        painter = QPainter()
-        
-        drawSamples = self.spline.samplesForDrawing(64)
+    def updateDrawCache(self):
+        '''
+        rebuilds the gradient fill image, the spline polyline and the control point positions / colors,
+        only if the control points or the widget size changed since the last call (not for hover / plain repaints)
+        '''
+        key = (self.spline.lutCacheKey(), self.width(), self.height())
+        if key == self.drawCacheKey:
+            return
+        self.drawCacheKey = key
+        w = self.width()
+        h = self.height()
 
-        drawPointsUnmapped = [sample.xa() for sample in drawSamples]
-        drawPoints = self.mapListToDrawArea(drawPointsUnmapped)
-        drawColors = [self.QColorFromVec4(sample.rgba) for sample in drawSamples]
+        # more control points get more samples, so every segment stays smooth
+        noDrawSamples = max(self.noSamples, 16 * (len(self.spline.cp) - 1))
+        drawSamples = self.spline.samplesForDrawing(noDrawSamples)
+        drawX = drawSamples[:, 0] * w
+        drawY = h * (1.0 - drawSamples[:, 4])
+        self.splinePolyline = QPolygonF([QPointF(x, y) for x, y in zip(drawX.tolist(), drawY.tolist())])
 
-        #evenSamples = self.spline.sampleEvenX(self.noSamples)
-        #evenPoints = self.mapListToDrawArea([glm.vec2(sample.x, sample.rgba.a) for sample in evenSamples])
-        #evenColors = [sample.rgba.rgb for sample in evenSamples]
-        
-        cpPositions = [p.xa() for p in self.spline.cp]
-        cpPositions = self.mapListToDrawArea(cpPositions)
-        cpColors = [self.QColorFromVec3(p.rgba.rgb) for p in self.spline.cp]
+        cpArr = self.spline.controlPointsToArray().reshape((-1, 5))
+        self.cpPositions = [QPointF(x * w, h * (1.0 - a)) for x, a in zip(cpArr[:, 0].tolist(), cpArr[:, 4].tolist())]
+        self.cpColors = [QColor(r, g, b) for r, g, b in (255 * cpArr[:, 1:4]).astype(int).tolist()]
 
         # create fill of draw area from control point colors
-        horizColorGrad = QLinearGradient(0, 0, self.width(), 0)
-        for p, col in zip(drawPointsUnmapped, drawColors):
-            horizColorGrad.setColorAt(p.x, col)
+        horizColorGrad = QLinearGradient(0, 0, w, 0)
+        drawColors = (255 * drawSamples[:, 1:]).astype(int).tolist()
+        for x, (r, g, b, a) in zip(drawSamples[:, 0].tolist(), drawColors):
+            horizColorGrad.setColorAt(x, QColor(r, g, b, a))
         
-        verticalAlphaGrad = QLinearGradient(0, self.height(), 0, 0)
+        verticalAlphaGrad = QLinearGradient(0, h, 0, 0)
         noGradSamples = 10
         gradStep = 1/noGradSamples
         gradPositions = np.arange(0, 1 + gradStep, gradStep)
@@ -112,52 +161,40 @@ class TransFuncWidget(QWidget):
         for gradPos, gradVal in zip(gradPositions, gradValues):
             verticalAlphaGrad.setColorAt(gradPos, QColor(255, 255, 255, gradVal))
         
-        imgGradFill = QImage(self.width(), self.height(), QImage.Format_ARGB32_Premultiplied)
+        imgGradFill = QImage(w, h, QImage.Format_ARGB32_Premultiplied)
         imgGradFill.fill(Qt.transparent)
-        painter.begin(imgGradFill)
+        painter = QPainter(imgGradFill)
         painter.fillRect(imgGradFill.rect(), QBrush(horizColorGrad))
         painter.setCompositionMode(QPainter.CompositionMode_DestinationIn)
         painter.fillRect(imgGradFill.rect(), QBrush(verticalAlphaGrad))
         painter.end()
+        self.gradientFillImage = imgGradFill
 
+    def paintEvent(self, event : QPaintEvent):
+        self.updateDrawCache()
+
+        painter = QPainter()
         painter.begin(self)
         painter.setRenderHint(QPainter.Antialiasing)
         painter.setCompositionMode(QPainter.CompositionMode_SourceOver)
         
         painter.drawPixmap(0, 0, self.backgroundImage)
 
-        painter.drawImage(0, 0, imgGradFill)
+        painter.drawImage(0, 0, self.gradientFillImage)
 
-        painter.setPen(TransFuncWidget.splinePen)
-        
-        ## spline using evenPoints
-        #for i in range(len(evenPoints)-1):
-        #    painter.drawLine(evenPoints[i].x, evenPoints[i].y, 
-        #                     evenPoints[i+1].x, evenPoints[i+1].y)
-        
-        # spline using drawPoints
-        for i in range(len(drawPoints)-1):
-            painter.drawLine(drawPoints[i].x, drawPoints[i].y, 
-                             drawPoints[i+1].x, drawPoints[i+1].y)
+        if self.histogramImage is not None:
+            painter.drawPixmap(0, 0, self.histogramImage)
 
-        ## vertical sample lines
-        #painter.setPen(QPen(QColor(0, 0, 255)))
-        #for i in range(len(evenPoints)):
-        #    painter.drawLine(evenPoints[i].x, self.height(), evenPoints[i].x, evenPoints[i].y)
+        # spline
+        painter.setPen(TransFuncWidget.splinePen)
+        painter.drawPolyline(self.splinePolyline)
 
         # control points
         painter.setPen(TransFuncWidget.cpPen)
-        for pos, col in zip(cpPositions, cpColors):
+        for pos, col in zip(self.cpPositions, self.cpColors):
             TransFuncWidget.cpBrush.setColor(col)    
             painter.setBrush(TransFuncWidget.cpBrush)
-            painter.drawEllipse(pos.x - self.cpRadius, pos.y - self.cpRadius, self.cpDiameter, self.cpDiameter)
-
-        ## draw points
-        #painter.setPen(TransFuncWidget.drawSamplePen)
-        #painter.setBrush(TransFuncWidget.drawSampleBrush)
-        #for dp in drawPoints:
-        #    painter.drawEllipse(dp.x - self.drawSampleRadius, dp.y - self.drawSampleRadius,
-        #                        self.drawSampleDiameter, self.drawSampleDiameter)
+            painter.drawEllipse(pos, self.cpRadius, self.cpRadius)
 
         painter.end()
 
@@ -238,6 +275,7 @@ class TransFuncWidget(QWidget):
         # important: when resizing procedurally-generated images make sure to update the bytesPerLine parameter!!!
         # also important: when painting on a QImage make sure to initialze the color values of the QImage using .fill(...)
         self.backgroundImage = self.generateBackgroundImage()
+        self.histogramImage = self.generateHistogramImage()
 
     def updateTransFunc(self):
         self.update()
@@ -1,4 +1,4 @@
-from PySide2.QtCore import Qt, QSize, Signal, Slot
+from PySide2.QtCore import Qt, QSize, Signal, Slot, QTimer
 from PySide2.QtWidgets import QWidget, QLabel, QVBoxLayout
 from PySide2.QtGui import QImage, QPixmap
 from PySide2.QtGui import QMouseEvent, QResizeEvent
@@ -97,6 +97,13 @@ class VolumeImageViewer(SimpleImageViewer):
         self.update()
 
 class HistogramPlotter(FigureCanvasQTAgg):
+    '''
+    line plot of a histogram with its chi2 annotation, redrawn incrementally:
+    the artists are created once and updated with set_data, the axes are rendered once into a cached background 
+    (re-cached on every full draw, e.g. after a resize), and an update only restores the background, 
+    draws the three artists and blits the axes
+    updates arriving faster than refreshInterval (ms) are coalesced, only the latest one is drawn
+    '''
     defaultDPI = 100
     def __init__(self, width = 400, height = 200, parent : QWidget = None):
         self.fig = Figure(figsize = (width / self.defaultDPI, 
@@ -109,25 +116,62 @@ class HistogramPlotter(FigureCanvasQTAgg):
 
         self.xRange = [0.0, 1.0]
         self.yRange = [0.0, 0.01]
+        self.axes.set_xlim(self.xRange)
+        self.axes.set_ylim(self.yRange)
 
+        # animated artists are left out of full draws, they are drawn over the cached background
+        self.histLine, = self.axes.plot([], [], animated = True)
+        self.meanLine, = self.axes.plot(self.xRange, [0, 0], animated = True)
+        self.chi2Label = self.axes.annotate('', (self.xRange[0] + 0.02, self.yRange[1] - 0.001), animated = True)
+        self.xVals = np.empty(0)
+        self.background = None
+        self.mpl_connect('draw_event', self.onDraw)
+
+        self.refreshInterval = 16
+        self.pendingHist = None
+        self.refreshTimer = QTimer(self)
+        self.refreshTimer.setSingleShot(True)
+        self.refreshTimer.timeout.connect(self.drawPendingHist)
+
+    def onDraw(self, event):
+        # a full draw of the figure, cache it without the artists and draw them on top
+        self.background = self.copy_from_bbox(self.axes.bbox)
+        self.drawArtists()
+
+    def drawArtists(self):
+        for artist in (self.histLine, self.meanLine, self.chi2Label):
+            self.axes.draw_artist(artist)
 
     def updateHist(self, histVals):
-        
-        xVals = np.arange(self.xRange[0], self.xRange[1], 
-                          (self.xRange[1] - self.xRange[0])/len(histVals))
-        #hVals = hVals / sum(histVals)
-        self.axes.cla()
-        self.axes.plot(xVals, histVals)
+        self.pendingHist = np.asarray(histVals)
+        if not self.refreshTimer.isActive():
+            self.refreshTimer.start(self.refreshInterval)
+
+    @Slot()
+    def drawPendingHist(self):
+        if self.pendingHist is not None:
+            histVals = self.pendingHist
+            self.pendingHist = None
+            self.drawHist(histVals)
+
+    def drawHist(self, histVals):
+        # draws histVals right away, bypassing the coalescing of updateHist
+        if len(self.xVals) != len(histVals):
+            self.xVals = np.arange(self.xRange[0], self.xRange[1], 
+                                   (self.xRange[1] - self.xRange[0])/len(histVals))
+        self.histLine.set_data(self.xVals, histVals)
         histMean = (np.max(histVals) - np.min(histVals)) / 2
-        self.axes.plot([0, 1], [histMean, histMean])
+        self.meanLine.set_ydata([histMean, histMean])
         chi2 = np.sum((histVals - histMean)**2)/histMean
-        self.axes.annotate(f'chi2 = {round(chi2, 3)}', (self.xRange[0] + 0.02, self.yRange[1] - 0.001))
-
-        self.axes.set_xlim(self.xRange)
-        self.axes.set_ylim(self.yRange)
-
-        self.fig.canvas.draw()
+        self.chi2Label.set_text(f'chi2 = {round(chi2, 3)}')
 
+        if self.background is None:
+            # first update, the full draw caches the background
+            self.draw()
+            return
+        self.restore_region(self.background)
+        self.drawArtists()
+        self.blit(self.axes.bbox)
 
 class GradMapViewer(QWidget):
     def __init__(self, parent : QWidget = None):
@@ -148,11 +192,16 @@ class GradMapViewer(QWidget):
         self.setLayout(layout)
 
     def updateContents(self, gradMap, histVals):
-        w, h = gradMap.shape
-        self.imgWidget.loadImageData(gradMap, [w, h, 1])
+        # gradMap is an (h, w) uint8 image
+        h, w = gradMap.shape
+        self.imgWidget.loadImageData(np.ascontiguousarray(gradMap), [w, h, 1])
         self.histWidget.updateHist(histVals)
         self.update()
 
+    def showScores(self, scores, index = 0):
+        # one candidate of a batch scored by fitness.scoreBatch / FitnessEvaluator
+        self.updateContents(scores['gradientMaps'][index], scores['histograms'][index])
+
 
 
         